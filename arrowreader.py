@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+""" Arrow stream reader for ogr2osm
+
+GDAL 3.6 and later can return the features of a layer as columnar record
+batches with Layer.GetArrowStreamAsNumPy(), which avoids most of the per
+feature and per field overhead of GetNextFeature() and GetFieldAsString().
+
+ArrowReader reads a layer that way and yields ArrowFeature objects, which
+offer the ogr.Feature methods the parser uses (GetFID, GetFieldCount,
+GetFieldAsString and GetGeometryRef), so the parser is the same for both
+readers. The fields of a batch are turned into strings a column at a time,
+the way GetFieldAsString() formats them: reals of a field with a width with
+its precision, other reals with %.15g, and nulls as empty strings.
+Only layers whose fields are all strings, integers or reals are read this way.
+
+As the formatting has to match exactly for the tags to be the same with both
+readers, the first features are read with GetNextFeature() before the stream
+is opened, and the rows of the first batch are checked against them. On any
+difference the reader warns and reads the layer feature by feature instead.
+
+Those bindings need Python 3. canReadArrow() tells whether a layer supports
+them; if not, the parser keeps reading the features one by one, which is
+also the default without --arrow.
+"""
+
+import logging
+
+from osgeo import ogr
+
+BATCHSIZE = 10000
+
+# Rows of the first batch compared with GetFieldAsString()
+CHECKROWS = 100
+
+FIELD_TYPES = (ogr.OFTString, ogr.OFTInteger, ogr.OFTInteger64, ogr.OFTReal)
+
+
+def canReadArrow(layer):
+    # Checked on the class, so wrappers that filter the features in
+    # GetNextFeature(), like CellLayer, are not read around
+    if getattr(type(layer), "GetArrowStreamAsNumPy", None) is None:
+        return False
+    featureDefinition = layer.GetLayerDefn()
+    return all(featureDefinition.GetFieldDefn(j).GetType() in FIELD_TYPES
+               for j in range(featureDefinition.GetFieldCount()))
+
+
+def columnFormatter(fieldDefinition):
+    # A function turning a column of the field into a list of strings
+    fieldType = fieldDefinition.GetType()
+    if fieldType == ogr.OFTReal:
+        width = fieldDefinition.GetWidth()
+        if width != 0:
+            form = "%%.%df" % fieldDefinition.GetPrecision()
+        else:
+            form = "%.15g"
+        return lambda column: ["" if value is None else form % float(value)
+                               for value in column]
+    if fieldType in (ogr.OFTInteger, ogr.OFTInteger64):
+        return lambda column: ["" if value is None else str(int(value))
+                               for value in column]
+    return lambda column: ["" if value is None else
+                           value.decode("utf-8") if isinstance(value, bytes) else str(value)
+                           for value in column]
+
+
+class ArrowReader(object):
+    def __init__(self, layer, batchsize=BATCHSIZE):
+        self.layer = layer
+        self.batchsize = batchsize
+        featureDefinition = layer.GetLayerDefn()
+        fieldDefinitions = [featureDefinition.GetFieldDefn(j)
+                            for j in range(featureDefinition.GetFieldCount())]
+        self.fieldNames = [fieldDefinition.GetNameRef() for fieldDefinition in fieldDefinitions]
+        self.fieldIndexes = dict((name, j) for (j, name) in enumerate(self.fieldNames))
+        self.formatters = [columnFormatter(fieldDefinition)
+                           for fieldDefinition in fieldDefinitions]
+        self.fidColumn = layer.GetFIDColumn() or "OGC_FID"
+        self.geometryColumn = layer.GetGeometryColumn() or "wkb_geometry"
+
+    def __iter__(self):
+        # Nothing else may be read from the layer while its stream is open,
+        # so the features to check against are read first
+        expected = self.firstRows()
+        self.layer.ResetReading()
+        stream = self.layer.GetArrowStreamAsNumPy(
+            ["INCLUDE_FID=YES", "MAX_FEATURES_IN_BATCH=%d" % self.batchsize])
+        fallback = False
+        for batch in stream:
+            columns = [formatter(batch[name]) for (name, formatter)
+                       in zip(self.fieldNames, self.formatters)]
+            fids = batch[self.fidColumn]
+            geometries = batch[self.geometryColumn] if self.geometryColumn in batch else None
+            if expected is not None:
+                fallback = not self.matches(columns, fids, expected)
+                expected = None
+                if fallback:
+                    break
+            for row in range(len(fids)):
+                yield ArrowFeature(self, columns, fids, geometries, row)
+        stream = batch = None
+        if fallback:
+            logging.warning(("Arrow field values of layer %s differ from OGR's, " +
+                             "reading it feature by feature") % self.layer.GetName())
+            for ogrfeature in self.features():
+                yield ogrfeature
+
+    def firstRows(self):
+        # The strings GetFieldAsString() gives for the first features, by FID
+        rows = {}
+        for ogrfeature in self.features():
+            rows[ogrfeature.GetFID()] = [ogrfeature.GetFieldAsString(j)
+                                         for j in range(len(self.fieldNames))]
+            if len(rows) >= CHECKROWS:
+                break
+        return rows
+
+    def matches(self, columns, fids, expected):
+        # Whether the rows of the batch read before give the same strings
+        for row in range(len(fids)):
+            values = expected.get(int(fids[row]))
+            if values is not None and [column[row] for column in columns] != values:
+                return False
+        return True
+
+    def features(self):
+        self.layer.ResetReading()
+        ogrfeature = self.layer.GetNextFeature()
+        while ogrfeature is not None:
+            yield ogrfeature
+            ogrfeature = self.layer.GetNextFeature()
+
+
+class ArrowFeature(object):
+    __slots__ = ("reader", "columns", "fids", "geometries", "row", "geometry")
+
+    def __init__(self, reader, columns, fids, geometries, row):
+        self.reader = reader
+        self.columns = columns
+        self.fids = fids
+        self.geometries = geometries
+        self.row = row
+        self.geometry = None
+
+    def GetFID(self):
+        return int(self.fids[self.row])
+
+    def GetFieldCount(self):
+        return len(self.columns)
+
+    def GetFieldAsString(self, field):
+        if not isinstance(field, int):
+            field = self.reader.fieldIndexes[field]
+        return self.columns[field][self.row]
+
+    def GetGeometryRef(self):
+        # Decoded on first use, and kept so that changes to it stay
+        if self.geometry is None and self.geometries is not None:
+            wkb = self.geometries[self.row]
+            if wkb is not None:
+                self.geometry = ogr.CreateGeometryFromWkb(bytes(wkb))
+        return self.geometry
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Benchmark vertex extraction from OGR linestrings
+
+Reads the vertices of the same synthetic linestrings with one GetPoint(i) call
+per vertex, as the parser used to, and with each of the linepoints paths:
+GetPoints(), WKB decoding and GetPoint_2D(i). Checks that they all return the
+same coordinates and prints the time each took.
+
+usage: bench_linepoints.py [-l LINES] [-v VERTICES] [-r REPEAT]
+"""
+
+import os
+import random
+import sys
+import time
+from optparse import OptionParser
+
+from osgeo import ogr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from linepoints import getPoints, wkbPoints, pointByPoint
+
+
+def makeLines(linecount, vertexcount, seed=1):
+    random.seed(seed)
+    lines = []
+    for i in range(linecount):
+        line = ogr.Geometry(ogr.wkbLineString)
+        (x, y) = (random.uniform(73, 135), random.uniform(18, 53))
+        for j in range(random.randint(2, 2 * vertexcount)):
+            x += random.uniform(-0.001, 0.001)
+            y += random.uniform(-0.001, 0.001)
+            line.AddPoint_2D(x, y)
+        lines.append(line)
+    return lines
+
+
+def getPointLoop(ogrgeometry):
+    # What parseLineString() did before
+    points = []
+    for i in range(ogrgeometry.GetPointCount()):
+        (x, y, unused) = ogrgeometry.GetPoint(i)
+        points.append((x, y))
+    return points
+
+
+def run(extract, lines):
+    start = time.time()
+    result = [extract(line) for line in lines]
+    return (time.time() - start, result)
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [-l LINES] [-v VERTICES] [-r REPEAT]")
+    parser.add_option("-l", "--lines", dest="lines", type="int", default=20000)
+    parser.add_option("-v", "--vertices", dest="vertices", type="int", default=20,
+                      help="Average number of vertices per line")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3)
+    (options, args) = parser.parse_args()
+
+    lines = makeLines(options.lines, options.vertices)
+    vertexcount = sum([line.GetPointCount() for line in lines])
+    methods = [('GetPoint loop', getPointLoop),
+               ('GetPoint_2D', pointByPoint),
+               ('WKB decoding', wkbPoints)]
+    if hasattr(ogr.Geometry, "GetPoints"):
+        methods.append(('GetPoints', getPoints))
+
+    results = {}
+    for (name, extract) in methods:
+        times = []
+        for i in range(options.repeat):
+            (elapsed, points) = run(extract, lines)
+            times.append(elapsed)
+        results[name] = (min(times), points)
+
+    (looptime, reference) = results['GetPoint loop']
+    for (name, extract) in methods:
+        if [list(points) for points in results[name][1]] != [list(points) for points in reference]:
+            print "ERROR: %s returns different coordinates" % name
+            sys.exit(1)
+    print "%d lines, %d vertices, all methods agree" % (len(lines), vertexcount)
+    for (name, extract) in methods:
+        elapsed = results[name][0]
+        print "%-15s %.3f s, %.2f M vertices/s, %.1fx" % (
+            name + ":", elapsed, vertexcount / elapsed / 1e6, looptime / elapsed)
+
+
+if __name__ == "__main__":
+    main()
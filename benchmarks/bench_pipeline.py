@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Benchmark the ogr2osm conversion pipeline on synthetic data
+
+Generates road networks (linestrings sharing their end points at the
+junctions) and building footprints (rectangles, some with a courtyard) at
+several sizes, as shapefiles, GeoPackages and SQLite databases. The SQLite
+databases stand in for PostGIS, as ogr2osm2.py is tied to its database server.
+The data is in UTM 50N, so reprojection is part of the work. Generated files
+are kept in the data directory and reused, so that runs against different
+commits read the same data.
+
+For every dataset, the phases of ogr2osm.py are timed on their own in a fresh
+process, with the definitions of the script loaded without running its main
+flow:
+
+  read        reading the fields and geometries of all the features
+  parse       parseData(): reading, reprojecting and building the elements
+  output      output(): writing the elements
+
+then the whole script is run. Every result gives the time, the features/s,
+the vertices/s, the MB/s written where there is output, and the peak RSS of
+the process. The results are written as JSON; with --baseline, the speed and
+memory of each result are compared to those of an earlier run.
+
+usage: bench_pipeline.py [-s SIZES] [--formats F,...] [--layers L,...]
+                         [-r REPEAT] [-d DATADIR] [-o RESULTS]
+                         [--baseline RESULTS] [-a CONVERTER_ARGS]
+"""
+
+import json
+import math
+import os
+import random
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+# Dataset formats: OGR driver and file extension
+FORMATS = {
+    'shp': ("ESRI Shapefile", ".shp"),
+    'gpkg': ("GPKG", ".gpkg"),
+    'sqlite': ("SQLite", ".sqlite"),
+}
+LAYERS = ('roads', 'buildings')
+PHASES = ('read', 'parse', 'output')
+
+# The converter script is loaded up to this line
+MAIN_FLOW = "\n# Main flow\n"
+
+# UTM zone 50N, around Beijing
+EPSG = 32650
+ORIGIN = (440000.0, 4420000.0)
+SPACING = 100.0
+
+NAMES = [u"京藏路", u"长安街", "Main Street", "Ring Road & <Exit>"]
+
+
+def datasetName(layer, size, format):
+    return "%s_%d%s" % (layer, size, FORMATS[format][1])
+
+
+def createLayer(filename, format, layername, geometrytype, fields):
+    from osgeo import ogr, osr
+    driver = ogr.GetDriverByName(FORMATS[format][0])
+    if os.path.exists(filename):
+        driver.DeleteDataSource(filename)
+    dataSource = driver.CreateDataSource(filename)
+    spatialRef = osr.SpatialReference()
+    spatialRef.ImportFromEPSG(EPSG)
+    layer = dataSource.CreateLayer(layername, spatialRef, geometrytype)
+    for (name, fieldtype) in fields:
+        layer.CreateField(ogr.FieldDefn(name, fieldtype))
+    return (dataSource, layer)
+
+
+def addFeature(layer, geometry, values):
+    from osgeo import ogr
+    feature = ogr.Feature(layer.GetLayerDefn())
+    for (name, value) in values.items():
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        feature.SetField(name, value)
+    feature.SetGeometry(geometry)
+    layer.CreateFeature(feature)
+
+
+def makeRoads(filename, format, size, vertices):
+    # A square grid of streets, each street segment going from one junction
+    # to the next through a few jittered vertices. Returns the feature and
+    # vertex counts.
+    from osgeo import ogr
+    (dataSource, layer) = createLayer(filename, format, "roads", ogr.wkbLineString,
+                                      [("name", ogr.OFTString), ("highway", ogr.OFTString),
+                                       ("oneway", ogr.OFTString), ("lanes", ogr.OFTInteger),
+                                       ("maxspeed", ogr.OFTReal)])
+    side = int(math.ceil(math.sqrt(size / 2.0))) + 1
+    (x0, y0) = ORIGIN
+    count = 0
+    vertexcount = 0
+    layer.StartTransaction()
+    for (i, j, di, dj) in ((i, j, di, dj) for i in range(side) for j in range(side)
+                           for (di, dj) in ((1, 0), (0, 1))):
+        if count == size:
+            break
+        if i + di >= side or j + dj >= side:
+            continue
+        line = ogr.Geometry(ogr.wkbLineString)
+        line.AddPoint_2D(x0 + i * SPACING, y0 + j * SPACING)
+        steps = random.randint(1, 2 * vertices)
+        for k in range(1, steps):
+            line.AddPoint_2D(x0 + (i + di * k / float(steps)) * SPACING + random.uniform(-5, 5),
+                             y0 + (j + dj * k / float(steps)) * SPACING + random.uniform(-5, 5))
+        line.AddPoint_2D(x0 + (i + di) * SPACING, y0 + (j + dj) * SPACING)
+        vertexcount += line.GetPointCount()
+        addFeature(layer, line, {
+            'name': random.choice(NAMES),
+            'highway': random.choice(['primary', 'secondary', 'residential']),
+            'oneway': random.choice(['yes', 'no']),
+            'lanes': random.randint(1, 4),
+            'maxspeed': random.choice([30.0, 50.0, 80.0]),
+        })
+        count += 1
+    layer.CommitTransaction()
+    dataSource = None
+    return (count, vertexcount)
+
+
+def makeBuildings(filename, format, size, vertices):
+    # Rectangles on a grid, every twentieth with a courtyard. Returns the
+    # feature and vertex counts.
+    from osgeo import ogr
+    (dataSource, layer) = createLayer(filename, format, "buildings", ogr.wkbPolygon,
+                                      [("name", ogr.OFTString), ("building", ogr.OFTString),
+                                       ("levels", ogr.OFTInteger), ("height", ogr.OFTReal)])
+    side = int(math.ceil(math.sqrt(size)))
+    (x0, y0) = ORIGIN
+    vertexcount = 0
+    layer.StartTransaction()
+    for n in range(size):
+        (i, j) = divmod(n, side)
+        (x, y) = (x0 + i * SPACING / 2, y0 + j * SPACING / 2)
+        (w, h) = (random.uniform(10, 40), random.uniform(10, 40))
+        polygon = ogr.Geometry(ogr.wkbPolygon)
+        rings = [(x, y, w, h)]
+        if n % 20 == 0:
+            rings.append((x + w / 4, y + h / 4, w / 2, h / 2))
+        for (rx, ry, rw, rh) in rings:
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            for (px, py) in ((rx, ry), (rx + rw, ry), (rx + rw, ry + rh), (rx, ry + rh), (rx, ry)):
+                ring.AddPoint_2D(px, py)
+            polygon.AddGeometry(ring)
+            vertexcount += ring.GetPointCount()
+        addFeature(layer, polygon, {
+            'name': random.choice(NAMES),
+            'building': random.choice(['yes', 'residential', 'commercial']),
+            'levels': random.randint(1, 30),
+            'height': random.uniform(3, 90),
+        })
+    layer.CommitTransaction()
+    dataSource = None
+    return (size, vertexcount)
+
+
+def prepareDataset(datadir, layer, size, format, vertices):
+    # Generates the dataset unless it is there already, and returns its
+    # description
+    filename = os.path.join(datadir, datasetName(layer, size, format))
+    metafile = filename + ".meta.json"
+    if os.path.exists(filename) and os.path.exists(metafile):
+        with open(metafile) as f:
+            return json.load(f)
+    random.seed(size)
+    make = makeRoads if layer == 'roads' else makeBuildings
+    (features, vertexcount) = make(filename, format, size, vertices)
+    (base, ext) = os.path.splitext(filename)
+    inputbytes = sum([os.path.getsize(base + e) for e in (ext, ".shx", ".dbf", ".prj")
+                      if os.path.exists(base + e)])
+    dataset = {'file': filename, 'layer': layer, 'format': format, 'size': size,
+               'features': features, 'vertices': vertexcount, 'input_bytes': inputbytes}
+    with open(metafile, "w") as f:
+        json.dump(dataset, f)
+    return dataset
+
+
+def peakRss(rusage):
+    # ru_maxrss is in kilobytes on Linux, in bytes on OS X
+    if sys.platform == "darwin":
+        return rusage.ru_maxrss / 1024.0 / 1024
+    return rusage.ru_maxrss / 1024.0
+
+
+def loadConverter(script, args):
+    # Runs the options parsing and the definitions of the script, everything
+    # before its main flow, with args as its command line
+    with open(script) as f:
+        source = f.read()
+    (definitions, marker, main) = source.partition(MAIN_FLOW)
+    if not marker:
+        raise ValueError("'%s' has no main flow marker" % script)
+    sys.argv = [script] + args
+    namespace = {'__name__': "ogr2osm", '__file__': script}
+    exec compile(definitions, script, "exec") in namespace
+    return namespace
+
+
+def readAll(converter, dataSource):
+    # What the parser asks OGR for, without doing anything with it
+    for i in range(dataSource.GetLayerCount()):
+        layer = dataSource.GetLayer(i)
+        layer.ResetReading()
+        fieldCount = len(converter['getLayerFields'](layer))
+        for ogrfeature in converter['readFeatures'](layer):
+            for j in range(fieldCount):
+                ogrfeature.GetFieldAsString(j)
+            ogrgeometry = ogrfeature.GetGeometryRef()
+            if ogrgeometry is not None:
+                ogrgeometry.ExportToWkb()
+
+
+def runPhases(script, datafile, outfile, resultfile, args):
+    # Runs in its own process, see measurePhases()
+    converter = loadConverter(script, [datafile, "-f", "-o", outfile] + args)
+    results = {}
+
+    start = time.time()
+    readAll(converter, converter['getFileData'](datafile))
+    results['read'] = time.time() - start
+
+    dataSource = converter['getFileData'](datafile)
+    start = time.time()
+    converter['parseData'](dataSource)
+    results['parse'] = time.time() - start
+    converter['translations'].preOutputTransform(converter['geometries'],
+                                                 converter['features'])
+
+    start = time.time()
+    converter['output']()
+    results['output'] = time.time() - start
+
+    if converter['idAllocator'] is not None:
+        converter['idAllocator'].close()
+
+    results['rss'] = peakRss(resource.getrusage(resource.RUSAGE_SELF))
+    with open(resultfile, "w") as f:
+        json.dump(results, f)
+
+
+def runChild(command):
+    # Runs a command, returning its wall time and peak RSS in MB
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        process = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+        (pid, status, rusage) = os.wait4(process.pid, 0)
+        elapsed = time.time() - start
+    if status != 0:
+        raise RuntimeError("'%s' failed with status %d" % (" ".join(command), status))
+    return (elapsed, peakRss(rusage))
+
+
+def measurePhases(script, dataset, outfile, args):
+    resultfile = outfile + ".phases.json"
+    runChild([sys.executable, os.path.abspath(__file__), "--phases", script,
+              dataset['file'], outfile, resultfile] + args)
+    with open(resultfile) as f:
+        results = json.load(f)
+    os.remove(resultfile)
+    return results
+
+
+def measureEndToEnd(script, dataset, outfile, args):
+    (elapsed, rss) = runChild([sys.executable, script, dataset['file'],
+                               "-f", "-o", outfile] + args)
+    return {'end-to-end': elapsed, 'rss': rss}
+
+
+def result(dataset, phase, seconds, rss, outputbytes=None):
+    entry = {'dataset': os.path.basename(dataset['file']), 'format': dataset['format'],
+             'layer': dataset['layer'], 'size': dataset['size'], 'phase': phase,
+             'features': dataset['features'], 'vertices': dataset['vertices'],
+             'seconds': round(seconds, 4), 'peak_rss_mb': round(rss, 1),
+             'features_per_s': round(dataset['features'] / seconds, 1) if seconds else None,
+             'vertices_per_s': round(dataset['vertices'] / seconds, 1) if seconds else None}
+    if outputbytes is not None:
+        entry['output_bytes'] = outputbytes
+        entry['mb_written_per_s'] = round(outputbytes / 1e6 / seconds, 2) if seconds else None
+    return entry
+
+
+def benchmark(script, dataset, outdir, args, repeat):
+    # Best of repeat runs for every phase and for the whole script
+    outfile = os.path.join(outdir, os.path.basename(dataset['file']) + ".osm")
+    best = {}
+    for i in range(repeat):
+        for measure in (measurePhases, measureEndToEnd):
+            times = measure(script, dataset, outfile, args)
+            rss = times.pop('rss')
+            for (phase, seconds) in times.items():
+                if phase not in best or seconds < best[phase][0]:
+                    best[phase] = (seconds, rss)
+    outputbytes = os.path.getsize(outfile) if os.path.exists(outfile) else None
+    entries = []
+    for phase in PHASES + ('end-to-end',):
+        (seconds, rss) = best[phase]
+        written = outputbytes if phase in ('output', 'end-to-end') else None
+        entries.append(result(dataset, phase, seconds, rss, written))
+    return entries
+
+
+def compare(results, baseline):
+    # Tells how each result compares to the same one in the baseline
+    previous = dict(((entry['dataset'], entry['phase']), entry)
+                    for entry in baseline['results'])
+    sys.stderr.write("%-26s %-11s %10s %10s %8s %10s\n" % (
+        "dataset", "phase", "seconds", "baseline", "speedup", "rss ratio"))
+    for entry in results['results']:
+        old = previous.get((entry['dataset'], entry['phase']))
+        if old is None or not entry['seconds']:
+            continue
+        sys.stderr.write("%-26s %-11s %10.3f %10.3f %7.2fx %9.2fx\n" % (
+            entry['dataset'], entry['phase'], entry['seconds'], old['seconds'],
+            old['seconds'] / entry['seconds'], entry['peak_rss_mb'] / old['peak_rss_mb']))
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT,
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--phases":
+        # Child process started by measurePhases()
+        runPhases(*(sys.argv[2:6] + [sys.argv[6:]]))
+        return
+
+    parser = OptionParser(usage="usage: %prog [-s SIZES] [--formats F,...] [--layers L,...] "
+                          "[-r REPEAT] [-d DATADIR] [-o RESULTS] [--baseline RESULTS] "
+                          "[-a CONVERTER_ARGS]")
+    parser.add_option("-s", "--sizes", dest="sizes", default="1000,10000,100000",
+                      help="Comma separated numbers of features per dataset")
+    parser.add_option("--formats", dest="formats", default=",".join(sorted(FORMATS)),
+                      help="Comma separated dataset formats, out of " +
+                           ", ".join(sorted(FORMATS)))
+    parser.add_option("--layers", dest="layers", default=",".join(LAYERS),
+                      help="Comma separated kinds of datasets, out of " + ", ".join(LAYERS))
+    parser.add_option("-v", "--vertices", dest="vertices", type="int", default=8,
+                      help="Average number of vertices per road")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=1)
+    parser.add_option("-d", "--data-dir", dest="dataDir",
+                      help="Where to keep the generated datasets, reused between runs")
+    parser.add_option("-o", "--output", dest="resultsFile",
+                      help="Write the results there instead of to stdout")
+    parser.add_option("--baseline", dest="baselineFile",
+                      help="Compare the results to those of an earlier run")
+    parser.add_option("-a", "--args", dest="converterArgs", default="",
+                      help="Extra arguments for ogr2osm.py, like '--compact'")
+    parser.add_option("--script", dest="script", default=os.path.join(ROOT, "ogr2osm.py"),
+                      help="The converter script, ogr2osm.py by default")
+    (options, args) = parser.parse_args()
+
+    formats = options.formats.split(",")
+    layers = options.layers.split(",")
+    for format in formats:
+        if format not in FORMATS:
+            parser.error("unknown format '%s'" % format)
+    for layer in layers:
+        if layer not in LAYERS:
+            parser.error("unknown dataset kind '%s'" % layer)
+    sizes = [int(size) for size in options.sizes.split(",")]
+    datadir = options.dataDir or os.path.join(tempfile.gettempdir(), "ogr2osm-bench")
+    if not os.path.isdir(datadir):
+        os.makedirs(datadir)
+    outdir = tempfile.mkdtemp(prefix="ogr2osm-bench-out")
+    script = os.path.abspath(options.script)
+    converterArgs = shlex.split(options.converterArgs)
+
+    from osgeo import gdal
+    results = {'revision': revision(), 'python': sys.version.split()[0],
+               'gdal': gdal.__version__, 'args': converterArgs, 'results': []}
+    for layer in layers:
+        for format in formats:
+            for size in sizes:
+                dataset = prepareDataset(datadir, layer, size, format, options.vertices)
+                entries = benchmark(script, dataset, outdir, converterArgs, options.repeat)
+                results['results'].extend(entries)
+                for entry in entries:
+                    sys.stderr.write("%-26s %-11s %8.3f s %10.0f features/s %7.1f MB\n" % (
+                        entry['dataset'], entry['phase'], entry['seconds'],
+                        entry['features_per_s'] or 0, entry['peak_rss_mb']))
+    for name in os.listdir(outdir):
+        os.remove(os.path.join(outdir, name))
+    os.rmdir(outdir)
+
+    if options.resultsFile:
+        with open(options.resultsFile, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    else:
+        print json.dumps(results, indent=1, sort_keys=True)
+    if options.baselineFile:
+        with open(options.baselineFile) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
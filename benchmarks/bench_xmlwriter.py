@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Benchmark the OSM XML writers
+
+Writes the same synthetic road network with osmwriter.SimpleXmlWriter (the
+SimpleXMLWriter based reference) and osmwriter.XmlWriter in us-ascii mode,
+checks that the output is byte-identical and prints the time each writer took.
+The default UTF-8 mode of XmlWriter is timed as well.
+
+usage: bench_xmlwriter.py [-n NODES] [-r REPEAT]
+"""
+
+import os
+import random
+import sys
+import time
+from optparse import OptionParser
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from osmwriter import XmlWriter, SimpleXmlWriter
+
+
+class Sink(object):
+    # Collects the output in memory, and keeps it when the writer closes it
+    def __init__(self):
+        self.buffer = StringIO()
+        self.write = self.buffer.write
+        self.value = None
+
+    def close(self):
+        self.value = self.buffer.getvalue()
+
+
+def makeElements(nodecount, seed=1):
+    random.seed(seed)
+    nodes = []
+    for i in range(nodecount):
+        tags = None
+        if i % 50 == 0:
+            tags = {'highway': 'traffic_signals'}
+        nodes.append((-(i + 1), random.uniform(73, 135), random.uniform(18, 53), tags))
+    ways = []
+    wayid = -(nodecount + 1)
+    i = 0
+    while i < nodecount - 1:
+        length = random.randint(2, 12)
+        refs = [-(j + 1) for j in range(i, min(i + length, nodecount))]
+        tags = {'highway': random.choice(['primary', 'secondary', 'residential']),
+                'oneway': random.choice(['yes', 'no']),
+                'name': random.choice(['Road %d & <Co>', '京藏高速 %d']) % -wayid,
+                'id': str(-wayid)}
+        ways.append((wayid, refs, tags))
+        wayid -= 1
+        i += length - 1
+    relations = [(wayid - 1, [('way', ways[0][0], 'outer'), ('way', ways[1][0], 'inner')],
+                  {'type': 'multipolygon'})]
+    return (nodes, ways, relations)
+
+
+def run(writerclass, elements):
+    (nodes, ways, relations) = elements
+    sink = Sink()
+    start = time.time()
+    w = writerclass(sink)
+    for (id, x, y, tags) in nodes:
+        w.node(id, x, y, tags)
+    for (id, refs, tags) in ways:
+        w.way(id, refs, tags)
+    for (id, members, tags) in relations:
+        w.relation(id, members, tags)
+    w.close()
+    return (time.time() - start, sink.value)
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [-n NODES] [-r REPEAT]")
+    parser.add_option("-n", "--nodes", dest="nodes", type="int", default=200000)
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3)
+    (options, args) = parser.parse_args()
+
+    elements = makeElements(options.nodes)
+    writers = [('SimpleXmlWriter', SimpleXmlWriter),
+               ('XmlWriter us-ascii', lambda f: XmlWriter(f, encoding="us-ascii")),
+               ('XmlWriter utf-8', XmlWriter)]
+    results = {}
+    for (name, writerclass) in writers:
+        times = []
+        for i in range(options.repeat):
+            (elapsed, output) = run(writerclass, elements)
+            times.append(elapsed)
+        results[name] = (min(times), output)
+
+    (simpletime, simpleoutput) = results['SimpleXmlWriter']
+    if simpleoutput != results['XmlWriter us-ascii'][1]:
+        print "ERROR: output differs"
+        sys.exit(1)
+    print "us-ascii output identical"
+    for (name, writerclass) in writers:
+        (elapsed, output) = results[name]
+        megabytes = len(output) / 1048576.0
+        print "%-20s %.3f s, %.1f MB (%.1f MB/s), %.1fx" % (
+            name + ":", elapsed, megabytes, megabytes / elapsed, simpletime / elapsed)
+
+
+if __name__ == "__main__":
+    main()
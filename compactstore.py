@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+""" Compact node and way storage for ogr2osm
+
+With --compact, nodes are not Point objects any more. Their ids, coordinates
+and reference counts live in typed arrays in a NodeTable, and every way keeps
+its node references as a range of a single shared array of row numbers.
+
+Code that works on the objects (translation hooks, output) sees thin views:
+NodeView has the id, x, y (and z) attributes and the addparent()/removeparent()
+methods of a Point, and WayNodes behaves like the list in Way.points. Views are
+created on access and are not kept around, so a vertex costs a few array slots
+plus its entry in the location index instead of a Python object.
+
+Parents are tracked as a count of references instead of a set. A node is live
+while its count is above zero; output only sees live nodes.
+"""
+
+from array import array
+
+
+class NodeView(object):
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __eq__(self, other):
+        return (isinstance(other, NodeView) and self.row == other.row and
+                self.table is other.table)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.row)
+
+    def getid(self):
+        return self.table.ids[self.row]
+
+    def setid(self, value):
+        self.table.ids[self.row] = value
+
+    def getx(self):
+        return self.table.xs[self.row]
+
+    def setx(self, value):
+        self.table.xs[self.row] = value
+
+    def gety(self):
+        return self.table.ys[self.row]
+
+    def sety(self, value):
+        self.table.ys[self.row] = value
+
+    def getz(self):
+        return self.table.zs[self.row]
+
+    id = property(getid, setid)
+    x = property(getx, setx)
+    y = property(gety, sety)
+    z = property(getz)
+
+    def replacejwithi(self, i, j):
+        pass
+
+    def addparent(self, parent):
+        self.table.refs[self.row] += 1
+
+    def removeparent(self, parent, shoulddestroy=True):
+        # A way adds itself as a parent once per vertex, so drop all of them
+        try:
+            count = max(1, parent.points.count(self))
+        except AttributeError:
+            count = 1
+        refs = self.table.refs
+        refs[self.row] = max(0, refs[self.row] - count)
+        if shoulddestroy and refs[self.row] == 0:
+            self.table.discard(self)
+
+
+class NodeTable(object):
+    def __init__(self, newid, withz=False):
+        self.newid = newid
+        self.ids = array('l')
+        self.xs = array('d')
+        self.ys = array('d')
+        self.zs = array('b') if withz else None
+        self.refs = array('i')
+        self.waynodes = array('l')
+        self.index = {}
+
+    def getpoint(self, x, y, z=None):
+        # Return the node at this location, creating it if needed
+        key = (x, y) if z is None else (x, y, z)
+        try:
+            return NodeView(self, self.index[key])
+        except KeyError:
+            row = len(self.ids)
+            self.ids.append(self.newid())
+            self.xs.append(x)
+            self.ys.append(y)
+            if self.zs is not None:
+                self.zs.append(z)
+            self.refs.append(0)
+            self.index[key] = row
+            return NodeView(self, row)
+
+    def newway(self):
+        return WayNodes(self)
+
+    # ElementStore partition interface
+
+    def __iter__(self):
+        refs = self.refs
+        for row in xrange(len(refs)):
+            if refs[row] > 0:
+                yield NodeView(self, row)
+
+    def __len__(self):
+        return sum(1 for count in self.refs if count > 0)
+
+    def __contains__(self, view):
+        return view.table is self and self.refs[view.row] > 0
+
+    def add(self, view):
+        pass
+
+    def discard(self, view):
+        if view.table is not self:
+            return False
+        row = view.row
+        self.refs[row] = 0
+        if self.zs is None:
+            key = (self.xs[row], self.ys[row])
+        else:
+            key = (self.xs[row], self.ys[row], self.zs[row])
+        if self.index.get(key) == row:
+            del self.index[key]
+        return True
+
+    def tidy(self):
+        pass
+
+
+class WayNodes(object):
+    # The nodes of one way, stored as a range of NodeTable.waynodes
+    __slots__ = ('table', 'start', 'end')
+
+    def __init__(self, table):
+        self.table = table
+        self.start = self.end = len(table.waynodes)
+
+    def rows(self):
+        return self.table.waynodes[self.start:self.end]
+
+    def append(self, view):
+        waynodes = self.table.waynodes
+        if self.end != len(waynodes):
+            # Another way was built since, so move this one to the end first
+            rows = self.rows()
+            self.start = len(waynodes)
+            waynodes.extend(rows)
+            self.end = len(waynodes)
+        waynodes.append(view.row)
+        self.end += 1
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        table = self.table
+        for row in self.rows():
+            yield NodeView(table, row)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("way node index out of range")
+        return NodeView(self.table, self.table.waynodes[self.start + i])
+
+    def __contains__(self, view):
+        return view.table is self.table and view.row in self.rows()
+
+    def count(self, view):
+        if view.table is not self.table:
+            return 0
+        return self.rows().count(view.row)
+
+    def reverse(self):
+        rows = self.rows()
+        rows.reverse()
+        self.table.waynodes[self.start:self.end] = rows
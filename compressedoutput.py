@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+""" Compressed output files for ogr2osm
+
+openOutput() opens the output file and, if its name ends in .gz, .bz2 or
+.zst, returns a file-like object that compresses everything written to it on
+the fly, so the uncompressed file never touches the disk.
+
+With threads > 1 the data is cut into independent blocks that are compressed
+on a thread pool (zlib and bz2 release the GIL) and written out in order as
+concatenated gzip members or bzip2 streams, like pigz and pbzip2 do. zstd uses
+the compressor's own worker threads instead.
+
+zstd output needs the zstandard module.
+"""
+
+import bz2
+import os
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+COMPRESSIONS = {'.gz': 'gzip', '.bz2': 'bzip2', '.zst': 'zstd'}
+BLOCKSIZE = 4 << 20
+
+
+def compressionFromFilename(filename):
+    (root, ext) = os.path.splitext(filename)
+    return COMPRESSIONS.get(ext)
+
+
+def stripCompression(filename):
+    # Name of the file once decompressed, e.g. foo.osm for foo.osm.gz
+    (root, ext) = os.path.splitext(filename)
+    if ext in COMPRESSIONS:
+        return root
+    return filename
+
+
+def gzipBlock(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def bzip2Block(data):
+    return bz2.compress(data, 9)
+
+
+def openOutput(filename, threads=1):
+    compression = compressionFromFilename(filename)
+    fileobj = open(filename, 'wb')
+    if compression == 'gzip':
+        if threads > 1:
+            return ParallelCompressedFile(fileobj, gzipBlock, threads)
+        # wbits 31 makes zlib write a gzip header and trailer
+        return CompressedFile(fileobj, zlib.compressobj(6, zlib.DEFLATED, 31))
+    elif compression == 'bzip2':
+        if threads > 1:
+            return ParallelCompressedFile(fileobj, bzip2Block, threads)
+        return CompressedFile(fileobj, bz2.BZ2Compressor(9))
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            fileobj.close()
+            raise ImportError("writing .zst files needs the zstandard module")
+        if threads > 1:
+            compressor = zstandard.ZstdCompressor(threads=threads)
+        else:
+            compressor = zstandard.ZstdCompressor()
+        return CompressedFile(fileobj, compressor.compressobj())
+    return fileobj
+
+
+class CompressedFile(object):
+    # Streams everything through a single compressor object
+    def __init__(self, fileobj, compressor):
+        self.file = fileobj
+        self.compressor = compressor
+
+    def write(self, data):
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.file.write(compressed)
+
+    def close(self):
+        self.file.write(self.compressor.flush())
+        self.file.close()
+
+
+class ParallelCompressedFile(object):
+    # Compresses independent blocks on a thread pool, writing them in order
+    def __init__(self, fileobj, compress, threads, blocksize=BLOCKSIZE):
+        self.file = fileobj
+        self.compress = compress
+        self.blocksize = blocksize
+        self.pool = ThreadPool(threads)
+        self.maxpending = threads * 2
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.blocksize:
+            self.submit()
+
+    def submit(self):
+        block = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.pool.apply_async(self.compress, (block,)))
+        # Bound the memory held by blocks waiting to be written
+        while len(self.pending) > self.maxpending:
+            self.file.write(self.pending.popleft().get())
+
+    def close(self):
+        if self.buffer:
+            self.submit()
+        while self.pending:
+            self.file.write(self.pending.popleft().get())
+        self.pool.close()
+        self.pool.join()
+        self.file.close()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+""" Element registry for ogr2osm
+
+ElementStore replaces the plain lists that used to hold every geometry and
+feature. It keeps the list-like interface the translation hooks rely on
+(append, remove, iteration, len, in) but adds and removes elements in constant
+time, keeps every element type in its own partition so that output can walk
+nodes, ways and relations separately, and offers mark()/sweep() for removing
+many elements at once.
+
+Elements are kept in insertion order. Removing an element leaves a hole in its
+partition; holes are compacted once they outnumber the live elements, so
+removal stays O(1) amortised.
+
+A type can also be given a custom partition with attach(), e.g. the NodeTable
+from compactstore. A partition needs add(), discard(), tidy(), __iter__,
+__len__ and __contains__.
+"""
+
+
+class _Partition(object):
+    # Insertion ordered set of the elements of one type
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+        self.holes = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, element):
+        return element in self.positions
+
+    def __iter__(self):
+        # Compaction replaces self.items rather than modifying it, so holding
+        # on to the current list keeps running iterators valid
+        for element in self.items:
+            if element is not None and element in self.positions:
+                yield element
+
+    def add(self, element):
+        if element in self.positions:
+            return
+        self.positions[element] = len(self.items)
+        self.items.append(element)
+
+    def discard(self, element):
+        try:
+            i = self.positions.pop(element)
+        except KeyError:
+            return False
+        self.items[i] = None
+        self.holes += 1
+        return True
+
+    def tidy(self):
+        # Compact once holes outnumber live elements
+        if self.holes > len(self.positions) and self.holes > 1024:
+            self.items = [element for element in self.items if element is not None]
+            self.positions = dict((element, i) for (i, element) in enumerate(self.items))
+            self.holes = 0
+
+
+class ElementStore(object):
+    def __init__(self):
+        self.partitions = {}
+        self.order = []
+        self.marked = []
+
+    def partition(self, cls):
+        try:
+            return self.partitions[cls]
+        except KeyError:
+            return self.attach(cls, _Partition())
+
+    def attach(self, cls, partition):
+        # Use a custom partition for elements of type cls
+        if cls not in self.partitions:
+            self.order.append(cls)
+        self.partitions[cls] = partition
+        return partition
+
+    def append(self, element):
+        self.partition(type(element)).add(element)
+
+    add = append
+
+    def remove(self, element):
+        # Behaves like list.remove(), so existing hooks catching ValueError
+        # keep working
+        if not self.discard(element):
+            raise ValueError("ElementStore.remove(x): x not in store")
+
+    def discard(self, element):
+        partition = self.partitions.get(type(element))
+        if partition is None or not partition.discard(element):
+            return False
+        partition.tidy()
+        return True
+
+    def __contains__(self, element):
+        partition = self.partitions.get(type(element))
+        return partition is not None and element in partition
+
+    def __len__(self):
+        return sum(len(partition) for partition in self.partitions.values())
+
+    def __iter__(self):
+        for cls in list(self.order):
+            for element in self.partitions[cls]:
+                yield element
+
+    def oftype(self, cls):
+        # Iterate over the elements whose type is exactly cls
+        partition = self.partitions.get(cls)
+        if partition is None:
+            return iter(())
+        return iter(partition)
+
+    def count(self, cls):
+        partition = self.partitions.get(cls)
+        if partition is None:
+            return 0
+        return len(partition)
+
+    def mark(self, element):
+        # Schedule an element for removal by the next sweep()
+        self.marked.append(element)
+
+    def sweep(self):
+        # Remove every marked element in one go and return them
+        marked = self.marked
+        self.marked = []
+        removed = []
+        touched = set()
+        for element in marked:
+            partition = self.partitions.get(type(element))
+            if partition is not None and partition.discard(element):
+                touched.add(partition)
+                removed.append(element)
+        for partition in touched:
+            partition.tidy()
+        return removed
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+""" Translation hook profiling for ogr2osm
+
+With --profile-hooks, HookProfiler wraps every hook the translation defines
+and records how often it is called, the time spent in it, and how many of the
+layers, features or tags it was given it dropped or modified:
+
+  filterLayer         dropped: returned None, modified: returned another layer
+  filterFeature       dropped: returned None, modified: returned another
+                      feature (changes made in place are not seen)
+  filterTags          dropped: returned no tags for a feature that had some,
+                      modified: returned different tags
+  filterFeaturePost   modified: changed the tags of the feature
+  preOutputTransform  dropped: features removed
+
+Latency percentiles come from a reservoir sample of the calls of each hook,
+so the memory used does not grow with the number of features. The summary
+gives the share of the run spent in each hook, which is the share the
+translation costs over ogr2osm itself.
+
+The default hooks are not wrapped, and nothing is wrapped without the option.
+"""
+
+import random
+import time
+
+# Hooks in the order they run
+HOOKS = ("filterLayer", "filterFeature", "filterTags", "filterFeaturePost",
+         "preOutputTransform")
+
+# Latencies kept per hook for the percentiles
+RESERVOIR = 2000
+
+
+class HookStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.dropped = 0
+        self.modified = 0
+        self.longest = 0.0
+        self.samples = []
+
+    def add(self, seconds):
+        self.calls += 1
+        self.seconds += seconds
+        if seconds > self.longest:
+            self.longest = seconds
+        if len(self.samples) < RESERVOIR:
+            self.samples.append(seconds)
+        else:
+            i = random.randint(0, self.calls - 1)
+            if i < RESERVOIR:
+                self.samples[i] = seconds
+
+    def export(self):
+        return (self.calls, self.seconds, self.dropped, self.modified, self.longest,
+                self.samples)
+
+    def merge(self, exported):
+        (calls, seconds, dropped, modified, longest, samples) = exported
+        # The combined sample takes from each side in proportion to its calls
+        total = self.calls + calls
+        if total > 0 and len(self.samples) + len(samples) > RESERVOIR:
+            ours = int(round(RESERVOIR * self.calls / float(total)))
+            ours = min(ours, len(self.samples))
+            theirs = min(RESERVOIR - ours, len(samples))
+            self.samples = (random.sample(self.samples, ours) +
+                            random.sample(samples, theirs))
+        else:
+            self.samples = self.samples + list(samples)
+        self.calls = total
+        self.seconds += seconds
+        self.dropped += dropped
+        self.modified += modified
+        self.longest = max(self.longest, longest)
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(p / 100.0 * len(samples)))]
+
+
+class HookProfiler(object):
+    def __init__(self):
+        self.start = time.time()
+        self.hooks = []
+
+    def wrap(self, translations, names):
+        # Replace the hooks named in names by profiled ones
+        for name in HOOKS:
+            if name in names:
+                hook = HookStats(name)
+                self.hooks.append(hook)
+                wrapper = getattr(self, name)
+                setattr(translations, name, wrapper(getattr(translations, name), hook))
+
+    def filterLayer(self, function, hook):
+        def profiled(layer):
+            start = time.time()
+            result = function(layer)
+            hook.add(time.time() - start)
+            if result is None:
+                hook.dropped += layer is not None
+            elif result is not layer:
+                hook.modified += 1
+            return result
+        return profiled
+
+    def filterFeature(self, function, hook):
+        def profiled(ogrfeature, fieldNames, reproject):
+            start = time.time()
+            result = function(ogrfeature, fieldNames, reproject)
+            hook.add(time.time() - start)
+            if result is None:
+                hook.dropped += ogrfeature is not None
+            elif result is not ogrfeature:
+                hook.modified += 1
+            return result
+        return profiled
+
+    def filterTags(self, function, hook):
+        def profiled(tags):
+            # The hook may change the dictionary it is given
+            before = dict(tags) if tags is not None else None
+            start = time.time()
+            result = function(tags)
+            hook.add(time.time() - start)
+            if not result:
+                hook.dropped += bool(before)
+            elif result != before:
+                hook.modified += 1
+            return result
+        return profiled
+
+    def filterFeaturePost(self, function, hook):
+        def profiled(feature, ogrfeature, ogrgeometry):
+            before = dict(feature.tags) if feature is not None and feature.tags else None
+            start = time.time()
+            result = function(feature, ogrfeature, ogrgeometry)
+            hook.add(time.time() - start)
+            if feature is not None and (feature.tags or None) != before:
+                hook.modified += 1
+            return result
+        return profiled
+
+    def preOutputTransform(self, function, hook):
+        def profiled(geometries, features):
+            before = len(features) if features is not None else 0
+            start = time.time()
+            result = function(geometries, features)
+            hook.add(time.time() - start)
+            if features is not None:
+                hook.dropped += max(0, before - len(features))
+            return result
+        return profiled
+
+    def reset(self):
+        # Forget the calls made so far, in a worker process forked with the
+        # counts of its parent
+        for hook in self.hooks:
+            hook.__init__(hook.name)
+
+    def export(self):
+        return [(hook.name, hook.export()) for hook in self.hooks]
+
+    def merge(self, exported):
+        # Adds the calls made in a worker process
+        hooks = dict((hook.name, hook) for hook in self.hooks)
+        for (name, stats) in exported:
+            hooks[name].merge(stats)
+
+    def report(self):
+        return [{'hook': hook.name, 'calls': hook.calls,
+                 'seconds': round(hook.seconds, 4),
+                 'p50_ms': round(hook.percentile(50) * 1000, 4),
+                 'p90_ms': round(hook.percentile(90) * 1000, 4),
+                 'p99_ms': round(hook.percentile(99) * 1000, 4),
+                 'max_ms': round(hook.longest * 1000, 4),
+                 'dropped': hook.dropped, 'modified': hook.modified}
+                for hook in self.hooks]
+
+    def summary(self):
+        # Lines of a table of the hooks, for the log
+        elapsed = time.time() - self.start
+        lines = ["%-19s %9s %9s %6s %9s %9s %9s %9s %9s" % (
+            "hook", "calls", "total s", "run %", "mean ms", "p50 ms", "p99 ms",
+            "dropped", "modified")]
+        for hook in self.hooks:
+            mean = hook.seconds / hook.calls if hook.calls else 0.0
+            lines.append("%-19s %9d %9.3f %6.1f %9.4f %9.4f %9.4f %9d %9d" % (
+                hook.name, hook.calls, hook.seconds,
+                100.0 * hook.seconds / elapsed if elapsed else 0.0, mean * 1000,
+                hook.percentile(50) * 1000, hook.percentile(99) * 1000,
+                hook.dropped, hook.modified))
+        return lines
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+""" State of incremental conversions for ogr2osm2
+
+With --state the ids given to every road and node are kept in a sqlite
+database, together with a fingerprint of the source data of each road. The
+next run compares the roads against it, only parses the ones that are new or
+changed, and writes the differences as an osmChange file. Roads and nodes keep
+their ids from run to run, so the changes apply on top of the previous output.
+
+Nodes are identified by location and z-level, and count the roads that use
+them. A node is deleted once no road uses it any more.
+
+The run is only committed to the database by close(), once its changes are
+written; abort() forgets them, so that the next run diffs against the last
+output that was written.
+"""
+
+import hashlib
+import os
+import sqlite3
+
+SCHEMA = """
+create table if not exists roads (key text primary key, hash text,
+                                  way integer, nodes text);
+create table if not exists nodes (id integer primary key, x real, y real,
+                                  z integer, refs integer);
+create unique index if not exists nodes_location on nodes (x, y, z);
+create table if not exists meta (key text primary key, value integer);
+"""
+
+# sqlite allows 999 parameters per statement
+CHUNKSIZE = 500
+
+
+def fingerprint(values):
+    # Hash of a list of strings, e.g. the fields and geometry of a road
+    h = hashlib.sha1()
+    for value in values:
+        if type(value) is unicode:
+            value = value.encode("utf-8")
+        h.update(value)
+        h.update('\x00')
+    return h.hexdigest()
+
+
+def previousRun(filename):
+    # Number of the last run recorded in a state database, 0 if none
+    if not os.path.exists(filename):
+        return 0
+    conn = sqlite3.connect(filename)
+    try:
+        row = conn.execute("select value from meta where key = 'run'").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    conn.close()
+    if row is None:
+        return 0
+    return row[0]
+
+
+class ChangeSet(object):
+    def __init__(self):
+        self.createdNodes = []      # (id, x, y)
+        self.createdWays = []       # (id, refs, tags)
+        self.modifiedWays = []      # (id, refs, tags)
+        self.deletedWays = []       # ids
+        self.deletedNodes = []      # ids
+
+
+class ConversionState(object):
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        self.conn.text_factory = str
+        self.conn.executescript(SCHEMA)
+        self.conn.execute("create temp table seen (key text primary key)")
+        self.conn.execute("create temp table wanted (x real, y real, z integer)")
+        self.run = self.getmeta("run", 0) + 1
+        # Last id handed out, ids count down from -1
+        self.lastid = self.getmeta("lastid", 0)
+
+    def getmeta(self, key, default):
+        row = self.conn.execute("select value from meta where key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def newid(self):
+        self.lastid -= 1
+        return self.lastid
+
+    def setmeta(self, key, value):
+        self.conn.execute("insert or replace into meta (key, value) values (?, ?)",
+                          (key, value))
+
+    def hashes(self, keys):
+        # Fingerprints from the previous run for these road keys
+        hashes = {}
+        keys = list(set(keys))
+        for i in range(0, len(keys), CHUNKSIZE):
+            chunk = keys[i:i + CHUNKSIZE]
+            query = ("select key, hash from roads where key in (" +
+                     ", ".join(["?"] * len(chunk)) + ")")
+            hashes.update(self.conn.execute(query, chunk))
+        return hashes
+
+    def markseen(self, keys):
+        # Roads not marked as seen by the end of the run are deleted
+        self.conn.executemany("insert or ignore into seen (key) values (?)",
+                              [(key,) for key in keys])
+
+    def nodeids(self, locations):
+        # Ids of the nodes already at these (x, y, z) locations, looked up
+        # with a single join rather than a query per location
+        self.conn.execute("delete from wanted")
+        self.conn.executemany("insert into wanted (x, y, z) values (?, ?, ?)", locations)
+        rows = self.conn.execute("select wanted.x, wanted.y, wanted.z, nodes.id " +
+                                 "from wanted join nodes on nodes.x = wanted.x and " +
+                                 "nodes.y = wanted.y and nodes.z = wanted.z")
+        return dict(((x, y, z), id) for (x, y, z, id) in rows)
+
+    def update(self, roads):
+        # roads are the new and changed roads as (key, hash, tags, locations)
+        # tuples, locations being the (x, y, z) of the vertices of the way.
+        # Records them and returns the resulting ChangeSet.
+        changes = ChangeSet()
+        refs = {}
+        cur = self.conn.cursor()
+
+        deleted = cur.execute("select key, way, nodes from roads where key not in " +
+                              "(select key from seen)").fetchall()
+        for (key, way, nodes) in deleted:
+            for id in set(map(int, nodes.split())):
+                refs[id] = refs.get(id, 0) - 1
+            changes.deletedWays.append(way)
+        cur.execute("delete from roads where key not in (select key from seen)")
+
+        nodeids = self.nodeids(set(location for (key, hash, tags, locations) in roads
+                                   for location in locations))
+        newnodes = []
+        for (key, hash, tags, locations) in roads:
+            row = cur.execute("select way, nodes from roads where key = ?", (key,)).fetchone()
+            if row is None:
+                way = self.newid()
+            else:
+                (way, nodes) = row
+                for id in set(map(int, nodes.split())):
+                    refs[id] = refs.get(id, 0) - 1
+            nodes = []
+            for location in locations:
+                id = nodeids.get(location)
+                if id is None:
+                    id = self.newid()
+                    nodeids[location] = id
+                    (x, y, z) = location
+                    newnodes.append((id, x, y, z))
+                    changes.createdNodes.append((id, x, y))
+                nodes.append(id)
+            for id in set(nodes):
+                refs[id] = refs.get(id, 0) + 1
+            cur.execute("insert or replace into roads (key, hash, way, nodes) values (?, ?, ?, ?)",
+                        (key, hash, way, " ".join(map(str, nodes))))
+            if row is None:
+                changes.createdWays.append((way, nodes, tags))
+            else:
+                changes.modifiedWays.append((way, nodes, tags))
+        cur.executemany("insert into nodes (id, x, y, z, refs) values (?, ?, ?, ?, 0)",
+                        newnodes)
+
+        for (id, change) in refs.items():
+            if change != 0:
+                cur.execute("update nodes set refs = refs + ? where id = ?", (change, id))
+        unused = [id for (id, change) in refs.items() if change < 0]
+        for i in range(0, len(unused), CHUNKSIZE):
+            chunk = unused[i:i + CHUNKSIZE]
+            query = ("select id from nodes where refs <= 0 and id in (" +
+                     ", ".join(["?"] * len(chunk)) + ")")
+            changes.deletedNodes.extend([row[0] for row in cur.execute(query, chunk)])
+            cur.execute(query.replace("select id", "delete"), chunk)
+        cur.close()
+        return changes
+
+    def close(self):
+        # Commits the run, once its changes are written
+        self.setmeta("run", self.run)
+        self.setmeta("lastid", self.lastid)
+        self.conn.commit()
+        self.conn.close()
+
+    def abort(self):
+        # Forgets the run, when its changes could not be written
+        self.conn.rollback()
+        self.conn.close()
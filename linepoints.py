@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+""" Bulk vertex extraction for ogr2osm
+
+Reading a linestring with one GetPoint(i) call per vertex goes through SWIG
+and builds a 3-tuple for every vertex, in the innermost loop of the parser.
+linePoints() gets all the (x, y) vertices of a linestring or ring at once:
+
+  - with GetPoints(), a single call, where the bindings have it
+  - otherwise by decoding the WKB of the geometry into an array of doubles
+  - with GetPoint_2D(i) for the rest, like rings that cannot be exported
+    to WKB on their own
+
+benchmarks/bench_linepoints.py compares the three.
+"""
+
+import struct
+import sys
+from array import array
+
+NATIVE_ORDER = 1 if sys.byteorder == "little" else 0
+
+
+def linePoints(ogrgeometry):
+    if hasattr(ogrgeometry, "GetPoints"):
+        return getPoints(ogrgeometry)
+    points = wkbPoints(ogrgeometry)
+    if points is None:
+        points = pointByPoint(ogrgeometry)
+    return points
+
+
+def getPoints(ogrgeometry):
+    points = ogrgeometry.GetPoints()
+    if not points:
+        return []
+    if len(points[0]) > 2:
+        return [(point[0], point[1]) for point in points]
+    return points
+
+
+def pointByPoint(ogrgeometry):
+    return [ogrgeometry.GetPoint_2D(i) for i in range(ogrgeometry.GetPointCount())]
+
+
+def wkbPoints(ogrgeometry):
+    # None if the geometry cannot be read as a WKB linestring
+    try:
+        wkb = ogrgeometry.ExportToWkb()
+    except Exception:
+        return None
+    return decodeLineString(wkb)
+
+
+def decodeLineString(wkb):
+    # Vertices of a WKB (or ISO WKB, 25D, Z or M) linestring, None for any
+    # other geometry type
+    if len(wkb) < 9:
+        return None
+    byteorder = ord(wkb[0])
+    (geometrytype, count) = struct.unpack("<II" if byteorder == 1 else ">II", wkb[1:9])
+    dimensions = 2
+    if geometrytype & 0x80000000:
+        # 2.5D flag used by OGR
+        geometrytype &= 0xffff
+        dimensions = 3
+    elif 1000 < geometrytype < 4000:
+        # ISO: 1000 for Z, 2000 for M, 3000 for ZM
+        dimensions = 2 + [0, 1, 1, 2][geometrytype // 1000]
+        geometrytype %= 1000
+    if geometrytype != 2:
+        return None
+    coordinates = array("d")
+    coordinates.fromstring(wkb[9:9 + 8 * dimensions * count])
+    if byteorder != NATIVE_ORDER:
+        coordinates.byteswap()
+    return zip(coordinates[0::dimensions], coordinates[1::dimensions])
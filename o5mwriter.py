@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+""" o5m writer for ogr2osm
+
+Writes the o5m format (http://wiki.openstreetmap.org/wiki/O5m) read by
+osmconvert, osmfilter and osmium.
+
+Ids, coordinates and references are delta coded. Key/value pairs, and the
+type/role strings of relation members, are written once and then referred to
+through the o5m string table. A reset is written before ways and before
+relations, so every section starts with fresh deltas and an empty table.
+"""
+
+from pbfwriter import writevarint, zigzag, tobytes
+
+STRINGTABLE_SIZE = 15000
+STRING_MAXLENGTH = 250
+MEMBER_TYPES = {'node': '0', 'way': '1', 'relation': '2'}
+FLUSH_SIZE = 1 << 20
+
+
+class O5mWriter(object):
+    def __init__(self, fileobj):
+        self.file = fileobj
+        self.out = bytearray('\xff\xe0\x04o5m2')
+        self.kind = None
+        self.reset()
+
+    def reset(self):
+        self.lastid = 0
+        self.lastx = 0
+        self.lasty = 0
+        self.lastrefs = {'node': 0, 'way': 0, 'relation': 0}
+        self.strings = {}
+        self.stringcount = 0
+
+    def start(self, kind):
+        if kind != self.kind:
+            if self.kind is not None:
+                self.out.append(0xff)
+                self.reset()
+            self.kind = kind
+
+    def writestring(self, out, s, length):
+        # s is the string or pair, with pairs joined by a zero byte
+        serial = self.strings.get(s)
+        if serial is not None and self.stringcount - serial <= STRINGTABLE_SIZE:
+            writevarint(out, self.stringcount - serial)
+            return
+        out.append(0)
+        out.extend(s)
+        out.append(0)
+        if length <= STRING_MAXLENGTH:
+            self.strings[s] = self.stringcount
+            self.stringcount += 1
+
+    def tags(self, out, tags):
+        if tags:
+            for (key, value) in tags.items():
+                key = tobytes(key)
+                value = tobytes(value)
+                self.writestring(out, key + '\x00' + value, len(key) + len(value))
+
+    def dataset(self, datasettype, body):
+        out = self.out
+        out.append(datasettype)
+        writevarint(out, len(body))
+        out.extend(body)
+        if len(out) > FLUSH_SIZE:
+            self.file.write(bytes(out))
+            self.out = bytearray()
+
+    def writeid(self, out, id):
+        writevarint(out, zigzag(id - self.lastid))
+        self.lastid = id
+        # no version and author information
+        out.append(0)
+
+    def node(self, id, x, y, tags):
+        self.start('node')
+        body = bytearray()
+        self.writeid(body, id)
+        x = int(round(x * 10000000))
+        y = int(round(y * 10000000))
+        writevarint(body, zigzag(x - self.lastx))
+        writevarint(body, zigzag(y - self.lasty))
+        (self.lastx, self.lasty) = (x, y)
+        self.tags(body, tags)
+        self.dataset(0x10, body)
+
+    def way(self, id, refs, tags):
+        self.start('way')
+        body = bytearray()
+        self.writeid(body, id)
+        section = bytearray()
+        last = self.lastrefs['node']
+        for ref in refs:
+            writevarint(section, zigzag(ref - last))
+            last = ref
+        self.lastrefs['node'] = last
+        writevarint(body, len(section))
+        body.extend(section)
+        self.tags(body, tags)
+        self.dataset(0x11, body)
+
+    def relation(self, id, members, tags):
+        self.start('relation')
+        body = bytearray()
+        self.writeid(body, id)
+        section = bytearray()
+        lastrefs = self.lastrefs
+        for (membertype, ref, role) in members:
+            writevarint(section, zigzag(ref - lastrefs[membertype]))
+            lastrefs[membertype] = ref
+            role = MEMBER_TYPES[membertype] + tobytes(role)
+            self.writestring(section, role, len(role))
+        writevarint(body, len(section))
+        body.extend(section)
+        self.tags(body, tags)
+        self.dataset(0x12, body)
+
+    def close(self):
+        self.out.append(0xfe)
+        self.file.write(bytes(self.out))
+        self.file.close()
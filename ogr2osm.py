@@ -47,12 +47,28 @@ import sys
 import os
 from optparse import OptionParser
 import logging as l
-l.basicConfig(level=l.DEBUG, format="%(message)s")
 
 from osgeo import ogr
 from osgeo import osr
 
-from SimpleXMLWriter import XMLWriter
+from elementstore import ElementStore
+from compactstore import NodeTable, NodeView
+from osmwriter import FORMATS, EXTENSIONS, formatFromFilename, openWriter
+from compressedoutput import openOutput
+from parallelparse import PARTITION_MODES, planPartitions, applyPartition, parallelMap
+from tiling import TileGrid, CellLayer, BoundaryIndex, Spool, layersExtent
+from stableids import StableIdAllocator
+from reproject import TransformCache, BatchTransformer, BATCHSIZE
+from linepoints import linePoints
+from arrowreader import ArrowReader, canReadArrow
+from parsecache import cacheKey, cachePath, readCache, writeCache
+from runstats import RunStats, NullStats
+from hookprofiler import HookProfiler
+from progress import Progress, NullProgress
+from tagmap import TagMap, layerRules
+from tagcache import TagCache, isPure, plainTags
+
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
 
 # Setup program usage
 usage = "usage: %prog SRCFILE"
@@ -62,7 +78,22 @@ parser.add_option("-t", "--translation", dest="translationMethod",
                   help="Select the attribute-tags translation method. See " +
                   "the translations/ directory for valid values.")
 parser.add_option("-o", "--output", dest="outputFile", metavar="OUTPUT",
-                  help="Set destination .osm file name and location.")
+                  help="Set destination .osm file name and location. " +
+                       "Names ending in .gz, .bz2 or .zst are compressed " +
+                       "on the fly.")
+parser.add_option("--format", dest="outputFormat", type="choice",
+                  choices=FORMATS, metavar="FORMAT",
+                  help="Output format, one of: " + ", ".join(FORMATS) + ". " +
+                       "Defaults to pbf or o5m if the output file name " +
+                       "ends in .pbf or .o5m, xml otherwise.")
+parser.add_option("--pbf-block-size", dest="pbfBlockSize", type="int",
+                  metavar="N",
+                  help="Maximum number of elements per PBF block. " +
+                       "Defaults to 8000.")
+parser.add_option("--compress-threads", dest="compressThreads", type="int",
+                  metavar="N",
+                  help="Compress the output in independent blocks on N " +
+                       "threads. Defaults to 1.")
 parser.add_option("-e", "--epsg", dest="sourceEPSG", metavar="EPSG_CODE",
                   help="EPSG code of source file. Do not include the " +
                        "'EPSG:' prefix. If specified, overrides projection " +
@@ -70,20 +101,92 @@ parser.add_option("-e", "--epsg", dest="sourceEPSG", metavar="EPSG_CODE",
 parser.add_option("-p", "--proj4", dest="sourcePROJ4", metavar="PROJ4_STRING",
                   help="PROJ.4 string. If specified, overrides projection " +
                        "from source metadata if it exists.")
-parser.add_option("-v", "--verbose", dest="verbose", action="store_true")
+parser.add_option("-v", "--verbose", dest="verbose", action="store_true",
+                  help="Log debug messages, same as --log-level DEBUG.")
+parser.add_option("--log-level", dest="logLevel", type="choice",
+                  choices=LOG_LEVELS, metavar="LEVEL",
+                  help="Log messages of LEVEL and above, out of " +
+                       ", ".join(LOG_LEVELS) + ". Defaults to INFO. " +
+                       "Progress is reported at INFO.")
 parser.add_option("-d", "--debug-tags", dest="debugTags", action="store_true",
                   help="Output the tags for every feature parsed.")
 parser.add_option("-f", "--force", dest="forceOverwrite", action="store_true",
                   help="Force overwrite of output file.")
+parser.add_option("-j", "--jobs", dest="jobs", type="int", metavar="N",
+                  help="Parse each layer in N worker processes. Defaults " +
+                       "to 1.")
+parser.add_option("--partition", dest="partitionMode", type="choice",
+                  choices=PARTITION_MODES, metavar="MODE",
+                  help="How --jobs splits a layer: 'fid' for ranges of " +
+                       "feature ids, 'tile' for strips of the layer " +
+                       "extent. Defaults to fid.")
+parser.add_option("--compact", dest="compactStorage", action="store_true",
+                  help="Keep nodes and way node lists in compact arrays " +
+                       "instead of one Python object per vertex. Uses far " +
+                       "less memory on very large inputs.")
+parser.add_option("--arrow", dest="arrowReader", action="store_true",
+                  help="Read the layers as Arrow record batches where GDAL " +
+                       "supports it (3.6 or later, with Python 3).")
+parser.add_option("--batch-reproject", dest="batchReproject", action="store_true",
+                  help="Reproject the vertices of many features at once " +
+                       "instead of one geometry at a time.")
+parser.add_option("--pyproj", dest="usePyproj", action="store_true",
+                  help="Use pyproj, if installed, for --batch-reproject.")
+parser.add_option("--id-file", dest="idFile", metavar="FILE",
+                  help="Keep the ids given to the elements in the sqlite " +
+                       "database FILE, so the same feature or node location " +
+                       "gets the same id in every run.")
+parser.add_option("--id-field", dest="idField", metavar="FIELD",
+                  help="Source field identifying a feature for --id-file. " +
+                       "Defaults to the feature id.")
+parser.add_option("--cache-dir", dest="cacheDir", metavar="DIR",
+                  help="Keep the parsed data in DIR, and load it from there " +
+                       "instead of parsing the source again while the " +
+                       "source, projection and translation are unchanged.")
+parser.add_option("--tile-size", dest="tileSize", type="float", metavar="SIZE",
+                  help="Convert the input in square tiles of SIZE, in the " +
+                       "units of the source coordinates, writing each tile " +
+                       "before reading the next. Memory use then depends " +
+                       "on the tile size rather than the input size.")
+parser.add_option("--tag-cache", dest="tagCacheSize", type="int", metavar="N",
+                  help="Keep the tags made from the last N or so distinct " +
+                       "combinations of field values, and share them between " +
+                       "the features with the same values. Needs a " +
+                       "translation whose filterTags is marked pure, and " +
+                       "that defines neither filterFeaturePost nor " +
+                       "preOutputTransform.")
+parser.add_option("--profile-hooks", dest="profileHooks", action="store_true",
+                  help="Time the hooks of the translation, count the features " +
+                       "they drop or modify, and log a summary at the end.")
+parser.add_option("--stats", dest="statsFile", metavar="FILE",
+                  help="Write the time and peak memory of each phase of " +
+                       "the run, and counts of the features, vertices and " +
+                       "elements, to FILE as JSON.")
 
 parser.set_defaults(sourceEPSG=None, sourcePROJ4=None, verbose=False,
                     debugTags=False,
                     translationMethod=None, outputFile=None,
-                    forceOverwrite=False)
+                    outputFormat=None, pbfBlockSize=8000, compressThreads=1,
+                    jobs=1, partitionMode="fid",
+                    forceOverwrite=False, compactStorage=False, tileSize=None,
+                    arrowReader=False, batchReproject=False, usePyproj=False,
+                    idFile=None, idField=None, cacheDir=None, statsFile=None,
+                    profileHooks=False, logLevel=None,
+                    tagCacheSize=0)
 
 # Parse and process arguments
 (options, args) = parser.parse_args()
 
+if options.logLevel is None:
+    options.logLevel = "DEBUG" if options.verbose else "INFO"
+l.basicConfig(level=getattr(l, options.logLevel), format="%(message)s")
+
+# Phase timings and counters, with --stats
+if options.statsFile is not None:
+    stats = RunStats()
+else:
+    stats = NullStats()
+
 try:
     if options.sourceEPSG:
         options.sourceEPSG = int(options.sourceEPSG)
@@ -104,7 +207,10 @@ if options.outputFile is not None:
     options.outputFile = os.path.realpath(options.outputFile)
 else:
     (base, ext) = os.path.splitext(os.path.basename(sourceFile))
-    options.outputFile = os.path.join(os.getcwd(), base + ".osm")
+    options.outputFile = os.path.join(os.getcwd(),
+                                      base + EXTENSIONS[options.outputFormat or 'xml'])
+if options.outputFormat is None:
+    options.outputFormat = formatFromFilename(options.outputFile)
 if not options.forceOverwrite and os.path.exists(options.outputFile):
     parser.error("ERROR: output file '%s' exists" % (options.outputFile))
 l.info("Preparing to convert file '%s' to '%s'." % (sourceFile, options.outputFile))
@@ -149,8 +255,12 @@ else:
     translations = types.ModuleType("translationmodule")
     l.info("Using default translations")
 
+# Hooks defined by the translation itself
+userHooks = set()
+
 try:
     translations.filterLayer(None)
+    userHooks.add("filterLayer")
     l.debug("Using user filterLayer")
 except:
     l.debug("Using default filterLayer")
@@ -158,6 +268,7 @@ except:
 
 try:
     translations.filterFeature(None, None, None)
+    userHooks.add("filterFeature")
     l.debug("Using user filterFeature")
 except:
     l.debug("Using default filterFeature")
@@ -165,6 +276,7 @@ except:
 
 try:
     translations.filterTags(None)
+    userHooks.add("filterTags")
     l.debug("Using user filterTags")
 except:
     l.debug("Using default filterTags")
@@ -172,6 +284,7 @@ except:
 
 try:
     translations.filterFeaturePost(None, None, None)
+    userHooks.add("filterFeaturePost")
     l.debug("Using user filterFeaturePost")
 except:
     l.debug("Using default filterFeaturePost")
@@ -179,16 +292,92 @@ except:
 
 try:
     translations.preOutputTransform(None, None)
+    userHooks.add("preOutputTransform")
     l.debug("Using user preOutputTransform")
 except:
     l.debug("Using default preOutputTransform")
     translations.preOutputTransform = lambda geometries, features: None
 
+if options.jobs > 1 and "filterFeaturePost" in userHooks:
+    parser.error("--jobs cannot be used with a translation that defines " +
+                 "filterFeaturePost, as it would run in the worker processes")
+if options.batchReproject and "filterFeaturePost" in userHooks:
+    parser.error("--batch-reproject cannot be used with a translation that " +
+                 "defines filterFeaturePost, as its geometries would not " +
+                 "be reprojected")
+if options.jobs > 1 and options.tileSize:
+    parser.error("--jobs and --tile-size cannot be used together")
+if options.tileSize and options.batchReproject:
+    parser.error("--tile-size cannot be used with --batch-reproject, as the " +
+                 "nodes on tile edges are matched on coordinates reprojected by OGR")
+if options.tileSize and "preOutputTransform" in userHooks:
+    parser.error("--tile-size cannot be used with a translation that defines " +
+                 "preOutputTransform, as it would only see one tile at a time")
+if options.cacheDir is not None and options.tileSize:
+    parser.error("--cache-dir cannot be used with --tile-size")
+if options.cacheDir is not None and "filterFeaturePost" in userHooks:
+    # The hook may keep state for preOutputTransform, which would be missing
+    # when the parsed data comes from the cache
+    l.info("Not using the cache, the translation defines filterFeaturePost")
+    options.cacheDir = None
+
+if (options.tagCacheSize > 0 and "filterTags" in userHooks and
+    not isPure(translations.filterTags)):
+    l.warning("Not caching tags, as the filterTags of the translation is " +
+              "not marked pure (filterTags.pure = True)")
+    options.tagCacheSize = 0
+if (options.tagCacheSize > 0 and
+    ("filterFeaturePost" in userHooks or "preOutputTransform" in userHooks)):
+    # The cached tags are shared between features and cannot be changed
+    l.warning("Not caching tags, as the translation defines filterFeaturePost " +
+              "or preOutputTransform, which may change the tags of a feature")
+    options.tagCacheSize = 0
+
+# With --profile-hooks, the hooks of the translation are timed
+hookProfiler = None
+if options.profileHooks:
+    hookProfiler = HookProfiler()
+    hookProfiler.wrap(translations, userHooks)
+
 # Done options parsing, now to program code
 
-# Some global variables to hold stuff...
-geometries = []
-features = []
+# Some global variables to hold stuff, set up by setupStorage()
+geometries = None
+features = None
+
+# Points indexed by location, so that duplicate vertices are merged as they
+# are created rather than in a separate pass afterwards
+pointcoords = None
+
+# With --compact, nodes live in a NodeTable instead of Point objects
+nodetable = None
+pointType = None
+
+# Whether parseLayer() reports its progress, rather than a loop around it
+reportProgress = True
+
+# Vertices parsed so far, for the progress
+parsedVertices = 0
+
+# Tag mappings of the translation compiled per layer, see getTagMap(), and
+# the one of the layer being parsed
+tagMaps = {}
+layerTagMap = None
+
+# With --tag-cache, the tags made per layer by field values, see
+# getTagCache(), the cache of the layer being parsed, and the counts of the
+# worker processes
+tagCaches = {}
+layerTagCache = None
+workerTagCacheCounts = [0, 0, 0]
+
+# Coordinate transformations, shared by all the layers
+transformCache = TransformCache()
+
+# With --id-file, the ids are replaced by stable ones before writing
+idAllocator = None
+if options.idFile is not None:
+    idAllocator = StableIdAllocator(options.idFile)
 
 # Helper function to get a new ID
 elementIdCounter = 0
@@ -213,7 +402,7 @@ class Geometry(object):
         self.parents.discard(parent)
         if shoulddestroy and len(self.parents) == 0:
             global geometries
-            geometries.remove(self)
+            geometries.discard(self)
 
 class Point(Geometry):
     def __init__(self, x, y):
@@ -222,11 +411,47 @@ class Point(Geometry):
         self.y = y
     def replacejwithi(self, i, j):
         pass
+    def removeparent(self, parent, shoulddestroy=True):
+        Geometry.removeparent(self, parent, shoulddestroy)
+        if shoulddestroy and len(self.parents) == 0:
+            global pointcoords
+            pointcoords.pop((self.x, self.y), None)
+
+def getObjectPoint(x, y):
+    # Return the Point already at this location, creating it if needed
+    global pointcoords
+    try:
+        return pointcoords[(x, y)]
+    except KeyError:
+        point = Point(x, y)
+        pointcoords[(x, y)] = point
+        return point
+
+def setupStorage():
+    # (Re)create the containers for the parsed elements
+    global geometries, features, pointcoords, nodetable, pointType, getPoint
+    geometries = ElementStore()
+    features = ElementStore()
+    pointcoords = {}
+    if options.compactStorage:
+        nodetable = NodeTable(getNewID)
+        geometries.attach(NodeView, nodetable)
+        getPoint = nodetable.getpoint
+        pointType = NodeView
+    else:
+        nodetable = None
+        getPoint = getObjectPoint
+        pointType = Point
+
+setupStorage()
 
 class Way(Geometry):
     def __init__(self):
         Geometry.__init__(self)
-        self.points = []
+        if nodetable is None:
+            self.points = []
+        else:
+            self.points = nodetable.newway()
     def replacejwithi(self, i, j):
         self.points = map(lambda x: i if x == j else x, self.points)
         j.removeparent(self)
@@ -244,6 +469,8 @@ class Relation(Geometry):
 class Feature(object):
     geometry = None
     tags = {}
+    # Identifies the source feature across runs, see assignStableIds()
+    key = None
     def __init__(self):
         global features
         features.append(self)
@@ -268,9 +495,14 @@ def parseData(dataSource):
     for i in range(dataSource.GetLayerCount()):
         layer = dataSource.GetLayer(i)
         layer.ResetReading()
-        parseLayer(translations.filterLayer(layer))
+        if stats.enabled:
+            stats.count("features read", layer.GetFeatureCount())
+        if options.jobs > 1:
+            parseLayerParallel(i, layer)
+        else:
+            parseLayer(translations.filterLayer(layer))
 
-def getTransform(layer):
+def getSpatialRef(layer):
     global options
     # First check if the user supplied a projection, then check the layer,
     # then fall back to a default
@@ -287,22 +519,33 @@ def getTransform(layer):
             l.info("Detected projection metadata:\n" + str(spatialRef))
         else:
             l.info("No projection metadata, falling back to EPSG:4326")
+    return spatialRef
 
-    if spatialRef == None:
-        # No source proj specified yet? Then default to do no reprojection.
-        # Some python magic: skip reprojection altogether by using a dummy
-        # lamdba funcion. Otherwise, the lambda will be a call to the OGR
-        # reprojection stuff.
+def getTransform(layer):
+    coordTrans = transformCache.get(getSpatialRef(layer))
+    if coordTrans is None:
+        # No source projection, or already in EPSG:4326. Some python magic:
+        # skip reprojection altogether by using a dummy lamdba funcion.
+        # Otherwise, the lambda will be a call to the OGR reprojection stuff.
         reproject = lambda(geometry): None
     else:
-        destSpatialRef = osr.SpatialReference()
-        # Destionation projection will *always* be EPSG:4326, WGS84 lat-lon
-        destSpatialRef.ImportFromEPSG(4326)
-        coordTrans = osr.CoordinateTransformation(spatialRef, destSpatialRef)
         reproject = lambda(geometry): geometry.Transform(coordTrans)
-
     return reproject
 
+def getBatchTransformer(layer):
+    # With --batch-reproject, the BatchTransformer for the layer, or None if
+    # it needs no reprojection
+    if not options.batchReproject:
+        return None
+    spatialRef = getSpatialRef(layer)
+    coordTrans = transformCache.get(spatialRef)
+    if coordTrans is None:
+        return None
+    batcher = BatchTransformer(spatialRef, coordTrans, options.usePyproj)
+    if options.usePyproj and batcher.pyprojTransform is None:
+        l.warning("pyproj is not installed, reprojecting with OGR")
+    return batcher
+
 def getLayerFields(layer):
     featureDefinition = layer.GetLayerDefn()
     fieldNames = []
@@ -311,21 +554,144 @@ def getLayerFields(layer):
         fieldNames.append(featureDefinition.GetFieldDefn(j).GetNameRef())
     return fieldNames
 
+def getTagMap(layerName, fieldNames):
+    # The tag mappings the translation declares for the layer, compiled for
+    # its fields, or None to copy all the fields
+    rules = layerRules(getattr(translations, "tagMappings", None), layerName)
+    if rules is None:
+        return None
+    key = (layerName, tuple(fieldNames))
+    if key not in tagMaps:
+        tagMap = TagMap(rules, fieldNames)
+        if tagMap.missing:
+            l.warning("Layer %s has no field %s, its tag mappings are skipped" %
+                      (layerName, ", ".join(tagMap.missing)))
+        tagMaps[key] = tagMap
+    return tagMaps[key]
+
+def getTagCache(layerName, fieldNames):
+    # With --tag-cache, the tag cache of the layer
+    if options.tagCacheSize <= 0:
+        return None
+    key = (layerName, tuple(fieldNames))
+    if key not in tagCaches:
+        tagCaches[key] = TagCache(options.tagCacheSize)
+    return tagCaches[key]
+
+def tagCacheCounts():
+    # Hits, misses and evictions of all the tag caches, with the workers'
+    counts = list(workerTagCacheCounts)
+    for cache in tagCaches.values():
+        counts = [total + count for (total, count) in zip(counts, cache.counts())]
+    return counts
+
 def getFeatureTags(ogrfeature, fieldNames):
+    if layerTagCache is not None:
+        return getCachedTags(ogrfeature, fieldNames)
+    if layerTagMap is not None:
+        return translations.filterTags(layerTagMap.apply(ogrfeature))
     tags = {}
     for i in range(len(fieldNames)):
         tags[fieldNames[i]] = ogrfeature.GetFieldAsString(i)
     return translations.filterTags(tags)
 
-def parseLayer(layer):
+def getCachedTags(ogrfeature, fieldNames):
+    # The tags of the field values of the feature, only made if they are not
+    # in the cache
+    if layerTagMap is not None:
+        values = layerTagMap.values(ogrfeature)
+    else:
+        values = tuple([ogrfeature.GetFieldAsString(i) for i in range(len(fieldNames))])
+    try:
+        return layerTagCache.get(values)
+    except KeyError:
+        pass
+    if layerTagMap is not None:
+        tags = layerTagMap.fromValues(values)
+    else:
+        tags = dict(zip(fieldNames, values))
+    return layerTagCache.add(values, translations.filterTags(tags))
+
+def countVertices():
+    return parsedVertices
+
+def newProgress(name, total, unit="features"):
+    if not reportProgress or not l.getLogger().isEnabledFor(l.INFO):
+        return NullProgress()
+    return Progress(name, total, countVertices, unit)
+
+def iterFeatures(layer):
+    # Read until GetNextFeature() runs out rather than GetFeatureCount()
+    # times, as filtered layers like StripLayer and CellLayer skip features
+    ogrfeature = layer.GetNextFeature()
+    while ogrfeature is not None:
+        yield ogrfeature
+        ogrfeature = layer.GetNextFeature()
+
+def readFeatures(layer):
+    # The features of the layer, read in Arrow record batches when asked to
+    # and possible. Translations that get the OGR features themselves are
+    # given real ones.
+    if (options.arrowReader and canReadArrow(layer) and
+        "filterFeature" not in userHooks and "filterFeaturePost" not in userHooks):
+        l.debug("Reading Arrow record batches")
+        return ArrowReader(layer)
+    return iterFeatures(layer)
+
+def parseLayer(layer, reproject=None):
+    global layerTagMap, layerTagCache
     if layer is None:
         return
     fieldNames = getLayerFields(layer)
-    reproject = getTransform(layer)
-    
-    for j in range(layer.GetFeatureCount()):
-        ogrfeature = layer.GetNextFeature()
-        parseFeature(translations.filterFeature(ogrfeature, fieldNames, reproject), fieldNames, reproject)
+    if reproject is None:
+        reproject = getTransform(layer)
+    layerName = layer.GetName()
+    layerTagMap = getTagMap(layerName, fieldNames)
+    layerTagCache = getTagCache(layerName, fieldNames)
+    batcher = getBatchTransformer(layer)
+    progress = newProgress(layerName, layer.GetFeatureCount())
+
+    batch = []
+    count = 0
+    for ogrfeature in readFeatures(layer):
+        count += 1
+        progress.update(count)
+        ogrfeature = translations.filterFeature(ogrfeature, fieldNames, reproject)
+        if batcher is not None:
+            batch.append(ogrfeature)
+            if len(batch) >= BATCHSIZE:
+                parseReprojectedBatch(batch, fieldNames, batcher, layerName)
+                batch = []
+            continue
+        feature = parseFeature(ogrfeature, fieldNames, reproject)
+        if feature is not None:
+            feature.key = getFeatureKey(layerName, ogrfeature)
+    if batch:
+        parseReprojectedBatch(batch, fieldNames, batcher, layerName)
+    progress.finish(count)
+
+def parseReprojectedBatch(ogrfeatures, fieldNames, batcher, layerName):
+    # Reproject the vertices of all the features at once, then parse the
+    # features with getPoint looking up the reprojected coordinates
+    global getPoint
+    ogrfeatures = [ogrfeature for ogrfeature in ogrfeatures if ogrfeature is not None]
+    coordinates = batcher.transformGeometries(
+        [ogrfeature.GetGeometryRef() for ogrfeature in ogrfeatures
+         if ogrfeature.GetGeometryRef() is not None])
+    makePoint = getPoint
+    getPoint = lambda x, y: makePoint(*coordinates[(x, y)])
+    try:
+        for ogrfeature in ogrfeatures:
+            feature = parseFeature(ogrfeature, fieldNames, lambda(geometry): None)
+            if feature is not None:
+                feature.key = getFeatureKey(layerName, ogrfeature)
+    finally:
+        getPoint = makePoint
+
+def getFeatureKey(layerName, ogrfeature):
+    if options.idField:
+        return layerName + ":" + ogrfeature.GetFieldAsString(options.idField)
+    return layerName + ":" + str(ogrfeature.GetFID())
 
 def parseFeature(ogrfeature, fieldNames, reproject):
     if ogrfeature is None:
@@ -345,6 +711,7 @@ def parseFeature(ogrfeature, fieldNames, reproject):
     geometry.addparent(feature)
 
     translations.filterFeaturePost(feature, ogrfeature, ogrgeometry)
+    return feature
     
 
 def parseGeometry(ogrgeometry):
@@ -375,18 +742,22 @@ def parseGeometry(ogrgeometry):
         return None
 
 def parsePoint(ogrgeometry):
+    global parsedVertices
+    parsedVertices += 1
     x = ogrgeometry.GetX()
     y = ogrgeometry.GetY()
-    geometry = Point(x, y)
+    geometry = getPoint(x, y)
     return geometry
 
 def parseLineString(ogrgeometry):
+    global parsedVertices
     geometry = Way()
-    # LineString.GetPoint() returns a tuple, so we can't call parsePoint on it
-    # and instead have to create the point ourself
-    for i in range(ogrgeometry.GetPointCount()):
-        (x, y, unused) = ogrgeometry.GetPoint(i)
-        mypoint = Point(x, y)
+    # Get all the vertices at once rather than with one GetPoint() call each,
+    # and create the points ourself
+    vertices = linePoints(ogrgeometry)
+    parsedVertices += len(vertices)
+    for (x, y) in vertices:
+        mypoint = getPoint(x, y)
         geometry.points.append(mypoint)
         mypoint.addparent(geometry)
     return geometry
@@ -436,71 +807,281 @@ def parseCollection(ogrgeometry):
             geometry.members.append((member, "member"))
         return geometry
 
-def mergePoints():
-    l.debug("Merging points")
-    global geometries
-    points = [geometry for geometry in geometries if type(geometry) == Point]
-    
-    # Make list of Points at each location
-    l.debug("Making list")
-    pointcoords = {}
-    for i in points:
-        try:
-            pointcoords[(i.x, i.y)].append(i)
-        except KeyError:
-            pointcoords[(i.x, i.y)] = [i]
-
-    # Use list to get rid of extras
-    l.debug("Checking list")
-    for (location, pointsatloc) in pointcoords.items():
-        if len(pointsatloc) > 1:
-            for point in pointsatloc[1:]:
-                for parent in set(point.parents):
-                    parent.replacejwithi(pointsatloc[0], point)
-        
-def output():
-    l.debug("Outputting XML")
+def parseLayerParallel(layerIndex, layer):
+    # Parse the partitions of a layer in worker processes and merge the
+    # results
+    partitions = planPartitions(layer, options.jobs * 4, options.partitionMode)
+    l.debug("Parsing layer %d in %d partitions" % (layerIndex, len(partitions)))
+    work = [(layerIndex, partition) for partition in partitions]
+    progress = newProgress(layer.GetName(), len(partitions), "partitions")
+    for (done, (elements, hookProfile, cacheCounts)) in enumerate(
+            parallelMap(parsePartition, work, options.jobs)):
+        importElements(elements)
+        if hookProfile is not None:
+            hookProfiler.merge(hookProfile)
+        workerTagCacheCounts[:] = [total + count for (total, count)
+                                   in zip(workerTagCacheCounts, cacheCounts)]
+        progress.update(done + 1)
+    progress.finish(len(partitions))
+
+def parsePartition(work):
+    # Runs in a worker process, with its own OGR handle and element storage
+    global reportProgress
+    (layerIndex, partition) = work
+    reportProgress = False
+    setupStorage()
+    if hookProfiler is not None:
+        hookProfiler.reset()
+    # Counts inherited from the parent are not this worker's
+    for cache in tagCaches.values():
+        cache.resetCounts()
+    workerTagCacheCounts[:] = [0, 0, 0]
+    dataSource = ogr.Open(sourceFile, 0)
+    layer = applyPartition(dataSource.GetLayer(layerIndex), partition)
+    parseLayer(translations.filterLayer(layer))
+    elements = exportElements()
+    setupStorage()
+    hookProfile = hookProfiler.export() if hookProfiler is not None else None
+    return (elements, hookProfile, tagCacheCounts())
+
+def exportElements():
+    # Flatten the parsed elements into plain lists that can be pickled, with
+    # references to other elements given as list indexes
+    nodes = []
+    nodeindex = {}
+    for node in geometries.oftype(pointType):
+        nodeindex[node] = len(nodes)
+        nodes.append((node.x, node.y))
+    ways = []
+    wayindex = {}
+    for way in geometries.oftype(Way):
+        wayindex[way] = len(ways)
+        ways.append([nodeindex[node] for node in way.points])
+    relationobjects = list(geometries.oftype(Relation))
+    relationindex = dict((relation, i) for (i, relation) in enumerate(relationobjects))
+
+    indexes = {pointType: ("node", nodeindex), Way: ("way", wayindex),
+               Relation: ("relation", relationindex)}
+    def reference(geometry):
+        (kind, index) = indexes[type(geometry)]
+        return (kind, index[geometry])
+
+    relations = [[reference(member) + (role,) for (member, role) in relation.members]
+                 for relation in relationobjects]
+    featurelist = [reference(feature.geometry) + (feature.tags, feature.key)
+                   for feature in features]
+    return (nodes, ways, relations, featurelist)
+
+def importElements(elements):
+    # Recreate the elements from exportElements(). Nodes are merged with the
+    # ones already at the same location and everything gets new ids.
+    global parsedVertices
+    (nodes, ways, relations, featurelist) = elements
+    parsedVertices += (sum(len(refs) for refs in ways) +
+                       sum(1 for feature in featurelist if feature[0] == "node"))
+    points = [getPoint(x, y) for (x, y) in nodes]
+    wayobjects = []
+    for refs in ways:
+        way = Way()
+        for i in refs:
+            point = points[i]
+            way.points.append(point)
+            point.addparent(way)
+        wayobjects.append(way)
+    relationobjects = [Relation() for members in relations]
+
+    geometrylists = {"node": points, "way": wayobjects, "relation": relationobjects}
+    for (relation, members) in zip(relationobjects, relations):
+        for (kind, i, role) in members:
+            member = geometrylists[kind][i]
+            member.addparent(relation)
+            relation.members.append((member, role))
+    for (kind, i, tags, key) in featurelist:
+        feature = Feature()
+        feature.tags = tags
+        feature.key = key
+        feature.geometry = geometrylists[kind][i]
+        feature.geometry.addparent(feature)
+    return (points, wayobjects, relationobjects)
+
+def parseCached(dataSource):
+    # Load the parsed data from the cache, or parse the source and store it
+    # there for the next run
+    settings = [("epsg", options.sourceEPSG), ("proj4", options.sourcePROJ4),
+                ("idField", options.idField),
+                ("pyproj", options.batchReproject and options.usePyproj)]
+    path = cachePath(options.cacheDir, cacheKey(sourceFile, settings, translations))
+    data = readCache(path)
+    if data is not None:
+        l.info("Loading parsed data from '%s'" % path)
+        loadParsed(data)
+        return
+    parseData(dataSource)
+    l.info("Saving parsed data to '%s'" % path)
+    saveParsed(path)
+
+def saveParsed(path):
+    # The ids are stored too, so the output is the same as without the cache
+    ids = [[element.id for element in geometries.oftype(elementtype)]
+           for elementtype in (pointType, Way, Relation)]
+    (nodes, ways, relations, featurelist) = exportElements()
+    # Shared tags cannot be marshalled
+    featurelist = [(kind, i, plainTags(tags), key) for (kind, i, tags, key) in featurelist]
+    writeCache(path, ((nodes, ways, relations, featurelist), ids, elementIdCounter))
+
+def loadParsed(data):
+    global elementIdCounter
+    (elements, ids, lastid) = data
+    for (elementlist, idlist) in zip(importElements(elements), ids):
+        for (element, id) in zip(elementlist, idlist):
+            element.id = id
+    elementIdCounter = lastid
+
+def convertTiled(dataSource):
+    # Parse and write the input one tile at a time
+    l.debug("Parsing data in tiles")
+    layers = [dataSource.GetLayer(i) for i in range(dataSource.GetLayerCount())]
+    transforms = [getTransform(layer) for layer in layers]
+    grid = TileGrid(layersExtent(layers), options.tileSize)
+    boundary = BoundaryIndex(grid)
+    with stats.phase("boundary scan"):
+        for (layer, reproject) in zip(layers, transforms):
+            boundary.scan(layer, reproject)
+    l.debug("%d tiles, %d vertices on tile boundaries" % (len(grid), len(boundary)))
+
+    global reportProgress
+    w = openOutputWriter()
+    spool = Spool()
+    progress = newProgress("tiles", len(grid), "tiles")
+    reportProgress = False
+    for cell in range(len(grid)):
+        progress.update(cell + 1)
+        setupStorage()
+        with stats.phase("parseData"):
+            for (layer, reproject) in zip(layers, transforms):
+                parseLayer(translations.filterLayer(CellLayer(layer, grid, cell)), reproject)
+        countElements()
+        with stats.phase("output"):
+            writeElements(w, spool, boundary)
+    reportProgress = True
+    progress.finish(len(grid))
+    for layer in layers:
+        layer.SetSpatialFilter(None)
+    setupStorage()
+    with stats.phase("output"):
+        spool.replay(w)
+        w.close()
+
+def openOutputWriter():
+    return stats.wrapWriter(openWriter(openOutput(options.outputFile, options.compressThreads),
+                                       options.outputFormat, blocksize=options.pbfBlockSize))
+
+def countElements():
+    # Counters for --stats, taken from the parsed elements. Every vertex
+    # of a way or point feature that got a node made before counts as merged.
+    if not stats.enabled:
+        return
+    nodes = sum(1 for node in geometries.oftype(pointType))
+    vertices = sum(len(way.points) for way in geometries.oftype(Way))
+    vertices += sum(1 for feature in features if isinstance(feature.geometry, pointType))
+    stats.count("features", len(features))
+    stats.count("vertices", vertices)
+    stats.count("nodes", nodes)
+    stats.count("nodes merged", vertices - nodes)
+    stats.count("ways", sum(1 for way in geometries.oftype(Way)))
+    stats.count("relations", sum(1 for relation in geometries.oftype(Relation)))
+
+def assignStableIds():
+    # Give the elements the ids recorded for them in previous runs. Ways and
+    # relations are keyed by the feature they belong to, relation members by
+    # their position in the relation, and nodes by their location.
+    keys = {}
+    def addkeys(geometry, key):
+        keys[geometry] = key
+        if isinstance(geometry, Relation):
+            for (i, (member, role)) in enumerate(geometry.members):
+                if member not in keys:
+                    addkeys(member, "%s/%d" % (key, i))
+    for feature in features:
+        if feature.key is not None:
+            addkeys(feature.geometry, feature.key)
+
+    nodes = list(geometries.oftype(pointType))
+    ids = idAllocator.assign("node", ["%r %r" % (node.x, node.y) for node in nodes])
+    for (node, id) in zip(nodes, ids):
+        node.id = id
+    for (kind, elementtype) in (("way", Way), ("relation", Relation)):
+        elements = []
+        for element in geometries.oftype(elementtype):
+            if element in keys:
+                elements.append(element)
+            else:
+                element.id = idAllocator.newid()
+        ids = idAllocator.assign(kind, [keys[element] for element in elements])
+        for (element, id) in zip(elements, ids):
+            element.id = id
+
+def writeElements(nodeWriter, wayWriter, boundary=None):
+    # Nodes go to nodeWriter, ways and relations to wayWriter. With a
+    # boundary index, nodes shared with a tile written before are skipped.
+    if idAllocator is not None:
+        assignStableIds()
     # First, set up a few data structures for optimization purposes
     global geometries, features
-    nodes = [geometry for geometry in geometries if type(geometry) == Point]
-    ways = [geometry for geometry in geometries if type(geometry) == Way]
-    relations = [geometry for geometry in geometries if type(geometry) == Relation]
+    nodes = geometries.oftype(pointType)
+    ways = geometries.oftype(Way)
+    relations = geometries.oftype(Relation)
     featuresmap = {feature.geometry : feature for feature in features}
 
-    w = XMLWriter(open(options.outputFile, 'w'))
-    w.start("osm", version='0.6', generator='uvmogr2osm')
-
     for node in nodes:
-        w.start("node", visible="true", id=str(node.id), lat=str(node.y), lon=str(node.x))
-        if node in featuresmap:
-            for (key, value) in featuresmap[node].tags.items():
-                w.element("tag", k=key, v=value)
-        w.end("node")
+        if boundary is not None and not boundary.stitch(node, (node.x, node.y)):
+            continue
+        tags = featuresmap[node].tags if node in featuresmap else None
+        nodeWriter.node(node.id, node.x, node.y, tags)
 
     for way in ways:
-        w.start("way", visible="true", id=str(way.id))
-        for node in way.points:
-            w.element("nd", ref=str(node.id))
-        if way in featuresmap:
-            for (key, value) in featuresmap[way].tags.items():
-                w.element("tag", k=key, v=value)
-        w.end("way")
+        tags = featuresmap[way].tags if way in featuresmap else None
+        wayWriter.way(way.id, [node.id for node in way.points], tags)
 
     for relation in relations:
-        w.start("relation", visible="true", id=str(relation.id))
-        for (member, role) in relation.members:
-            w.element("member", type="way", ref=str(member.id), role=role)
-        if relation in featuresmap:
-            for (key, value) in featuresmap[relation].tags.items():
-                w.element("tag", k=key, v=value)
-        w.end("relation")
+        tags = featuresmap[relation].tags if relation in featuresmap else None
+        members = [("way", member.id, role) for (member, role) in relation.members]
+        wayWriter.relation(relation.id, members, tags)
 
-    w.end("osm")
+def output():
+    l.debug("Outputting " + options.outputFormat)
+    w = openOutputWriter()
+    writeElements(w, w)
+    w.close()
 
 
 # Main flow
-data = getFileData(sourceFile)
-parseData(data)
-mergePoints()
-translations.preOutputTransform(geometries, features)
-output()
+with stats.phase("open"):
+    data = getFileData(sourceFile)
+if options.tileSize:
+    convertTiled(data)
+else:
+    with stats.phase("parseData"):
+        if options.cacheDir is not None:
+            parseCached(data)
+        else:
+            parseData(data)
+    countElements()
+    with stats.phase("preOutputTransform"):
+        translations.preOutputTransform(geometries, features)
+    with stats.phase("output"):
+        output()
+if idAllocator is not None:
+    idAllocator.close()
+if options.tagCacheSize > 0:
+    (hits, misses, evictions) = tagCacheCounts()
+    l.info("Tag cache: %d hits, %d misses, %d evicted" % (hits, misses, evictions))
+    stats.count("tag cache hits", hits)
+    stats.count("tag cache misses", misses)
+    stats.count("tag cache evictions", evictions)
+if hookProfiler is not None:
+    for line in hookProfiler.summary():
+        l.info(line)
+    stats.section("hooks", hookProfiler.report())
+if options.statsFile is not None:
+    stats.write(options.statsFile)
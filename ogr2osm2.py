@@ -48,12 +48,29 @@ import psycopg2
 from optparse import OptionParser
 import logging as l
 
-l.basicConfig(level=l.DEBUG, format="%(message)s")
 
 from osgeo import ogr
 from osgeo import osr
 
-from SimpleXMLWriter import XMLWriter
+from elementstore import ElementStore
+from compactstore import NodeTable, NodeView
+from osmwriter import FORMATS, EXTENSIONS, formatFromFilename, openWriter, OscWriter
+from compressedoutput import openOutput, stripCompression
+from roadnames import RoadNames
+from parallelparse import PARTITION_MODES, planPartitions, applyPartition, parallelMap
+from tiling import TileGrid, CellLayer, BoundaryIndex, Spool, layersExtent
+from stableids import StableIdAllocator
+from reproject import TransformCache, BatchTransformer, BATCHSIZE
+from linepoints import linePoints
+from arrowreader import ArrowReader, canReadArrow
+from incremental import ConversionState, fingerprint, previousRun
+from runstats import RunStats, NullStats
+from hookprofiler import HookProfiler
+from progress import Progress, NullProgress
+from tagmap import TagMap, layerRules
+from tagcache import TagCache, isPure
+
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
 
 # Setup program usage
 usage = "usage: %prog SRCFILE"
@@ -63,7 +80,22 @@ parser.add_option("-t", "--translation", dest="translationMethod",
                   help="Select the attribute-tags translation method. See " +
                        "the translations/ directory for valid values.")
 parser.add_option("-o", "--output", dest="outputFile", metavar="OUTPUT",
-                  help="Set destination .osm file name and location.")
+                  help="Set destination .osm file name and location. " +
+                       "Names ending in .gz, .bz2 or .zst are compressed " +
+                       "on the fly.")
+parser.add_option("--format", dest="outputFormat", type="choice",
+                  choices=FORMATS, metavar="FORMAT",
+                  help="Output format, one of: " + ", ".join(FORMATS) + ". " +
+                       "Defaults to pbf or o5m if the output file name " +
+                       "ends in .pbf or .o5m, xml otherwise.")
+parser.add_option("--pbf-block-size", dest="pbfBlockSize", type="int",
+                  metavar="N",
+                  help="Maximum number of elements per PBF block. " +
+                       "Defaults to 8000.")
+parser.add_option("--compress-threads", dest="compressThreads", type="int",
+                  metavar="N",
+                  help="Compress the output in independent blocks on N " +
+                       "threads. Defaults to 1.")
 parser.add_option("-e", "--epsg", dest="sourceEPSG", metavar="EPSG_CODE",
                   help="EPSG code of source file. Do not include the " +
                        "'EPSG:' prefix. If specified, overrides projection " +
@@ -71,20 +103,101 @@ parser.add_option("-e", "--epsg", dest="sourceEPSG", metavar="EPSG_CODE",
 parser.add_option("-p", "--proj4", dest="sourcePROJ4", metavar="PROJ4_STRING",
                   help="PROJ.4 string. If specified, overrides projection " +
                        "from source metadata if it exists.")
-parser.add_option("-v", "--verbose", dest="verbose", action="store_true")
+parser.add_option("-v", "--verbose", dest="verbose", action="store_true",
+                  help="Log debug messages, same as --log-level DEBUG.")
+parser.add_option("--log-level", dest="logLevel", type="choice",
+                  choices=LOG_LEVELS, metavar="LEVEL",
+                  help="Log messages of LEVEL and above, out of " +
+                       ", ".join(LOG_LEVELS) + ". Defaults to INFO. " +
+                       "Progress is reported at INFO.")
 parser.add_option("-d", "--debug-tags", dest="debugTags", action="store_true",
                   help="Output the tags for every feature parsed.")
 parser.add_option("-f", "--force", dest="forceOverwrite", action="store_true",
                   help="Force overwrite of output file.")
+parser.add_option("--name-lookup", dest="nameLookup", type="choice",
+                  choices=("preload", "batch"), metavar="MODE",
+                  help="How road names are read from r_lname/r_name: " +
+                       "'preload' loads them all with one query before " +
+                       "parsing, 'batch' fetches them for each batch of " +
+                       "roads. Defaults to preload.")
+parser.add_option("--name-batch-size", dest="nameBatchSize", type="int",
+                  metavar="N",
+                  help="Number of roads per name query in batch mode. " +
+                       "Defaults to 5000.")
+parser.add_option("-j", "--jobs", dest="jobs", type="int", metavar="N",
+                  help="Parse each layer in N worker processes. Defaults " +
+                       "to 1.")
+parser.add_option("--partition", dest="partitionMode", type="choice",
+                  choices=PARTITION_MODES, metavar="MODE",
+                  help="How --jobs splits a layer: 'fid' for ranges of " +
+                       "feature ids, 'tile' for strips of the layer " +
+                       "extent. Defaults to fid.")
+parser.add_option("--compact", dest="compactStorage", action="store_true",
+                  help="Keep nodes and way node lists in compact arrays " +
+                       "instead of one Python object per vertex. Uses far " +
+                       "less memory on very large inputs.")
+parser.add_option("--arrow", dest="arrowReader", action="store_true",
+                  help="Read the layers as Arrow record batches where GDAL " +
+                       "supports it (3.6 or later, with Python 3).")
+parser.add_option("--batch-reproject", dest="batchReproject", action="store_true",
+                  help="Reproject the vertices of many features at once " +
+                       "instead of one geometry at a time.")
+parser.add_option("--pyproj", dest="usePyproj", action="store_true",
+                  help="Use pyproj, if installed, for --batch-reproject.")
+parser.add_option("--id-file", dest="idFile", metavar="FILE",
+                  help="Keep the ids given to the elements in the sqlite " +
+                       "database FILE, so the same feature or node location " +
+                       "gets the same id in every run.")
+parser.add_option("--tile-size", dest="tileSize", type="float", metavar="SIZE",
+                  help="Convert the input in square tiles of SIZE, in the " +
+                       "units of the source coordinates, writing each tile " +
+                       "before reading the next. Memory use then depends " +
+                       "on the tile size rather than the input size.")
+parser.add_option("--state", dest="stateFile", metavar="FILE",
+                  help="Keep the ids and a fingerprint of every road in the " +
+                       "sqlite database FILE. If it holds a previous run, " +
+                       "only new and changed roads are parsed and the " +
+                       "output is an osmChange file against that run.")
+parser.add_option("--tag-cache", dest="tagCacheSize", type="int", metavar="N",
+                  help="Keep the tags made from the last N or so distinct " +
+                       "combinations of field values, and share them between " +
+                       "the features with the same values. Needs a " +
+                       "translation whose filterTags is marked pure, and " +
+                       "that defines neither filterFeaturePost nor " +
+                       "preOutputTransform.")
+parser.add_option("--profile-hooks", dest="profileHooks", action="store_true",
+                  help="Time the hooks of the translation, count the features " +
+                       "they drop or modify, and log a summary at the end.")
+parser.add_option("--stats", dest="statsFile", metavar="FILE",
+                  help="Write the time and peak memory of each phase of " +
+                       "the run, and counts of the features, vertices and " +
+                       "elements, to FILE as JSON.")
 
 parser.set_defaults(sourceEPSG=None, sourcePROJ4=None, verbose=False,
                     debugTags=False,
                     translationMethod=None, outputFile=None,
-                    forceOverwrite=False)
+                    outputFormat=None, pbfBlockSize=8000, compressThreads=1,
+                    nameLookup="preload", nameBatchSize=5000,
+                    jobs=1, partitionMode="fid",
+                    forceOverwrite=False, compactStorage=False, tileSize=None,
+                    arrowReader=False, batchReproject=False, usePyproj=False,
+                    idFile=None,
+                    stateFile=None, statsFile=None, profileHooks=False, logLevel=None,
+                    tagCacheSize=0)
 
 # Parse and process arguments
 (options, args) = parser.parse_args()
 
+if options.logLevel is None:
+    options.logLevel = "DEBUG" if options.verbose else "INFO"
+l.basicConfig(level=getattr(l, options.logLevel), format="%(message)s")
+
+# Phase timings and counters, with --stats
+if options.statsFile is not None:
+    stats = RunStats()
+else:
+    stats = NullStats()
+
 try:
     if options.sourceEPSG:
         options.sourceEPSG = int(options.sourceEPSG)
@@ -97,13 +210,30 @@ except:
 #
 # rheilongjiang R_LName R_Name n z z_index
 
-conn = psycopg2.connect(host="t0.map.design",user="postgres",password="***",database="basemap")
-datasource = ogr.Open("PG:dbname=basemap host=t0.map.design port=5432 user=postgres password=***")
-rlayer = datasource.GetLayerByName("r")
-nlayer = datasource.GetLayerByName("n")
-zlayer = datasource.GetLayerByName("z_level")
-
-options.outputFile = "output.osm"
+dbParams = dict(host="t0.map.design",user="postgres",password="***",database="basemap")
+with stats.phase("open"):
+    conn = psycopg2.connect(**dbParams)
+    roadNames = RoadNames(conn, batchsize=options.nameBatchSize)
+    datasourceName = "PG:dbname=basemap host=t0.map.design port=5432 user=postgres password=***"
+    datasource = ogr.Open(datasourceName)
+    rlayer = datasource.GetLayerByName("r")
+    nlayer = datasource.GetLayerByName("n")
+    zlayer = datasource.GetLayerByName("z_level")
+
+# Against a previous run the output is an osmChange file
+if options.stateFile is not None and previousRun(options.stateFile) > 0:
+    if options.outputFormat not in (None, "xml"):
+        parser.error("changes to a previous run can only be written as osmChange XML")
+    if (options.outputFile is not None and
+        os.path.splitext(stripCompression(options.outputFile))[1] not in (".osc", ".osm")):
+        parser.error("changes to a previous run are written as osmChange XML, " +
+                     "the output file must end in .osc or .osm")
+    options.outputFormat = "osc"
+
+if options.outputFile is None:
+    options.outputFile = "output" + EXTENSIONS[options.outputFormat or 'xml']
+if options.outputFormat is None:
+    options.outputFormat = formatFromFilename(options.outputFile)
 
 if not options.forceOverwrite and os.path.exists(options.outputFile):
     parser.error("ERROR: output file '%s' exists" % (options.outputFile))
@@ -150,8 +280,12 @@ else:
     translations = types.ModuleType("translationmodule")
     l.info("Using default translations")
 
+# Hooks defined by the translation itself
+userHooks = set()
+
 try:
     translations.filterLayer(None)
+    userHooks.add("filterLayer")
     l.debug("Using user filterLayer")
 except:
     l.debug("Using default filterLayer")
@@ -159,6 +293,7 @@ except:
 
 try:
     translations.filterFeature(None, None, None)
+    userHooks.add("filterFeature")
     l.debug("Using user filterFeature")
 except:
     l.debug("Using default filterFeature")
@@ -166,6 +301,7 @@ except:
 
 try:
     translations.filterTags(None)
+    userHooks.add("filterTags")
     l.debug("Using user filterTags")
 except:
     l.debug("Using default filterTags")
@@ -173,6 +309,7 @@ except:
 
 try:
     translations.filterFeaturePost(None, None, None)
+    userHooks.add("filterFeaturePost")
     l.debug("Using user filterFeaturePost")
 except:
     l.debug("Using default filterFeaturePost")
@@ -180,17 +317,113 @@ except:
 
 try:
     translations.preOutputTransform(None, None)
+    userHooks.add("preOutputTransform")
     l.debug("Using user preOutputTransform")
 except:
     l.debug("Using default preOutputTransform")
     translations.preOutputTransform = lambda geometries, features: None
 
-# Done options parsing, now to program code
+if options.jobs > 1 and "filterFeaturePost" in userHooks:
+    parser.error("--jobs cannot be used with a translation that defines " +
+                 "filterFeaturePost, as it would run in the worker processes")
+if options.batchReproject and "filterFeaturePost" in userHooks:
+    parser.error("--batch-reproject cannot be used with a translation that " +
+                 "defines filterFeaturePost, as its geometries would not " +
+                 "be reprojected")
+if options.jobs > 1 and options.tileSize:
+    parser.error("--jobs and --tile-size cannot be used together")
+if options.tileSize and options.batchReproject:
+    parser.error("--tile-size cannot be used with --batch-reproject, as the " +
+                 "nodes on tile edges are matched on coordinates reprojected by OGR")
+if options.tileSize and "preOutputTransform" in userHooks:
+    parser.error("--tile-size cannot be used with a translation that defines " +
+                 "preOutputTransform, as it would only see one tile at a time")
+if options.stateFile is not None and (options.jobs > 1 or options.tileSize):
+    parser.error("--state cannot be used with --jobs or --tile-size")
+if options.stateFile is not None and options.idFile is not None:
+    parser.error("--state already keeps the ids, --id-file is not needed")
+if options.stateFile is not None and "preOutputTransform" in userHooks:
+    parser.error("--state cannot be used with a translation that defines " +
+                 "preOutputTransform, as only the changed roads are parsed")
+
+if (options.tagCacheSize > 0 and "filterTags" in userHooks and
+    not isPure(translations.filterTags)):
+    l.warning("Not caching tags, as the filterTags of the translation is " +
+              "not marked pure (filterTags.pure = True)")
+    options.tagCacheSize = 0
+if (options.tagCacheSize > 0 and
+    ("filterFeaturePost" in userHooks or "preOutputTransform" in userHooks)):
+    # The cached tags are shared between features and cannot be changed
+    l.warning("Not caching tags, as the translation defines filterFeaturePost " +
+              "or preOutputTransform, which may change the tags of a feature")
+    options.tagCacheSize = 0
+
+# With --profile-hooks, the hooks of the translation are timed
+hookProfiler = None
+if options.profileHooks:
+    hookProfiler = HookProfiler()
+    hookProfiler.wrap(translations, userHooks)
 
-# Some global variables to hold stuff...
-geometries = []
-features = []
+# Done options parsing, now to program code
 
+# Some global variables to hold stuff, set up by setupStorage()
+geometries = None
+features = None
+
+# Points indexed by location, so that duplicate vertices are merged as they
+# are created rather than in a separate pass afterwards
+pointcoords = None
+
+# With --compact, nodes live in a NodeTable instead of Point objects
+nodetable = None
+pointType = None
+
+# How NavInfo road fields become tags: Direction gives the direction of
+# travel, and the first two characters of the first Kind code the highway
+# class, with 0b after a trunk or primary class for its links. Used unless
+# the translation declares tagMappings of its own.
+ROAD_TAG_MAPPINGS = [
+    {'field': 'ID', 'tag': 'id'},
+    {'field': 'Direction',
+     'values': {'2': {'oneway': 'yes', 'rDirection': 'no'},
+                '3': {'oneway': 'yes', 'rDirection': 'yes'}},
+     'default': {'oneway': 'no', 'rDirection': 'no'}},
+    {'field': 'Kind', 'tag': 'highway', 'split': '|',
+     'prefixes': {'00': 'motorway', '01': 'motorway',
+                  '02': 'trunk', '020b': 'trunk_link',
+                  '03': 'primary', '030b': 'primary_link',
+                  '04': 'secondary', '05': 'tertiary', '06': 'unclassified',
+                  '08': 'residential', '0a': 'living_street', '0b': 'service'}},
+]
+
+# Whether parseLayer() reports its progress, rather than a loop around it
+reportProgress = True
+
+# Vertices parsed so far, for the progress
+parsedVertices = 0
+
+# Tag mappings of the translation compiled per layer, see getTagMap(), and
+# the one of the layer being parsed
+tagMaps = {}
+layerTagMap = None
+
+# With --tag-cache, the tags made per layer by field values, see
+# getTagCache(), the cache of the layer being parsed, and the counts of the
+# worker processes
+tagCaches = {}
+layerTagCache = None
+workerTagCacheCounts = [0, 0, 0]
+
+# Coordinate transformations, shared by all the layers
+transformCache = TransformCache()
+
+# With --id-file, the ids are replaced by stable ones before writing
+idAllocator = None
+if options.idFile is not None:
+    idAllocator = StableIdAllocator(options.idFile)
+
+# Vertices raised to z-level 1, as a set of vertex sequences per road id. A
+# sequence of -1 stands for the last vertex of the road.
 zpoints = {}
 # Helper function to get a new ID
 elementIdCounter = 0
@@ -221,7 +454,7 @@ class Geometry(object):
         self.parents.discard(parent)
         if shoulddestroy and len(self.parents) == 0:
             global geometries
-            geometries.remove(self)
+            geometries.discard(self)
 
 
 class Point(Geometry):
@@ -234,11 +467,52 @@ class Point(Geometry):
     def replacejwithi(self, i, j):
         pass
 
+    def removeparent(self, parent, shoulddestroy=True):
+        Geometry.removeparent(self, parent, shoulddestroy)
+        if shoulddestroy and len(self.parents) == 0:
+            global pointcoords
+            pointcoords.pop((self.x, self.y, self.z), None)
+
+
+def getObjectPoint(x, y, z):
+    # Return the Point already at this location and z-level, creating it if
+    # needed
+    global pointcoords
+    try:
+        return pointcoords[(x, y, z)]
+    except KeyError:
+        point = Point(x, y, z)
+        pointcoords[(x, y, z)] = point
+        return point
+
+
+def setupStorage():
+    # (Re)create the containers for the parsed elements
+    global geometries, features, pointcoords, nodetable, pointType, getPoint
+    geometries = ElementStore()
+    features = ElementStore()
+    pointcoords = {}
+    if options.compactStorage:
+        nodetable = NodeTable(getNewID, withz=True)
+        geometries.attach(NodeView, nodetable)
+        getPoint = nodetable.getpoint
+        pointType = NodeView
+    else:
+        nodetable = None
+        getPoint = getObjectPoint
+        pointType = Point
+
+
+setupStorage()
+
 
 class Way(Geometry):
     def __init__(self):
         Geometry.__init__(self)
-        self.points = []
+        if nodetable is None:
+            self.points = []
+        else:
+            self.points = nodetable.newway()
 
     def replacejwithi(self, i, j):
         self.points = map(lambda x: i if x == j else x, self.points)
@@ -260,6 +534,8 @@ class Relation(Geometry):
 class Feature(object):
     geometry = None
     tags = {}
+    # Identifies the source feature across runs, see assignStableIds()
+    key = None
 
     def __init__(self):
         global features
@@ -274,9 +550,11 @@ class Feature(object):
 
 def getzPoint():
     l.debug("getzPoint")
+    # Index the nodes by location and by the link ids in their Node_LID, so
+    # that each z-level record finds the road vertices it raises with a
+    # single lookup
     layer1 = nlayer
     lids = {}
-    jj = 0
     for i in range(layer1.GetFeatureCount()):
         ogrfeature1 = layer1.GetNextFeature()
         if ogrfeature1 is None:
@@ -285,6 +563,9 @@ def getzPoint():
         lid1 = ogrfeature1.GetFieldAsString("Node_LID")
         if lid1 == '':
             continue
+        ids = lid1.split("|")
+        if len(ids) < 2:
+            continue
         ogrgeometry1 = ogrfeature1.GetGeometryRef()
         geometryType1 = ogrgeometry1.GetGeometryType()
 
@@ -292,17 +573,25 @@ def getzPoint():
                     geometryType1 == ogr.wkbPoint25D):
             x1 = ogrgeometry1.GetX()
             y1 = ogrgeometry1.GetY()
-            lids[lid1] = (x1,y1)
+            lids.setdefault((x1, y1, ids[0]), []).append((ids[1], 0))
+            # A node whose ids are the same only raises the first vertex
+            if ids[1] != ids[0]:
+                lids.setdefault((x1, y1, ids[1]), []).append((ids[1], -1))
 
     layer = zlayer
+    badSequences = 0
     for i in range(layer.GetFeatureCount()):
         ogrfeature = layer.GetNextFeature()
         z = ogrfeature.GetFieldAsString("Z")
         if z == '1':
             id = ogrfeature.GetFieldAsString("ID")
             snum = ogrfeature.GetFieldAsString("Seq_Nm")
-            zpoints[jj] = id + "|" + snum
-            jj +=1
+            # A sequence number that is empty or not a number matches no
+            # vertex, but the record can still raise the ends of other roads
+            try:
+                zpoints.setdefault(id, set()).add(int(snum))
+            except ValueError:
+                badSequences += 1
 
             ogrgeometry = ogrfeature.GetGeometryRef()
             geometryType = ogrgeometry.GetGeometryType()
@@ -311,28 +600,49 @@ def getzPoint():
                         geometryType == ogr.wkbPoint25D):
                 x = ogrgeometry.GetX()
                 y = ogrgeometry.GetY()
+                for (roadid, seq) in lids.get((x, y, id), ()):
+                    zpoints.setdefault(roadid, set()).add(seq)
+    if badSequences:
+        l.warning("%d z-level records without a numeric Seq_Nm were skipped" % badSequences)
+    return zpoints
 
-            for (a, b) in lids.items():
-                ids = a.split("|")
-                if b == (x,y) and ids[0] == id:
-                    zpoints[jj] = ids[1]+'|0'
-                    jj += 1
 
-                elif b == (x,y) and ids[1] == id:
-                    zpoints[jj] = ids[1]+'|-1'
-                    jj += 1
-    return zpoints
+def getzSequences(strID, pointCount):
+    # The vertex indices of a road that are on z-level 1, with the last
+    # vertex (-1) resolved for a road of pointCount vertices
+    seqs = zpoints.get(strID)
+    if not seqs:
+        return ()
+    if -1 in seqs:
+        seqs = set(seqs)
+        seqs.discard(-1)
+        seqs.add(pointCount - 1)
+    return seqs
+
+def loadRoadData():
+    # z-levels, and the road names unless they are fetched per batch
+    with stats.phase("getzPoint"):
+        getzPoint()
+    if options.nameLookup == "preload":
+        l.debug("Loading road names")
+        with stats.phase("road names"):
+            roadNames.preload()
 
 def parseData():
     l.debug("Parsing data")
-    getzPoint()
+    loadRoadData()
     global translations
 
     rlayer.ResetReading()
-    parseLayer(translations.filterLayer(rlayer))
+    if stats.enabled:
+        stats.count("features read", rlayer.GetFeatureCount())
+    if options.jobs > 1:
+        parseLayerParallel(rlayer)
+    else:
+        parseLayer(translations.filterLayer(rlayer))
     conn.close()
 
-def getTransform(layer):
+def getSpatialRef(layer):
     global options
     # First check if the user supplied a projection, then check the layer,
     # then fall back to a default
@@ -349,23 +659,36 @@ def getTransform(layer):
             l.info("Detected projection metadata:\n" + str(spatialRef))
         else:
             l.info("No projection metadata, falling back to EPSG:4326")
+    return spatialRef
+
 
-    if spatialRef == None:
-        # No source proj specified yet? Then default to do no reprojection.
-        # Some python magic: skip reprojection altogether by using a dummy
-        # lamdba funcion. Otherwise, the lambda will be a call to the OGR
-        # reprojection stuff.
+def getTransform(layer):
+    coordTrans = transformCache.get(getSpatialRef(layer))
+    if coordTrans is None:
+        # No source projection, or already in EPSG:4326. Some python magic:
+        # skip reprojection altogether by using a dummy lamdba funcion.
+        # Otherwise, the lambda will be a call to the OGR reprojection stuff.
         reproject = lambda (geometry): None
     else:
-        destSpatialRef = osr.SpatialReference()
-        # Destionation projection will *always* be EPSG:4326, WGS84 lat-lon
-        destSpatialRef.ImportFromEPSG(4326)
-        coordTrans = osr.CoordinateTransformation(spatialRef, destSpatialRef)
         reproject = lambda (geometry): geometry.Transform(coordTrans)
-
     return reproject
 
 
+def getBatchTransformer(layer):
+    # With --batch-reproject, the BatchTransformer for the layer, or None if
+    # it needs no reprojection
+    if not options.batchReproject:
+        return None
+    spatialRef = getSpatialRef(layer)
+    coordTrans = transformCache.get(spatialRef)
+    if coordTrans is None:
+        return None
+    batcher = BatchTransformer(spatialRef, coordTrans, options.usePyproj)
+    if options.usePyproj and batcher.pyprojTransform is None:
+        l.warning("pyproj is not installed, reprojecting with OGR")
+    return batcher
+
+
 def getLayerFields(layer):
     featureDefinition = layer.GetLayerDefn()
     fieldNames = []
@@ -374,72 +697,179 @@ def getLayerFields(layer):
         fieldNames.append(featureDefinition.GetFieldDefn(j).GetNameRef())
     return fieldNames
 
-def getFeatureTags(ogrfeature):
-    tags = {}
-    strID = ogrfeature.GetFieldAsString("ID");
-    strDirection = ogrfeature.GetFieldAsString("Direction");
-    if strDirection == '0' or strDirection == '1':
-        tags['oneway'] = 'no'
-        tags['rDirection'] = 'no'
-    elif strDirection == '2':
-        tags['oneway'] = 'yes'
-        tags['rDirection'] = 'no'
-    elif strDirection == '3':
-        tags['oneway'] = 'yes'
-        tags['rDirection'] = 'yes'
-    else:
-        tags['oneway'] = 'no'
-        tags['rDirection'] = 'no'
-
-    cur = conn.cursor()
-    cur.execute(
-        "select PathName from r_lname left outer join r_name on r_lname.Route_ID= r_name.Route_ID where r_lname.ID = '%s' and r_name.Language ='1'" % strID)
-    rows = cur.fetchall()
-    if(len(rows) == 1):
-        tags['name'] = rows[0][0]
-
-    tags['id'] = strID
-    strKind = ogrfeature.GetFieldAsString("Kind").split("|")[0][0:2]
-    strKind2 = ogrfeature.GetFieldAsString("Kind").split("|")[0][2:4]
-
-    if strKind == "00" or strKind == '01':
-        tags['highway'] ="motorway"
-    elif strKind == "02":
-        tags['highway'] = "trunk"
-        if strKind2 == "0b":
-            tags['highway'] = "trunk_link"
-    elif strKind == "03":
-        tags['highway'] = "primary"
-        if strKind2 == "0b":
-            tags['highway'] = "primary_link"
-    elif strKind == "04":
-        tags['highway'] = "secondary"
-    elif strKind == "05":
-        tags['highway'] = "tertiary"
-    elif strKind == "06":
-        tags['highway'] = "unclassified"
-    elif strKind == "08":
-        tags['highway'] = "residential"
-    elif strKind == "0a":
-        tags['highway'] = "living_street"
-    elif strKind == "0b":
-        tags['highway'] = "service"
+def getTagMap(layerName, fieldNames):
+    # The tag mappings the translation declares for the layer, or else the
+    # NavInfo road ones, compiled for its fields
+    rules = layerRules(getattr(translations, "tagMappings", None), layerName)
+    if rules is None:
+        rules = ROAD_TAG_MAPPINGS
+    key = (layerName, tuple(fieldNames))
+    if key not in tagMaps:
+        tagMap = TagMap(rules, fieldNames)
+        if tagMap.missing:
+            l.warning("Layer %s has no field %s, its tag mappings are skipped" %
+                      (layerName, ", ".join(tagMap.missing)))
+        tagMaps[key] = tagMap
+    return tagMaps[key]
+
+
+def getTagCache(layerName, fieldNames, tagMap):
+    # With --tag-cache, the tag cache of the layer. It is keyed on the values
+    # of the mapped fields; the fields copied as is, like ID, differ for
+    # every road. A filterTags of the translation is given the copied fields
+    # too, so its tags are only cached for layers that copy none.
+    if options.tagCacheSize <= 0:
+        return None
+    key = (layerName, tuple(fieldNames))
+    if key not in tagCaches:
+        if "filterTags" in userHooks and tagMap.copies:
+            l.warning(("Not caching the tags of layer %s, its tag mappings copy " +
+                       "fields that differ for every feature") % layerName)
+            tagCaches[key] = None
+        else:
+            tagCaches[key] = TagCache(options.tagCacheSize)
+    return tagCaches[key]
 
+
+def tagCacheCounts():
+    # Hits, misses and evictions of all the tag caches, with the workers'
+    counts = list(workerTagCacheCounts)
+    for cache in tagCaches.values():
+        if cache is not None:
+            counts = [total + count for (total, count) in zip(counts, cache.counts())]
+    return counts
+
+
+def getFeatureTags(ogrfeature):
+    name = roadNames.get(ogrfeature.GetFieldAsString("ID"))
+    if layerTagCache is None:
+        return makeTags(layerTagMap.apply(ogrfeature), name)
+    values = layerTagMap.lookupValues(ogrfeature)
+    if "filterTags" in userHooks:
+        # The filterTags of the translation is given the name as well
+        values += (name,)
+        try:
+            return layerTagCache.get(values)
+        except KeyError:
+            return layerTagCache.add(values, makeTags(layerTagMap.fromLookupValues(values[:-1]),
+                                                      name))
+    # The default filterTags changes nothing, so only the tags of the mapped
+    # values are cached, and the copied fields and the name are added to them
+    try:
+        mapped = layerTagCache.get(values)
+    except KeyError:
+        mapped = layerTagCache.add(values, layerTagMap.fromLookupValues(values))
+    if not layerTagMap.copies and name is None:
+        return mapped
+    tags = layerTagMap.copyTags(ogrfeature)
+    tags.update(mapped)
+    if name is not None:
+        tags['name'] = name
+    return tags
+
+
+def isReversed(tags):
+    # One way roads drawn against their direction of travel are written
+    # the other way round. Translations need not keep these tags.
+    return (tags is not None and tags.get('oneway') == 'yes' and
+            tags.get('rDirection') == 'yes')
+
+
+def makeTags(tags, name):
+    if name is not None:
+        tags['name'] = name
     return translations.filterTags(tags)
 
 
-def parseLayer(layer):
+def countVertices():
+    return parsedVertices
+
+
+def newProgress(name, total, unit="features"):
+    if not reportProgress or not l.getLogger().isEnabledFor(l.INFO):
+        return NullProgress()
+    return Progress(name, total, countVertices, unit)
+
+
+def iterFeatures(layer):
+    # Read until GetNextFeature() runs out rather than GetFeatureCount()
+    # times, as filtered layers like StripLayer and CellLayer skip features
+    ogrfeature = layer.GetNextFeature()
+    while ogrfeature is not None:
+        yield ogrfeature
+        ogrfeature = layer.GetNextFeature()
+
+
+def readFeatures(layer):
+    # The features of the layer, read in Arrow record batches when asked to
+    # and possible. Translations that get the OGR features themselves are
+    # given real ones.
+    if (options.arrowReader and canReadArrow(layer) and
+        "filterFeature" not in userHooks and "filterFeaturePost" not in userHooks):
+        l.debug("Reading Arrow record batches")
+        return ArrowReader(layer)
+    return iterFeatures(layer)
+
+
+def parseLayer(layer, reproject=None):
+    global layerTagMap, layerTagCache
     l.debug("parseLayer")
     if layer is None:
         return
     fieldNames = getLayerFields(layer)
-    reproject = getTransform(layer)
-    nCount = 0
-    for j in range(layer.GetFeatureCount()):
-        ogrfeature = layer.GetNextFeature()
-        l.debug("parser feature %d",nCount)
-        nCount = nCount + 1
-        parseFeature(translations.filterFeature(ogrfeature, fieldNames, reproject), reproject)
+    layerTagMap = getTagMap(layer.GetName(), fieldNames)
+    layerTagCache = getTagCache(layer.GetName(), fieldNames, layerTagMap)
+    if reproject is None:
+        reproject = getTransform(layer)
+    batcher = getBatchTransformer(layer)
+    progress = newProgress(layer.GetName(), layer.GetFeatureCount())
+    count = 0
+    # Features are only held back to fetch the names of, or reproject, many
+    # at once; otherwise each is parsed as soon as it is read
+    batching = options.nameLookup == "batch" or batcher is not None
+    batch = []
+    for ogrfeature in readFeatures(layer):
+        count += 1
+        progress.update(count)
+        ogrfeature = translations.filterFeature(ogrfeature, fieldNames, reproject)
+        if not batching:
+            parseFeature(ogrfeature, reproject)
+            continue
+        batch.append(ogrfeature)
+        if len(batch) >= options.nameBatchSize:
+            parseFeatures(batch, reproject, batcher)
+            batch = []
+    parseFeatures(batch, reproject, batcher)
+    progress.finish(count)
+
+
+def parseFeatures(ogrfeatures, reproject, batcher=None):
+    # In batch mode, fetch the names of all the roads in the batch at once
+    if options.nameLookup == "batch":
+        roadNames.prefetch([ogrfeature.GetFieldAsString("ID")
+                            for ogrfeature in ogrfeatures if ogrfeature is not None])
+    if batcher is not None:
+        parseReprojectedFeatures(ogrfeatures, batcher)
+        return
+    for ogrfeature in ogrfeatures:
+        parseFeature(ogrfeature, reproject)
+
+
+def parseReprojectedFeatures(ogrfeatures, batcher):
+    # Reproject the vertices of all the features at once, then parse the
+    # features with getPoint looking up the reprojected coordinates
+    global getPoint
+    ogrfeatures = [ogrfeature for ogrfeature in ogrfeatures if ogrfeature is not None]
+    coordinates = batcher.transformGeometries(
+        [ogrfeature.GetGeometryRef() for ogrfeature in ogrfeatures
+         if ogrfeature.GetGeometryRef() is not None])
+    makePoint = getPoint
+    getPoint = lambda x, y, z: makePoint(*(coordinates[(x, y)] + (z,)))
+    try:
+        for ogrfeature in ogrfeatures:
+            parseFeature(ogrfeature, lambda (geometry): None)
+    finally:
+        getPoint = makePoint
 
 
 def parseFeature(ogrfeature, reproject):
@@ -457,9 +887,11 @@ def parseFeature(ogrfeature, reproject):
     feature = Feature()
     feature.geometry = geometry
     feature.tags = getFeatureTags(ogrfeature)
+    feature.key = ogrfeature.GetFieldAsString("ID")
     geometry.addparent(feature)
 
     translations.filterFeaturePost(feature, ogrfeature, ogrgeometry)
+    return feature
 
 
 def parseGeometry(ogrfeature, ogrgeometry):
@@ -491,29 +923,30 @@ def parseGeometry(ogrfeature, ogrgeometry):
 
 
 def parsePoint(ogrgeometry):
+    global parsedVertices
+    parsedVertices += 1
     x = ogrgeometry.GetX()
     y = ogrgeometry.GetY()
-    geometry = Point(x, y,0)
+    geometry = getPoint(x, y, 0)
     return geometry
 
 
 def parseLineString(ogrfeature,ogrgeometry):
+    global parsedVertices
     geometry = Way()
-    # LineString.GetPoint() returns a tuple, so we can't call parsePoint on it
-    # and instead have to create the point ourself
+    # Get all the vertices at once rather than with one GetPoint() call each,
+    # and create the points ourself
     # 增加一个z-index
     strID = ogrfeature.GetFieldAsString("ID");
+    vertices = linePoints(ogrgeometry)
+    parsedVertices += len(vertices)
+    zseqs = getzSequences(strID, len(vertices))
 
-    for i in range(ogrgeometry.GetPointCount()):
-        (x, y, unused) = ogrgeometry.GetPoint(i)
-
-        mypoint = Point(x, y, 0)
-        for (a,b) in zpoints.items():
-            ids = b.split("|");
-            if strID == ids[0] and str(i) == ids[1]:
-                mypoint = Point(x, y,1)
-            elif strID == ids[0] and ids[1] =='-1' and str(i) == ogrgeometry.GetPointCount()-1:
-                mypoint = Point(x, y, 1)
+    for (i, (x, y)) in enumerate(vertices):
+        if i in zseqs:
+            mypoint = getPoint(x, y, 1)
+        else:
+            mypoint = getPoint(x, y, 0)
         geometry.points.append(mypoint)
         mypoint.addparent(geometry)
     return geometry
@@ -544,6 +977,7 @@ def parsePolygon(ogrgeometry):
 
 
 def parseCollection(ogrfeature,ogrgeometry):
+    global parsedVertices
     # OGR MultiPolygon maps easily to osm multipolygon, so special case it
     # TODO: Does anything else need special casing?
     geometryType = ogrgeometry.GetGeometryType()
@@ -563,93 +997,399 @@ def parseCollection(ogrfeature,ogrgeometry):
         geometry = Way()
 
         strID = ogrfeature.GetFieldAsString("ID");
-        nCount = 0
+        # The parts share their end points, so only the first part
+        # contributes its first vertex
+        vertices = []
         for j in range(ogrgeometry.GetGeometryCount()):
-            for i in range(ogrgeometry.GetGeometryRef(j).GetPointCount()):
-                ogrgeometry2 = ogrgeometry.GetGeometryRef(j)
-                if j<>0 and i ==0:
-                    continue
-
-                (x, y, unused) = ogrgeometry2.GetPoint(i)
-
-                mypoint = Point(x, y, 0)
-                for (a, b) in zpoints.items():
-                    ids = b.split("|");
-                    if strID == ids[0] and str(nCount) == ids[1]:
-                        mypoint = Point(x, y, 1)
-                geometry.points.append(mypoint)
-                mypoint.addparent(geometry)
-                nCount += 1
+            partVertices = linePoints(ogrgeometry.GetGeometryRef(j))
+            if j == 0:
+                vertices.extend(partVertices)
+            else:
+                vertices.extend(partVertices[1:])
+        parsedVertices += len(vertices)
+        zseqs = getzSequences(strID, len(vertices))
+        for (nCount, (x, y)) in enumerate(vertices):
+            if nCount in zseqs:
+                mypoint = getPoint(x, y, 1)
+            else:
+                mypoint = getPoint(x, y, 0)
+            geometry.points.append(mypoint)
+            mypoint.addparent(geometry)
         return geometry
 
-def mergePoints():
-    l.debug("Merging points")
-    global geometries
-    points = [geometry for geometry in geometries if type(geometry) == Point]
 
-    # Make list of Points at each location
-    l.debug("Making list")
-    pointcoords = {}
-    for i in points:
-        try:
-            pointcoords[(i.x, i.y,i.z)].append(i)
-        except KeyError:
-            pointcoords[(i.x, i.y,i.z)] = [i]
+def parseLayerParallel(layer):
+    # Parse the partitions of the road layer in worker processes and merge
+    # the results
+    partitions = planPartitions(layer, options.jobs * 4, options.partitionMode)
+    l.debug("Parsing in %d partitions" % len(partitions))
+    progress = newProgress(layer.GetName(), len(partitions), "partitions")
+    for (done, (elements, hookProfile, cacheCounts)) in enumerate(
+            parallelMap(parsePartition, partitions, options.jobs)):
+        importElements(elements)
+        if hookProfile is not None:
+            hookProfiler.merge(hookProfile)
+        workerTagCacheCounts[:] = [total + count for (total, count)
+                                   in zip(workerTagCacheCounts, cacheCounts)]
+        progress.update(done + 1)
+    progress.finish(len(partitions))
+
+
+def parsePartition(partition):
+    # Runs in a worker process, with its own OGR handle, database connection
+    # and element storage. z-levels and preloaded road names are inherited
+    # from the parent process.
+    global reportProgress
+    reportProgress = False
+    setupStorage()
+    if hookProfiler is not None:
+        hookProfiler.reset()
+    # Counts inherited from the parent are not this worker's
+    for cache in tagCaches.values():
+        if cache is not None:
+            cache.resetCounts()
+    workerTagCacheCounts[:] = [0, 0, 0]
+    workerSource = ogr.Open(datasourceName)
+    if options.nameLookup == "batch":
+        roadNames.conn = psycopg2.connect(**dbParams)
+    layer = applyPartition(workerSource.GetLayerByName("r"), partition)
+    parseLayer(translations.filterLayer(layer))
+    if options.nameLookup == "batch":
+        roadNames.conn.close()
+    elements = exportElements()
+    setupStorage()
+    hookProfile = hookProfiler.export() if hookProfiler is not None else None
+    return (elements, hookProfile, tagCacheCounts())
+
+
+def exportElements():
+    # Flatten the parsed elements into plain lists that can be pickled, with
+    # references to other elements given as list indexes
+    nodes = []
+    nodeindex = {}
+    for node in geometries.oftype(pointType):
+        nodeindex[node] = len(nodes)
+        nodes.append((node.x, node.y, node.z))
+    ways = []
+    wayindex = {}
+    for way in geometries.oftype(Way):
+        wayindex[way] = len(ways)
+        ways.append([nodeindex[node] for node in way.points])
+    relationobjects = list(geometries.oftype(Relation))
+    relationindex = dict((relation, i) for (i, relation) in enumerate(relationobjects))
+
+    indexes = {pointType: ("node", nodeindex), Way: ("way", wayindex),
+               Relation: ("relation", relationindex)}
+    def reference(geometry):
+        (kind, index) = indexes[type(geometry)]
+        return (kind, index[geometry])
+
+    relations = [[reference(member) + (role,) for (member, role) in relation.members]
+                 for relation in relationobjects]
+    featurelist = [reference(feature.geometry) + (feature.tags, feature.key)
+                   for feature in features]
+    return (nodes, ways, relations, featurelist)
+
+
+def importElements(elements):
+    # Recreate the elements from exportElements(). Nodes are merged with the
+    # ones already at the same location and everything gets new ids.
+    global parsedVertices
+    (nodes, ways, relations, featurelist) = elements
+    parsedVertices += (sum(len(refs) for refs in ways) +
+                       sum(1 for feature in featurelist if feature[0] == "node"))
+    points = [getPoint(x, y, z) for (x, y, z) in nodes]
+    wayobjects = []
+    for refs in ways:
+        way = Way()
+        for i in refs:
+            point = points[i]
+            way.points.append(point)
+            point.addparent(way)
+        wayobjects.append(way)
+    relationobjects = [Relation() for members in relations]
+
+    geometrylists = {"node": points, "way": wayobjects, "relation": relationobjects}
+    for (relation, members) in zip(relationobjects, relations):
+        for (kind, i, role) in members:
+            member = geometrylists[kind][i]
+            member.addparent(relation)
+            relation.members.append((member, role))
+    for (kind, i, tags, key) in featurelist:
+        feature = Feature()
+        feature.tags = tags
+        feature.key = key
+        feature.geometry = geometrylists[kind][i]
+        feature.geometry.addparent(feature)
+
+
+def convertTiled():
+    # Parse and write the road layer one tile at a time
+    l.debug("Parsing data in tiles")
+    loadRoadData()
+    reproject = getTransform(rlayer)
+    grid = TileGrid(layersExtent([rlayer]), options.tileSize)
+    boundary = BoundaryIndex(grid)
+    with stats.phase("boundary scan"):
+        boundary.scan(rlayer, reproject)
+    l.debug("%d tiles, %d vertices on tile boundaries" % (len(grid), len(boundary)))
+
+    global reportProgress
+    w = openOutputWriter()
+    spool = Spool()
+    progress = newProgress("tiles", len(grid), "tiles")
+    reportProgress = False
+    for cell in range(len(grid)):
+        progress.update(cell + 1)
+        setupStorage()
+        with stats.phase("parseData"):
+            parseLayer(translations.filterLayer(CellLayer(rlayer, grid, cell)), reproject)
+        countElements()
+        with stats.phase("output"):
+            writeElements(w, spool, boundary)
+    reportProgress = True
+    progress.finish(len(grid))
+    rlayer.SetSpatialFilter(None)
+    conn.close()
+    setupStorage()
+    with stats.phase("output"):
+        spool.replay(w)
+        w.close()
+
+
+def convertIncremental():
+    # Parse the roads that changed since the run recorded in the state
+    # database, and write the changes
+    global layerTagMap, layerTagCache
+    l.debug("Parsing changed roads")
+    loadRoadData()
+    state = ConversionState(options.stateFile)
+    layer = translations.filterLayer(rlayer)
+    fieldNames = getLayerFields(layer)
+    layerTagMap = getTagMap(layer.GetName(), fieldNames)
+    layerTagCache = getTagCache(layer.GetName(), fieldNames, layerTagMap)
+    reproject = getTransform(layer)
+    roads = []
+    batch = []
+    layer.ResetReading()
+    if stats.enabled:
+        stats.count("features read", layer.GetFeatureCount())
+    progress = newProgress(layer.GetName(), layer.GetFeatureCount())
+    with stats.phase("parseData"):
+        for j in range(layer.GetFeatureCount()):
+            progress.update(j + 1)
+            ogrfeature = translations.filterFeature(layer.GetNextFeature(), fieldNames, reproject)
+            if ogrfeature is not None:
+                batch.append(ogrfeature)
+            if len(batch) >= options.nameBatchSize:
+                roads.extend(parseChangedFeatures(state, batch, reproject))
+                batch = []
+        roads.extend(parseChangedFeatures(state, batch, reproject))
+    progress.finish(layer.GetFeatureCount())
+    conn.close()
 
-    # Use list to get rid of extras
-    l.debug("Checking list")
-    for (location, pointsatloc) in pointcoords.items():
-        if len(pointsatloc) > 1:
-            for point in pointsatloc[1:]:
-                for parent in set(point.parents):
-                    parent.replacejwithi(pointsatloc[0], point)
+    with stats.phase("state update"):
+        changes = state.update(roads)
+    l.info("%d roads created, %d modified, %d deleted" %
+           (len(changes.createdWays), len(changes.modifiedWays), len(changes.deletedWays)))
+    stats.count("roads changed", len(roads))
+    # The run is only recorded once its changes are written, otherwise the
+    # next run would diff against changes that were never published
+    try:
+        with stats.phase("output"):
+            writeChanges(changes, state.run)
+    except:
+        state.abort()
+        raise
+    state.close()
 
 
-def output():
-    l.debug("Outputting XML")
+def getFeatureHash(strID, ogrfeature):
+    # Fingerprint of everything a road is converted from: its fields and
+    # geometry, its name and its z-levels
+    values = [ogrfeature.GetFieldAsString(i) for i in range(ogrfeature.GetFieldCount())]
+    ogrgeometry = ogrfeature.GetGeometryRef()
+    if ogrgeometry is not None:
+        values.append(ogrgeometry.ExportToWkb())
+    values.append(roadNames.get(strID) or "")
+    values.append(" ".join(map(str, sorted(zpoints.get(strID, ())))))
+    return fingerprint(values)
+
+
+def parseChangedFeatures(state, ogrfeatures, reproject):
+    # Parse the roads that are new or changed since the previous run and
+    # return them as (key, hash, tags, locations) for ConversionState.update()
+    keys = [ogrfeature.GetFieldAsString("ID") for ogrfeature in ogrfeatures]
+    if options.nameLookup == "batch":
+        roadNames.prefetch(keys)
+    hashes = state.hashes(keys)
+    seen = []
+    roads = []
+    for (key, ogrfeature) in zip(keys, ogrfeatures):
+        # Hash before parsing, which reprojects the geometry
+        hash = getFeatureHash(key, ogrfeature)
+        if hashes.get(key) == hash:
+            seen.append(key)
+            continue
+        feature = parseFeature(ogrfeature, reproject)
+        if feature is None:
+            continue
+        if not isinstance(feature.geometry, Way):
+            l.warning("road %s is not a line, skipped" % key)
+            continue
+        tags = feature.tags
+        points = list(feature.geometry.points)
+        if isReversed(tags):
+            points.reverse()
+        roads.append((key, hash, tags, [(point.x, point.y, point.z) for point in points]))
+        seen.append(key)
+    state.markseen(seen)
+    setupStorage()
+    return roads
+
+
+def writeChanges(changes, run):
+    if run == 1:
+        # Nothing to compare with yet, so write all the roads
+        w = openOutputWriter()
+        for (id, x, y) in changes.createdNodes:
+            w.node(id, x, y, None)
+        for (id, refs, tags) in changes.createdWays:
+            w.way(id, refs, tags)
+        w.close()
+        return
+
+    w = stats.wrapWriter(OscWriter(openOutput(options.outputFile, options.compressThreads), run))
+    if changes.createdNodes or changes.createdWays:
+        w.action("create")
+        for (id, x, y) in changes.createdNodes:
+            w.node(id, x, y, None)
+        for (id, refs, tags) in changes.createdWays:
+            w.way(id, refs, tags)
+    if changes.modifiedWays:
+        w.action("modify")
+        for (id, refs, tags) in changes.modifiedWays:
+            w.way(id, refs, tags)
+    for id in changes.deletedWays:
+        w.delete("way", id)
+    for id in changes.deletedNodes:
+        w.delete("node", id)
+    w.close()
+
+
+def openOutputWriter():
+    return stats.wrapWriter(openWriter(openOutput(options.outputFile, options.compressThreads),
+                                       options.outputFormat, blocksize=options.pbfBlockSize))
+
+
+def countElements():
+    # Counters for --stats, taken from the parsed elements. Every vertex
+    # of a way or point feature that got a node made before counts as merged.
+    if not stats.enabled:
+        return
+    nodes = sum(1 for node in geometries.oftype(pointType))
+    vertices = sum(len(way.points) for way in geometries.oftype(Way))
+    vertices += sum(1 for feature in features if isinstance(feature.geometry, pointType))
+    stats.count("features", len(features))
+    stats.count("vertices", vertices)
+    stats.count("nodes", nodes)
+    stats.count("nodes merged", vertices - nodes)
+    stats.count("ways", sum(1 for way in geometries.oftype(Way)))
+    stats.count("relations", sum(1 for relation in geometries.oftype(Relation)))
+
+
+def assignStableIds():
+    # Give the elements the ids recorded for them in previous runs. Ways and
+    # relations are keyed by the feature they belong to, relation members by
+    # their position in the relation, and nodes by their location.
+    keys = {}
+    def addkeys(geometry, key):
+        keys[geometry] = key
+        if isinstance(geometry, Relation):
+            for (i, (member, role)) in enumerate(geometry.members):
+                if member not in keys:
+                    addkeys(member, "%s/%d" % (key, i))
+    for feature in features:
+        if feature.key is not None:
+            addkeys(feature.geometry, feature.key)
+
+    nodes = list(geometries.oftype(pointType))
+    ids = idAllocator.assign("node", ["%r %r %d" % (node.x, node.y, node.z) for node in nodes])
+    for (node, id) in zip(nodes, ids):
+        node.id = id
+    for (kind, elementtype) in (("way", Way), ("relation", Relation)):
+        elements = []
+        for element in geometries.oftype(elementtype):
+            if element in keys:
+                elements.append(element)
+            else:
+                element.id = idAllocator.newid()
+        ids = idAllocator.assign(kind, [keys[element] for element in elements])
+        for (element, id) in zip(elements, ids):
+            element.id = id
+
+
+def writeElements(nodeWriter, wayWriter, boundary=None):
+    # Nodes go to nodeWriter, ways and relations to wayWriter. With a
+    # boundary index, nodes shared with a tile written before are skipped.
+    if idAllocator is not None:
+        assignStableIds()
     # First, set up a few data structures for optimization purposes
     global geometries, features
-    nodes = [geometry for geometry in geometries if type(geometry) == Point]
-    ways = [geometry for geometry in geometries if type(geometry) == Way]
-    relations = [geometry for geometry in geometries if type(geometry) == Relation]
+    nodes = geometries.oftype(pointType)
+    ways = geometries.oftype(Way)
+    relations = geometries.oftype(Relation)
     featuresmap = {feature.geometry: feature for feature in features}
 
-    w = XMLWriter(open(options.outputFile, 'w'))
-    w.start("osm", version='0.6', generator='uvmogr2osm')
-
     for node in nodes:
-        w.start("node", visible="true", id=str(node.id), lat=str(node.y), lon=str(node.x))
-        if node in featuresmap:
-            for (key, value) in featuresmap[node].tags.items():
-                w.element("tag", k=key, v=value)
-        w.end("node")
+        if boundary is not None and not boundary.stitch(node, (node.x, node.y, node.z)):
+            continue
+        tags = featuresmap[node].tags if node in featuresmap else None
+        nodeWriter.node(node.id, node.x, node.y, tags)
 
     for way in ways:
-        w.start("way", visible="true", id=str(way.id))
-        if way in featuresmap:
-            if featuresmap[way].tags['oneway'] == 'yes' and featuresmap[way].tags['rDirection'] == 'yes':
-                way.points.reverse()
-        for node in way.points:
-            w.element("nd", ref=str(node.id))
-        if way in featuresmap:
-            for (key, value) in featuresmap[way].tags.items():
-                w.element("tag", k=key, v=value)
-        w.end("way")
+        tags = featuresmap[way].tags if way in featuresmap else None
+        if isReversed(tags):
+            way.points.reverse()
+        wayWriter.way(way.id, [node.id for node in way.points], tags)
 
     for relation in relations:
-        w.start("relation", visible="true", id=str(relation.id))
-        for (member, role) in relation.members:
-            w.element("member", type="way", ref=str(member.id), role=role)
-        if relation in featuresmap:
-            for (key, value) in featuresmap[relation].tags.items():
-                w.element("tag", k=key, v=value)
-        w.end("relation")
+        tags = featuresmap[relation].tags if relation in featuresmap else None
+        members = [("way", member.id, role) for (member, role) in relation.members]
+        wayWriter.relation(relation.id, members, tags)
 
-    w.end("osm")
+
+def output():
+    l.debug("Outputting " + options.outputFormat)
+    w = openOutputWriter()
+    writeElements(w, w)
+    w.close()
 
 
 # Main flow
-parseData()
-mergePoints()
-translations.preOutputTransform(geometries, features)
-output()
\ No newline at end of file
+if options.stateFile is not None:
+    convertIncremental()
+elif options.tileSize:
+    convertTiled()
+else:
+    with stats.phase("parseData"):
+        parseData()
+    countElements()
+    with stats.phase("preOutputTransform"):
+        translations.preOutputTransform(geometries, features)
+    with stats.phase("output"):
+        output()
+if idAllocator is not None:
+    idAllocator.close()
+if options.tagCacheSize > 0:
+    (hits, misses, evictions) = tagCacheCounts()
+    l.info("Tag cache: %d hits, %d misses, %d evicted" % (hits, misses, evictions))
+    stats.count("tag cache hits", hits)
+    stats.count("tag cache misses", misses)
+    stats.count("tag cache evictions", evictions)
+if hookProfiler is not None:
+    for line in hookProfiler.summary():
+        l.info(line)
+    stats.section("hooks", hookProfiler.report())
+if options.statsFile is not None:
+    stats.write(options.statsFile)
\ No newline at end of file
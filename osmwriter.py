@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+""" Output writers for ogr2osm
+
+output() walks the nodes, ways and relations once and hands each of them to a
+writer, which serialises it in one of the supported formats. All writers have
+the same interface:
+
+    writer.node(id, x, y, tags)
+    writer.way(id, refs, tags)
+    writer.relation(id, members, tags)    # members are (type, ref, role)
+    writer.close()
+
+tags may be None for untagged elements.
+
+XmlWriter formats each element with a single template and writes the output
+in large chunks. By default it writes UTF-8 with an XML declaration; strings
+are expected to be unicode or UTF-8 encoded. With encoding="us-ascii" it writes
+non-ASCII characters as numeric entities instead, exactly like SimpleXmlWriter.
+
+OscWriter writes an osmChange file with the same templates. Elements go to
+the section last opened with action("create"), action("modify") or
+action("delete"); delete(type, id) writes the id of a deleted element.
+
+SimpleXmlWriter is the previous implementation on top of SimpleXMLWriter, one
+call per element, tag and node reference. It is kept as the reference the fast
+writer is checked and benchmarked against; in us-ascii mode both produce
+byte-identical output.
+"""
+
+import os
+import re
+
+from SimpleXMLWriter import XMLWriter, escape_attrib
+from compressedoutput import stripCompression
+from pbfwriter import PbfWriter
+from o5mwriter import O5mWriter
+
+FORMATS = ('xml', 'pbf', 'o5m')
+EXTENSIONS = {'xml': '.osm', 'pbf': '.osm.pbf', 'o5m': '.o5m', 'osc': '.osc'}
+
+
+def formatFromFilename(filename):
+    (root, ext) = os.path.splitext(stripCompression(filename))
+    if ext == '.pbf':
+        return 'pbf'
+    elif ext == '.o5m':
+        return 'o5m'
+    return 'xml'
+
+
+def openWriter(fileobj, format='xml', blocksize=8000):
+    if format == 'pbf':
+        return PbfWriter(fileobj, blocksize=blocksize)
+    elif format == 'o5m':
+        return O5mWriter(fileobj)
+    return XmlWriter(fileobj)
+
+
+# Characters that need escaping in an attribute value, and in us-ascii mode
+# the ones that need encoding as well
+_markup = re.compile(r'[&<>"\']')
+_special = re.compile(r'[&<>"\'\x80-\xff]')
+
+
+class XmlWriter(object):
+    root = "osm"
+
+    def __init__(self, fileobj, encoding="utf-8", chunksize=1 << 20):
+        self.file = fileobj
+        self.encoding = encoding
+        self.chunksize = chunksize
+        self.chunk = []
+        self.chunklength = 0
+        # Written after the id of every element
+        self.attributes = ' visible="true"'
+        if encoding == "utf-8":
+            self.escape = self.escapeutf8
+            self.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        self.write('<%s generator="uvmogr2osm" version="0.6">' % self.root)
+
+    def write(self, data):
+        self.chunk.append(data)
+        self.chunklength += len(data)
+        if self.chunklength >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+        self.file.write(''.join(self.chunk))
+        self.chunk = []
+        self.chunklength = 0
+
+    def escape(self, s):
+        if type(s) is str and _special.search(s) is None:
+            return s
+        return escape_attrib(s, self.encoding)
+
+    def escapeutf8(self, s):
+        if type(s) is unicode:
+            s = s.encode("utf-8")
+        if _markup.search(s) is None:
+            return s
+        s = s.replace("&", "&amp;")
+        s = s.replace("'", "&apos;")
+        s = s.replace("\"", "&quot;")
+        s = s.replace("<", "&lt;")
+        return s.replace(">", "&gt;")
+
+    def tags(self, tags):
+        escape = self.escape
+        return ''.join(['<tag k="%s" v="%s" />' % (escape(key), escape(value))
+                        for (key, value) in tags.items()])
+
+    def node(self, id, x, y, tags):
+        if tags:
+            self.write('<node id="%s" lat="%s" lon="%s"%s>%s</node>'
+                       % (id, y, x, self.attributes, self.tags(tags)))
+        else:
+            self.write('<node id="%s" lat="%s" lon="%s"%s />'
+                       % (id, y, x, self.attributes))
+
+    def way(self, id, refs, tags):
+        if refs or tags:
+            self.write('<way id="%s"%s>%s%s</way>'
+                       % (id, self.attributes,
+                          ''.join(['<nd ref="%s" />' % ref for ref in refs]),
+                          self.tags(tags) if tags else ''))
+        else:
+            self.write('<way id="%s"%s />' % (id, self.attributes))
+
+    def relation(self, id, members, tags):
+        escape = self.escape
+        if members or tags:
+            self.write('<relation id="%s"%s>%s%s</relation>'
+                       % (id, self.attributes,
+                          ''.join(['<member ref="%s" role="%s" type="%s" />'
+                                   % (ref, escape(role), membertype)
+                                   for (membertype, ref, role) in members]),
+                          self.tags(tags) if tags else ''))
+        else:
+            self.write('<relation id="%s"%s />' % (id, self.attributes))
+
+    def close(self):
+        self.write('</%s>' % self.root)
+        self.flush()
+        self.file.close()
+
+
+class OscWriter(XmlWriter):
+    root = "osmChange"
+
+    def __init__(self, fileobj, version, encoding="utf-8", chunksize=1 << 20):
+        XmlWriter.__init__(self, fileobj, encoding, chunksize)
+        # The version makes the changed elements replace the ones of the
+        # previous run when the change is applied
+        self.attributes = ' version="%d"' % version
+        self.current = None
+
+    def action(self, action):
+        if action != self.current:
+            if self.current is not None:
+                self.write('</%s>' % self.current)
+            self.write('<%s>' % action)
+            self.current = action
+
+    def delete(self, elementtype, id):
+        self.action("delete")
+        self.write('<%s id="%s"%s />' % (elementtype, id, self.attributes))
+
+    def close(self):
+        if self.current is not None:
+            self.write('</%s>' % self.current)
+        XmlWriter.close(self)
+
+
+class SimpleXmlWriter(object):
+    def __init__(self, fileobj):
+        self.file = fileobj
+        self.w = XMLWriter(fileobj)
+        self.w.start("osm", version='0.6', generator='uvmogr2osm')
+
+    def tags(self, tags):
+        if tags:
+            for (key, value) in tags.items():
+                self.w.element("tag", k=key, v=value)
+
+    def node(self, id, x, y, tags):
+        self.w.start("node", visible="true", id=str(id), lat=str(y), lon=str(x))
+        self.tags(tags)
+        self.w.end("node")
+
+    def way(self, id, refs, tags):
+        self.w.start("way", visible="true", id=str(id))
+        for ref in refs:
+            self.w.element("nd", ref=str(ref))
+        self.tags(tags)
+        self.w.end("way")
+
+    def relation(self, id, members, tags):
+        self.w.start("relation", visible="true", id=str(id))
+        for (membertype, ref, role) in members:
+            self.w.element("member", type=membertype, ref=str(ref), role=role)
+        self.tags(tags)
+        self.w.end("relation")
+
+    def close(self):
+        self.w.end("osm")
+        self.file.close()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+""" Multi-process parsing helpers for ogr2osm
+
+With --jobs N a layer is cut into partitions that worker processes parse with
+their own OGR handle. A partition is either a range of FIDs or a vertical strip
+of the layer extent. The workers send back their elements as plain lists (see
+exportElements() in the scripts) and the parent merges them, which assigns the
+final ids and merges nodes shared between partitions.
+
+Partitions are described by ("fid", (first, end)) or ("tile", (minx, maxx,
+last)) tuples so they can be sent to the workers, and applied to a freshly
+opened layer with applyPartition().
+"""
+
+import multiprocessing
+from array import array
+
+PARTITION_MODES = ('fid', 'tile')
+
+
+def planPartitions(layer, count, mode='fid'):
+    if mode == 'tile':
+        return tilePartitions(layer, count)
+    return fidPartitions(layer, count)
+
+
+def fidPartitions(layer, count):
+    # Cut the FIDs of the layer into ranges holding about the same number
+    # of features. Only the FIDs are read, geometries and fields are skipped.
+    featureDefinition = layer.GetLayerDefn()
+    ignored = [featureDefinition.GetFieldDefn(j).GetNameRef()
+               for j in range(featureDefinition.GetFieldCount())]
+    layer.SetIgnoredFields(ignored + ['OGR_GEOMETRY', 'OGR_STYLE'])
+    layer.ResetReading()
+    fids = array('l')
+    ogrfeature = layer.GetNextFeature()
+    while ogrfeature is not None:
+        fids.append(ogrfeature.GetFID())
+        ogrfeature = layer.GetNextFeature()
+    layer.SetIgnoredFields([])
+    layer.ResetReading()
+    if len(fids) == 0:
+        return []
+
+    fids = sorted(fids)
+    count = max(1, min(count, len(fids)))
+    bounds = [fids[(len(fids) * i) // count] for i in range(count)]
+    bounds.append(fids[-1] + 1)
+    partitions = []
+    for i in range(count):
+        if bounds[i] < bounds[i + 1]:
+            partitions.append(('fid', (bounds[i], bounds[i + 1])))
+    return partitions
+
+
+def tilePartitions(layer, count):
+    (minx, maxx, miny, maxy) = layer.GetExtent()
+    width = (maxx - minx) / count
+    # Each edge is computed once and shared by the strips on both sides of
+    # it, so that no x falls between two strips or in both
+    edges = [minx + i * width for i in range(count)] + [maxx]
+    return [('tile', (edges[i], edges[i + 1], i == count - 1)) for i in range(count)]
+
+
+def fidColumn(layer):
+    # Drivers like PostgreSQL pass attribute filters on to the database, which
+    # knows the FID by the name of its column; FID is the OGR SQL name for
+    # layers that have no such column, like shapefiles
+    name = layer.GetFIDColumn()
+    if not name:
+        return "FID"
+    return '"%s"' % name.replace('"', '""')
+
+
+def applyPartition(layer, partition):
+    (mode, bounds) = partition
+    if mode == 'tile':
+        (minx, maxx, last) = bounds
+        (unused, unused, miny, maxy) = layer.GetExtent()
+        layer.SetSpatialFilterRect(minx, miny, maxx, maxy)
+        layer.ResetReading()
+        return StripLayer(layer, minx, maxx, last)
+    (first, end) = bounds
+    column = fidColumn(layer)
+    layer.SetAttributeFilter("%s >= %d AND %s < %d" % (column, first, column, end))
+    layer.ResetReading()
+    return layer
+
+
+class StripLayer(object):
+    # A layer filtered on a strip of its extent. Features crossing several
+    # strips are returned by all of them, so only keep those whose envelope
+    # starts in this strip.
+    def __init__(self, layer, minx, maxx, last):
+        self.layer = layer
+        self.minx = minx
+        self.maxx = maxx
+        self.last = last
+
+    def __getattr__(self, name):
+        return getattr(self.layer, name)
+
+    def GetNextFeature(self):
+        while True:
+            ogrfeature = self.layer.GetNextFeature()
+            if ogrfeature is None:
+                return None
+            ogrgeometry = ogrfeature.GetGeometryRef()
+            if ogrgeometry is None:
+                return ogrfeature
+            west = ogrgeometry.GetEnvelope()[0]
+            if west >= self.minx and (west < self.maxx or self.last):
+                return ogrfeature
+
+
+def parallelMap(function, partitions, jobs):
+    # Run function on every partition in a pool of worker processes and
+    # yield the results in partition order. The workers are forked, so they
+    # start with the state of the calling process.
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(function, partitions):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+""" Cache of parsed datasets for ogr2osm
+
+Reading and parsing a large source takes most of the run time, which gets in
+the way when working on a translation's preOutputTransform() or on the output
+options. With --cache-dir the parsed elements, as returned by
+exportElements(), are stored in a marshal file after parsing and loaded instead
+of the source on the next run.
+
+A cache file is only used when its key matches. The key covers the source
+file and its sidecar files (path, size and modification time), the projection
+options, the translation source and CACHE_VERSION, which is bumped whenever the
+layout of the cached data changes.
+"""
+
+import hashlib
+import marshal
+import os
+
+CACHE_VERSION = 1
+MAGIC = "ogr2osm-cache"
+
+
+def sourceFiles(sourceFile):
+    # The file itself and the ones sharing its base name, e.g. the .dbf and
+    # .prj of a shapefile
+    (root, ext) = os.path.splitext(sourceFile)
+    directory = os.path.dirname(sourceFile)
+    prefix = os.path.basename(root) + "."
+    files = [os.path.join(directory, name) for name in os.listdir(directory or ".")
+             if name.startswith(prefix)]
+    return sorted(set(files + [sourceFile]))
+
+
+def moduleSource(module):
+    # Source of a translation module, or None for the default translations
+    filename = getattr(module, "__file__", None)
+    if filename is None:
+        return None
+    (root, ext) = os.path.splitext(filename)
+    if ext in (".pyc", ".pyo") and os.path.exists(root + ".py"):
+        filename = root + ".py"
+    f = open(filename, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def cacheKey(sourceFile, settings, translation):
+    # settings are the options that change the parsed data, as (name, value)
+    h = hashlib.sha1()
+    h.update("%s %d\0" % (MAGIC, CACHE_VERSION))
+    for filename in sourceFiles(sourceFile):
+        if os.path.isfile(filename):
+            st = os.stat(filename)
+            h.update("%s %d %r\0" % (filename, st.st_size, st.st_mtime))
+    for (name, value) in settings:
+        h.update("%s=%r\0" % (name, value))
+    source = moduleSource(translation)
+    h.update(hashlib.sha1(source).hexdigest() if source is not None else "default")
+    return h.hexdigest()
+
+
+def cachePath(cacheDir, key):
+    return os.path.join(cacheDir, key + ".cache")
+
+
+def readCache(path):
+    # The cached data, or None if there is no usable cache file
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return None
+    try:
+        try:
+            (magic, version, data) = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return None
+    finally:
+        f.close()
+    if magic != MAGIC or version != CACHE_VERSION:
+        return None
+    return data
+
+
+def writeCache(path, data):
+    # Written under a temporary name first, so an interrupted run does not
+    # leave a truncated cache file behind
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary = path + ".%d.tmp" % os.getpid()
+    f = open(temporary, "wb")
+    try:
+        marshal.dump((MAGIC, CACHE_VERSION, data), f, 2)
+    finally:
+        f.close()
+    os.rename(temporary, path)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+""" OSM PBF writer for ogr2osm
+
+Writes the OSM PBF format (http://wiki.openstreetmap.org/wiki/PBF_Format)
+without depending on the protobuf library: the handful of messages needed are
+encoded by hand.
+
+Nodes are written as DenseNodes with delta coded ids and coordinates. Every
+primitive block has its own string table and holds at most `blocksize`
+elements of one type. Blocks are zlib compressed.
+"""
+
+import struct
+import zlib
+
+INT64_MASK = 0xffffffffffffffff
+MEMBER_TYPES = {'node': 0, 'way': 1, 'relation': 2}
+
+
+def writevarint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def writekey(out, field, wiretype):
+    writevarint(out, (field << 3) | wiretype)
+
+
+def writeint(out, field, n):
+    writekey(out, field, 0)
+    writevarint(out, n & INT64_MASK)
+
+
+def writebytes(out, field, data):
+    writekey(out, field, 2)
+    writevarint(out, len(data))
+    out.extend(data)
+
+
+def tobytes(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+class StringTable(object):
+    def __init__(self):
+        self.strings = ['']
+        self.index = {'': 0}
+
+    def __call__(self, s):
+        try:
+            return self.index[s]
+        except KeyError:
+            i = len(self.strings)
+            self.strings.append(tobytes(s))
+            self.index[s] = i
+            return i
+
+    def encode(self):
+        out = bytearray()
+        for s in self.strings:
+            writebytes(out, 1, s)
+        return out
+
+
+class PbfWriter(object):
+    def __init__(self, fileobj, blocksize=8000, compresslevel=6,
+                 generator='ogr2osm'):
+        self.file = fileobj
+        self.blocksize = blocksize
+        self.compresslevel = compresslevel
+        self.kind = None
+        self.pending = []
+
+        header = bytearray()
+        writebytes(header, 4, 'OsmSchema-V0.6')
+        writebytes(header, 4, 'DenseNodes')
+        writebytes(header, 16, generator)
+        self.writeblob('OSMHeader', header)
+
+    def node(self, id, x, y, tags):
+        self.add('node', (id, x, y, tags))
+
+    def way(self, id, refs, tags):
+        self.add('way', (id, refs, tags))
+
+    def relation(self, id, members, tags):
+        self.add('relation', (id, members, tags))
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def add(self, kind, element):
+        if kind != self.kind:
+            self.flush()
+            self.kind = kind
+        self.pending.append(element)
+        if len(self.pending) >= self.blocksize:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        strings = StringTable()
+        if self.kind == 'node':
+            group = self.densenodes(self.pending, strings)
+        elif self.kind == 'way':
+            group = self.ways(self.pending, strings)
+        else:
+            group = self.relations(self.pending, strings)
+        self.pending = []
+
+        block = bytearray()
+        writebytes(block, 1, strings.encode())
+        writebytes(block, 2, group)
+        self.writeblob('OSMData', block)
+
+    def writeblob(self, blobtype, data):
+        data = bytes(data)
+        blob = bytearray()
+        writeint(blob, 2, len(data))
+        writebytes(blob, 3, zlib.compress(data, self.compresslevel))
+        header = bytearray()
+        writebytes(header, 1, blobtype)
+        writeint(header, 3, len(blob))
+        self.file.write(struct.pack('>I', len(header)))
+        self.file.write(bytes(header))
+        self.file.write(bytes(blob))
+
+    def densenodes(self, nodes, strings):
+        ids = bytearray()
+        lats = bytearray()
+        lons = bytearray()
+        keysvals = bytearray()
+        lastid = lastlat = lastlon = 0
+        for (id, x, y, tags) in nodes:
+            lat = int(round(y * 10000000))
+            lon = int(round(x * 10000000))
+            writevarint(ids, zigzag(id - lastid))
+            writevarint(lats, zigzag(lat - lastlat))
+            writevarint(lons, zigzag(lon - lastlon))
+            (lastid, lastlat, lastlon) = (id, lat, lon)
+            if tags:
+                for (key, value) in tags.items():
+                    writevarint(keysvals, strings(key))
+                    writevarint(keysvals, strings(value))
+            keysvals.append(0)
+
+        dense = bytearray()
+        writebytes(dense, 1, ids)
+        writebytes(dense, 8, lats)
+        writebytes(dense, 9, lons)
+        writebytes(dense, 10, keysvals)
+        group = bytearray()
+        writebytes(group, 2, dense)
+        return group
+
+    def tags(self, out, tags, strings):
+        if not tags:
+            return
+        keys = bytearray()
+        vals = bytearray()
+        for (key, value) in tags.items():
+            writevarint(keys, strings(key))
+            writevarint(vals, strings(value))
+        writebytes(out, 2, keys)
+        writebytes(out, 3, vals)
+
+    def ways(self, ways, strings):
+        group = bytearray()
+        for (id, refs, tags) in ways:
+            way = bytearray()
+            writeint(way, 1, id)
+            self.tags(way, tags, strings)
+            packed = bytearray()
+            last = 0
+            for ref in refs:
+                writevarint(packed, zigzag(ref - last))
+                last = ref
+            writebytes(way, 8, packed)
+            writebytes(group, 3, way)
+        return group
+
+    def relations(self, relations, strings):
+        group = bytearray()
+        for (id, members, tags) in relations:
+            relation = bytearray()
+            writeint(relation, 1, id)
+            self.tags(relation, tags, strings)
+            roles = bytearray()
+            memids = bytearray()
+            types = bytearray()
+            last = 0
+            for (membertype, ref, role) in members:
+                writevarint(roles, strings(role))
+                writevarint(memids, zigzag(ref - last))
+                last = ref
+                writevarint(types, MEMBER_TYPES[membertype])
+            writebytes(relation, 8, roles)
+            writebytes(relation, 9, memids)
+            writebytes(relation, 10, types)
+            writebytes(group, 4, relation)
+        return group
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+""" Progress reporting for ogr2osm
+
+Progress tells how far the parsing of a layer got: the features done out of
+the feature count of the layer, features/s, vertices/s and the time left at
+the current rate. It replaces logging a line per feature, which costs real
+time on layers of millions of features. The scripts count the vertices once
+per geometry, from the vertex lists they parse anyway.
+
+update() is called for every feature but only looks at the clock every so
+many features, a number sized from the rate so that it happens a few times
+per report. Reports are made at most every interval seconds: on a terminal
+by rewriting a single status line four times a second, otherwise as an INFO
+log line every ten seconds.
+
+NullProgress does nothing. The scripts use it when logging less than INFO
+and where another loop reports the progress, like the tiles of --tile-size.
+"""
+
+import logging
+import sys
+import time
+
+# Seconds between reports on a terminal, and in a log
+TERMINAL_INTERVAL = 0.25
+LOG_INTERVAL = 10.0
+
+
+def formatDuration(seconds):
+    (minutes, seconds) = divmod(int(seconds), 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+class Progress(object):
+    def __init__(self, name, total, vertices=None, unit="features", stream=sys.stderr):
+        # vertices is a function giving the number of vertices parsed so far
+        self.name = name
+        self.total = total
+        self.vertices = vertices
+        self.unit = unit
+        if hasattr(stream, "isatty") and stream.isatty():
+            self.stream = stream
+            self.interval = TERMINAL_INTERVAL
+        else:
+            self.stream = None
+            self.interval = LOG_INTERVAL
+        self.start = time.time()
+        self.last = self.start
+        self.next = 1
+        self.verticesAtStart = vertices() if vertices is not None else 0
+        self.width = 0
+
+    def update(self, done):
+        if done < self.next:
+            return
+        now = time.time()
+        elapsed = now - self.start
+        rate = done / elapsed if elapsed > 0 else 0
+        self.next = done + max(1, int(rate * TERMINAL_INTERVAL / 4))
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        self.show(self.message(done, elapsed), False)
+
+    def finish(self, done):
+        elapsed = time.time() - self.start
+        message = "%s: %d %s in %s" % (self.name, done, self.unit, formatDuration(elapsed))
+        if elapsed > 0:
+            message += ", %.0f %s/s" % (done / elapsed, self.unit)
+        self.show(message, True)
+
+    def message(self, done, elapsed):
+        rate = done / elapsed
+        message = "%s: %d" % (self.name, done)
+        if self.total:
+            message += "/%d %s (%.1f%%)" % (self.total, self.unit, 100.0 * done / self.total)
+        else:
+            message += " " + self.unit
+        message += ", %.0f %s/s" % (rate, self.unit)
+        if self.vertices is not None:
+            message += ", %.0f vertices/s" % ((self.vertices() - self.verticesAtStart) / elapsed)
+        if self.total and rate > 0:
+            message += ", ETA %s" % formatDuration(max(0, self.total - done) / rate)
+        return message
+
+    def show(self, message, last):
+        if self.stream is None:
+            logging.info(message)
+            return
+        # Pad to wipe out the end of a longer status line
+        self.stream.write("\r" + message.ljust(self.width) + ("\n" if last else ""))
+        self.stream.flush()
+        self.width = 0 if last else len(message)
+
+
+class NullProgress(object):
+    def update(self, done):
+        pass
+
+    def finish(self, done):
+        pass
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+""" Reprojection for ogr2osm
+
+TransformCache builds one coordinate transformation to WGS84 per source
+spatial reference and shares it between layers (and tiles, and partitions),
+instead of one per layer. Sources that already are WGS84 get no
+transformation at all.
+
+By default every geometry is transformed on its own with Transform(). With
+--batch-reproject, BatchTransformer transforms the distinct vertices of a
+whole batch of features with a single TransformPoints() call, or with pyproj
+if asked to and it is installed. The parser then looks the transformed
+coordinates up by source coordinates as it creates the nodes, so the OGR
+geometries themselves stay in source coordinates.
+"""
+
+from osgeo import osr
+
+from tiling import vertices
+
+# Number of features transformed together
+BATCHSIZE = 1000
+
+
+def setTraditionalAxisOrder(spatialRef):
+    # GDAL 3 follows the axis order of the CRS definition, which is lat/lon
+    # for EPSG:4326; ogr2osm expects x to be the longitude
+    if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+        spatialRef.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+
+class TransformCache(object):
+    def __init__(self):
+        self.target = osr.SpatialReference()
+        self.target.ImportFromEPSG(4326)
+        setTraditionalAxisOrder(self.target)
+        self.transforms = {}
+
+    def get(self, spatialRef):
+        # The transformation from spatialRef to WGS84, or None if there is
+        # nothing to transform
+        if spatialRef is None:
+            return None
+        key = spatialRef.ExportToWkt()
+        try:
+            return self.transforms[key]
+        except KeyError:
+            pass
+        spatialRef = spatialRef.Clone()
+        setTraditionalAxisOrder(spatialRef)
+        if spatialRef.IsSame(self.target):
+            coordTrans = None
+        else:
+            coordTrans = osr.CoordinateTransformation(spatialRef, self.target)
+        self.transforms[key] = coordTrans
+        return coordTrans
+
+
+class BatchTransformer(object):
+    def __init__(self, spatialRef, coordTrans, usePyproj=False):
+        self.coordTrans = coordTrans
+        self.pyprojTransform = None
+        if usePyproj:
+            self.pyprojTransform = pyprojTransformer(spatialRef)
+
+    def transform(self, coordinates):
+        # Transforms a list of (x, y) tuples
+        if not coordinates:
+            return []
+        if self.pyprojTransform is not None:
+            (xs, ys) = self.pyprojTransform([x for (x, y) in coordinates],
+                                            [y for (x, y) in coordinates])
+            return zip(xs, ys)
+        return [(x, y) for (x, y, z) in self.coordTrans.TransformPoints(coordinates)]
+
+    def transformGeometries(self, ogrgeometries):
+        # Maps the distinct vertices of the geometries to their transformed
+        # coordinates
+        distinct = set()
+        for ogrgeometry in ogrgeometries:
+            distinct.update(vertices(ogrgeometry))
+        source = list(distinct)
+        return dict(zip(source, self.transform(source)))
+
+
+def pyprojTransformer(spatialRef):
+    # A function transforming lists of xs and ys to WGS84 with pyproj, or
+    # None if pyproj is not installed
+    try:
+        import pyproj
+    except ImportError:
+        return None
+    if hasattr(pyproj, "Transformer"):
+        transformer = pyproj.Transformer.from_crs(spatialRef.ExportToWkt(), "EPSG:4326",
+                                                  always_xy=True)
+        return transformer.transform
+    source = pyproj.Proj(spatialRef.ExportToProj4())
+    target = pyproj.Proj(init="epsg:4326")
+    return lambda xs, ys: pyproj.transform(source, target, xs, ys)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+""" Road name lookup for ogr2osm2
+
+Road names come from the r_lname and r_name tables. Instead of querying them
+once per road, RoadNames either loads the whole road id -> name mapping with
+a single streamed query (preload), or fetches the names for a batch of road
+ids with one parameterised IN (...) query per chunk (prefetch). Like the
+per-road query it replaces, a road only gets a name when exactly one name row
+matches it.
+
+Works with any DB-API connection; pass placeholder='?' for sqlite3.
+"""
+
+NAME_QUERY = ("select r_lname.ID, r_name.PathName from r_lname "
+              "left outer join r_name on r_lname.Route_ID = r_name.Route_ID "
+              "where r_name.Language = '1'")
+
+
+class RoadNames(object):
+    def __init__(self, conn, placeholder='%s', batchsize=1000):
+        self.conn = conn
+        self.placeholder = placeholder
+        self.batchsize = batchsize
+        self.names = {}
+        self.preloaded = False
+
+    def cursor(self):
+        # A named cursor makes psycopg2 stream the rows from the server
+        # instead of fetching the whole result set into memory
+        try:
+            cur = self.conn.cursor(name="roadnames")
+            cur.itersize = 10000
+        except TypeError:
+            cur = self.conn.cursor()
+        return cur
+
+    def load(self, cur):
+        names = self.names
+        ambiguous = set()
+        for (id, name) in cur:
+            id = str(id)
+            if id in names:
+                ambiguous.add(id)
+            names[id] = name
+        for id in ambiguous:
+            del names[id]
+
+    def preload(self):
+        self.names = {}
+        cur = self.cursor()
+        cur.execute(NAME_QUERY)
+        self.load(cur)
+        cur.close()
+        self.preloaded = True
+
+    def prefetch(self, ids):
+        # Replace the cached names with the ones for these road ids
+        if self.preloaded:
+            return
+        self.names = {}
+        ids = list(set(ids))
+        cur = self.conn.cursor()
+        for i in range(0, len(ids), self.batchsize):
+            chunk = ids[i:i + self.batchsize]
+            query = (NAME_QUERY + " and r_lname.ID in (" +
+                     ", ".join([self.placeholder] * len(chunk)) + ")")
+            cur.execute(query, chunk)
+            self.load(cur)
+        cur.close()
+
+    def get(self, id):
+        return self.names.get(id)
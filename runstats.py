@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+""" Run statistics for ogr2osm
+
+With --stats FILE, RunStats times the phases of a run, keeps counters (the
+features read and parsed, the vertices, the nodes merged, the elements
+written, and deleted in an osmChange file) and samples the peak resident
+memory of the process at the end of every phase. The report is written to
+FILE as JSON.
+
+Without --stats the scripts get a NullStats, whose methods do nothing. Nothing
+is counted per feature or per vertex in either case: the scripts fill the
+counters from the layers and the parsed elements once a phase is over, and
+the elements written are counted by a CountingWriter that is only put around
+the writer when the statistics are kept.
+"""
+
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peakRss():
+    # Peak resident memory of the process so far in MB, None where unknown
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on OS X
+    if sys.platform == "darwin":
+        return round(maxrss / 1024.0 / 1024, 1)
+    return round(maxrss / 1024.0, 1)
+
+
+class Phase(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.startPhase(self.name)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.endPhase(self.name, time.time() - self.start)
+        return False
+
+
+class RunStats(object):
+    enabled = True
+
+    def __init__(self):
+        self.start = time.time()
+        # Phases in the order they first ran; a phase that runs again, like
+        # the parsing of each tile, adds to its time
+        self.phases = []
+        self.phaseIndex = {}
+        # Names of the phases running, a phase can run within another one
+        self.running = []
+        self.counters = {}
+        # Reports of other parts of the run, like the hook profile
+        self.sections = {}
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def startPhase(self, name):
+        if name not in self.phaseIndex:
+            entry = {'name': name, 'seconds': 0.0, 'calls': 0}
+            if self.running:
+                entry['within'] = self.running[-1]
+            self.phaseIndex[name] = entry
+            self.phases.append(entry)
+        self.running.append(name)
+
+    def endPhase(self, name, seconds):
+        self.running.pop()
+        entry = self.phaseIndex[name]
+        entry['seconds'] += seconds
+        entry['calls'] += 1
+        entry['peak_rss_mb'] = peakRss()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def section(self, name, report):
+        self.sections[name] = report
+
+    def wrapWriter(self, writer):
+        return CountingWriter(writer, self)
+
+    def report(self):
+        phases = []
+        for entry in self.phases:
+            entry = dict(entry)
+            entry['seconds'] = round(entry['seconds'], 4)
+            phases.append(entry)
+        report = {'seconds': round(time.time() - self.start, 4),
+                  'peak_rss_mb': peakRss(),
+                  'phases': phases,
+                  'counters': self.counters}
+        report.update(self.sections)
+        return report
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
+
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullStats(object):
+    enabled = False
+
+    def __init__(self):
+        self.nullPhase = NullPhase()
+
+    def phase(self, name):
+        return self.nullPhase
+
+    def count(self, name, n=1):
+        pass
+
+    def section(self, name, report):
+        pass
+
+    def wrapWriter(self, writer):
+        return writer
+
+    def write(self, filename):
+        pass
+
+
+class CountingWriter(object):
+    # Counts the elements passed on to the writer, and adds them to the
+    # counters of the stats when closed
+    def __init__(self, writer, stats):
+        self.writer = writer
+        self.stats = stats
+        self.nodes = 0
+        self.ways = 0
+        self.relations = 0
+        # Elements deleted, by type, in an osmChange file
+        self.deleted = {}
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def node(self, id, x, y, tags):
+        self.nodes += 1
+        self.writer.node(id, x, y, tags)
+
+    def way(self, id, refs, tags):
+        self.ways += 1
+        self.writer.way(id, refs, tags)
+
+    def relation(self, id, members, tags):
+        self.relations += 1
+        self.writer.relation(id, members, tags)
+
+    def delete(self, elementtype, id):
+        self.deleted[elementtype] = self.deleted.get(elementtype, 0) + 1
+        self.writer.delete(elementtype, id)
+
+    def close(self):
+        self.writer.close()
+        self.stats.count("nodes written", self.nodes)
+        self.stats.count("ways written", self.ways)
+        self.stats.count("relations written", self.relations)
+        for (elementtype, count) in self.deleted.items():
+            self.stats.count("%ss deleted" % elementtype, count)
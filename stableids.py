@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+""" Stable element ids for ogr2osm
+
+getNewID() numbers the elements in the order they are parsed, so their ids
+change from run to run. With --id-file, StableIdAllocator maps a key for each
+element, such as the source feature it comes from or the location of a node,
+to an id kept in a sqlite database. An element then gets the same id in every
+run, and only elements that were not there before get new ones.
+
+The ids are looked up once parsing is done, for a whole list of keys at a
+time, so they cost one query per few hundred elements rather than one query
+per element in the parse loop.
+"""
+
+import sqlite3
+
+SCHEMA = """
+create table if not exists ids (kind text, key text, id integer,
+                                primary key (kind, key));
+create table if not exists meta (key text primary key, value integer);
+"""
+
+# sqlite allows 999 parameters per statement
+CHUNKSIZE = 500
+
+
+class StableIdAllocator(object):
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        self.conn.text_factory = str
+        self.conn.executescript(SCHEMA)
+        row = self.conn.execute("select value from meta where key = 'lastid'").fetchone()
+        # Ids count down from -1, like the ones from getNewID()
+        self.lastid = row[0] if row is not None else 0
+
+    def newid(self):
+        # An id that is not recorded, for elements without a key
+        self.lastid -= 1
+        return self.lastid
+
+    def assign(self, kind, keys):
+        # Returns the ids for a list of keys of one kind of element,
+        # allocating ids for the keys seen for the first time. A key repeated
+        # in the list gets a distinct id for every repetition.
+        counts = {}
+        uniquekeys = []
+        for key in keys:
+            n = counts.get(key, 0)
+            counts[key] = n + 1
+            if n > 0:
+                key = "%s#%d" % (key, n)
+            uniquekeys.append(key)
+
+        known = {}
+        distinct = list(set(uniquekeys))
+        for i in range(0, len(distinct), CHUNKSIZE):
+            chunk = distinct[i:i + CHUNKSIZE]
+            query = ("select key, id from ids where kind = ? and key in (" +
+                     ", ".join(["?"] * len(chunk)) + ")")
+            known.update(self.conn.execute(query, [kind] + chunk))
+
+        ids = []
+        new = []
+        for key in uniquekeys:
+            id = known.get(key)
+            if id is None:
+                id = self.newid()
+                known[key] = id
+                new.append((kind, key, id))
+            ids.append(id)
+        self.conn.executemany("insert into ids (kind, key, id) values (?, ?, ?)", new)
+        return ids
+
+    def close(self):
+        self.conn.execute("insert or replace into meta (key, value) values ('lastid', ?)",
+                          (self.lastid,))
+        self.conn.commit()
+        self.conn.close()
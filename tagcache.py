@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+""" Memoized tag translation for ogr2osm
+
+Road datasets repeat the same attributes over and over: millions of features
+share a few thousand combinations of field values. With --tag-cache N, the
+tags of a feature are looked up by the tuple of the field values they are
+made from, and the tags are only made, and filterTags only called, for the
+combinations not seen recently. The features with the same values share one
+SharedTags object, which cannot be changed in place. The scripts therefore
+do not use the cache with translations that define filterFeaturePost or
+preOutputTransform, the hooks that are given the features and may change
+their tags.
+
+Only a filterTags whose result depends on nothing but the tags it is given
+can be cached. The default one is; a translation marks its own with
+
+    filterTags.pure = True
+
+and without that the cache is not used.
+
+TagCache approximates a least recently used cache of N entries with two
+generations of N/2: when the recent one is full it becomes the older one, and
+the previous older one is dropped. Entries used again while in the older
+generation move back to the recent one. Lookups are plain dict lookups.
+Fields whose values are unique per feature, like ids, make every lookup a
+miss; the hit and miss counters tell.
+"""
+
+
+class SharedTags(dict):
+    # Tags shared by the features with the same field values
+    __slots__ = ()
+
+    def readonly(self, *args, **kwargs):
+        raise TypeError("these tags are shared by the tag cache and cannot be " +
+                        "changed, give the feature a copy instead")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = readonly
+
+    def __reduce__(self):
+        # Pickle a plain copy, as unpickling would go through __setitem__
+        return (SharedTags, (dict(self),))
+
+
+def plainTags(tags):
+    # The tags as a plain dict where they have to be, like for marshal
+    if isinstance(tags, SharedTags):
+        return dict(tags)
+    return tags
+
+
+def isPure(function):
+    return getattr(function, "pure", False)
+
+
+class TagCache(object):
+    def __init__(self, size):
+        self.half = max(1, size // 2)
+        self.recent = {}
+        self.older = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        # The tags kept for key, or KeyError
+        try:
+            tags = self.recent[key]
+        except KeyError:
+            tags = self.older.pop(key)
+            self.keep(key, tags)
+        self.hits += 1
+        return tags
+
+    def add(self, key, tags):
+        # Keeps the tags made for key after a miss, and returns them shared
+        self.misses += 1
+        if tags is not None:
+            tags = SharedTags(tags)
+        self.keep(key, tags)
+        return tags
+
+    def keep(self, key, tags):
+        if len(self.recent) >= self.half:
+            self.evictions += len(self.older)
+            self.older = self.recent
+            self.recent = {}
+        self.recent[key] = tags
+
+    def counts(self):
+        return (self.hits, self.misses, self.evictions)
+
+    def resetCounts(self):
+        self.hits = self.misses = self.evictions = 0
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+""" Declarative tag mappings for ogr2osm
+
+Instead of turning fields into tags in filterTags, a translation can declare
+the mapping as data, in a module attribute tagMappings: a list of rules for
+every layer, or a dict of layer name to list of rules. A rule is a dict of:
+
+  field     the source field, required
+  tag       the tag to set. Without values or prefixes, the field value is
+            copied to it as is (to a tag named like the field if not given).
+  values    a dict of field value to what it maps to
+  prefixes  the same, for the longest prefix of the field value that is in it
+  split     a separator: only what comes before the first one is mapped
+  default   what the values matching nothing map to, by default no tags
+
+The rule {'field': '*'} copies every field of the layer as is, to a tag
+named like the field.
+
+What a value maps to is the value of tag if the rule has one, otherwise a dict
+of tags, or None for no tags. For example, NavInfo road directions:
+
+  {'field': 'Direction',
+   'values': {'2': {'oneway': 'yes', 'rDirection': 'no'},
+              '3': {'oneway': 'yes', 'rDirection': 'yes'}},
+   'default': {'oneway': 'no', 'rDirection': 'no'}}
+
+A layer with mappings only gets the tags of its rules, then filterTags runs
+on them as usual. TagMap compiles the rules for the fields of a layer once:
+field names become field indexes, and what a field value maps to is kept in a
+dict the first time it is worked out, so mapping a feature takes a field read
+and a dict lookup per rule.
+"""
+
+# Distinct values whose tags are kept per rule, so that a rule on a field
+# like a name does not keep every value; the others are worked out each time
+MAXVALUES = 10000
+
+RULE_KEYS = set(['field', 'tag', 'values', 'prefixes', 'split', 'default'])
+
+
+def layerRules(mappings, layerName):
+    # The rules declared for a layer, or None
+    if mappings is None:
+        return None
+    if isinstance(mappings, dict):
+        return mappings.get(layerName)
+    return mappings
+
+
+def compileRule(rule):
+    # A function of a field value returning the tags it maps to
+    tag = rule.get('tag')
+    def totags(target):
+        if target is None:
+            return {}
+        if tag is not None:
+            return {tag: target}
+        return dict(target)
+    values = dict((value, totags(target))
+                  for (value, target) in rule.get('values', {}).items())
+    prefixes = {}
+    for (prefix, target) in rule.get('prefixes', {}).items():
+        prefixes.setdefault(len(prefix), {})[prefix] = totags(target)
+    # Longest first
+    prefixes = sorted(prefixes.items(), reverse=True)
+    default = totags(rule.get('default'))
+    split = rule.get('split')
+
+    def resolve(value):
+        if split is not None:
+            value = value.split(split, 1)[0]
+        try:
+            return values[value]
+        except KeyError:
+            pass
+        for (length, table) in prefixes:
+            tags = table.get(value[:length])
+            if tags is not None:
+                return tags
+        return default
+    return resolve
+
+
+class TagMap(object):
+    def __init__(self, rules, fieldNames):
+        indexes = dict((name, j) for (j, name) in enumerate(fieldNames))
+        # (field index, tag) of the values copied as is
+        self.copies = []
+        # (field index, tags by value, resolve) of the values mapped
+        self.lookups = []
+        # Fields the rules name that the layer does not have
+        self.missing = []
+        for rule in rules:
+            unknown = set(rule) - RULE_KEYS
+            if unknown or 'field' not in rule:
+                raise ValueError("invalid tag mapping rule %r" % (rule,))
+            if rule['field'] == '*':
+                if len(rule) > 1:
+                    raise ValueError("invalid tag mapping rule %r" % (rule,))
+                self.copies.extend([(j, name) for (j, name) in enumerate(fieldNames)])
+                continue
+            index = indexes.get(rule['field'])
+            if index is None:
+                self.missing.append(rule['field'])
+            elif 'values' in rule or 'prefixes' in rule:
+                self.lookups.append((index, {}, compileRule(rule)))
+            else:
+                self.copies.append((index, rule.get('tag', rule['field'])))
+        # Indexes of the fields the tags are made from, copies first
+        self.fields = ([index for (index, tag) in self.copies] +
+                       [index for (index, results, resolve) in self.lookups])
+
+    def apply(self, ogrfeature):
+        tags = {}
+        for (index, tag) in self.copies:
+            tags[tag] = ogrfeature.GetFieldAsString(index)
+        for (index, results, resolve) in self.lookups:
+            value = ogrfeature.GetFieldAsString(index)
+            try:
+                mapped = results[value]
+            except KeyError:
+                mapped = resolve(value)
+                if len(results) < MAXVALUES:
+                    results[value] = mapped
+            tags.update(mapped)
+        return tags
+
+    def values(self, ogrfeature):
+        # The field values the tags are made from, for the tag cache
+        return tuple([ogrfeature.GetFieldAsString(index) for index in self.fields])
+
+    def fromValues(self, values):
+        # The tags of the field values given by values()
+        tags = dict(zip([tag for (index, tag) in self.copies], values))
+        return self.mapLookups(tags, values[len(self.copies):])
+
+    def copyTags(self, ogrfeature):
+        # The tags copied as is, which can differ for every feature
+        return dict([(tag, ogrfeature.GetFieldAsString(index)) for (index, tag) in self.copies])
+
+    def lookupValues(self, ogrfeature):
+        # The values of the mapped fields only, which features share more
+        return tuple([ogrfeature.GetFieldAsString(index)
+                      for (index, results, resolve) in self.lookups])
+
+    def fromLookupValues(self, values):
+        # The tags of the values given by lookupValues()
+        return self.mapLookups({}, values)
+
+    def mapLookups(self, tags, values):
+        for ((index, results, resolve), value) in zip(self.lookups, values):
+            try:
+                mapped = results[value]
+            except KeyError:
+                mapped = resolve(value)
+                if len(results) < MAXVALUES:
+                    results[value] = mapped
+            tags.update(mapped)
+        return tags
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+""" Tiled conversion for ogr2osm
+
+With --tile-size the input is converted one cell of a square grid at a time,
+so the memory needed depends on the size of a tile rather than of the whole
+dataset. Every feature belongs to the cell holding its first vertex and is
+only parsed with that tile.
+
+Nodes can be shared by features of different tiles. Before converting, a scan
+of the geometries collects the vertices of the features that touch or cross
+the edges of their cell, as only those can be shared with another tile. While
+writing, BoundaryIndex gives such a node the id it got in the first tile that
+wrote it and drops the copies made by later tiles. Tags of a point feature on
+a shared node are only kept from the first tile.
+
+Nodes are written tile by tile. Ways and relations go to a Spool and are
+written at the end, as the output formats want all the nodes first.
+
+The candidates are compared with the node coordinates as OGR reprojects them,
+so tiling is not used with --batch-reproject, whose transformer may differ in
+the last bits. Nor is it used with translations that define
+preOutputTransform, as the hook expects the whole dataset and would only be
+given one tile at a time.
+"""
+
+import marshal
+import math
+import tempfile
+
+from linepoints import linePoints
+from tagcache import plainTags
+
+
+def layersExtent(layers):
+    # Extent (minx, maxx, miny, maxy) covering all the layers
+    extents = [layer.GetExtent() for layer in layers]
+    return (min([e[0] for e in extents]), max([e[1] for e in extents]),
+            min([e[2] for e in extents]), max([e[3] for e in extents]))
+
+
+def firstVertex(ogrgeometry):
+    while ogrgeometry.GetGeometryCount() > 0:
+        ogrgeometry = ogrgeometry.GetGeometryRef(0)
+    if ogrgeometry.GetPointCount() == 0:
+        return None
+    return ogrgeometry.GetPoint_2D(0)
+
+
+def vertices(ogrgeometry):
+    count = ogrgeometry.GetGeometryCount()
+    if count > 0:
+        for i in range(count):
+            for vertex in vertices(ogrgeometry.GetGeometryRef(i)):
+                yield vertex
+    else:
+        for vertex in linePoints(ogrgeometry):
+            yield vertex
+
+
+class TileGrid(object):
+    # Cells are numbered row by row from the south west corner
+    def __init__(self, extent, size):
+        (self.minx, maxx, self.miny, maxy) = extent
+        self.size = size
+        self.cols = max(1, int(math.ceil((maxx - self.minx) / size)))
+        self.rows = max(1, int(math.ceil((maxy - self.miny) / size)))
+
+    def __len__(self):
+        return self.cols * self.rows
+
+    def cellof(self, x, y):
+        col = min(max(int((x - self.minx) / self.size), 0), self.cols - 1)
+        row = min(max(int((y - self.miny) / self.size), 0), self.rows - 1)
+        return row * self.cols + col
+
+    def bounds(self, cell):
+        (row, col) = divmod(cell, self.cols)
+        minx = self.minx + col * self.size
+        miny = self.miny + row * self.size
+        return (minx, miny, minx + self.size, miny + self.size)
+
+
+class CellLayer(object):
+    # A layer filtered on the features belonging to one cell of the grid
+    def __init__(self, layer, grid, cell):
+        self.layer = layer
+        self.grid = grid
+        self.cell = cell
+        (minx, miny, maxx, maxy) = grid.bounds(cell)
+        # cellof() may round a vertex lying on an edge to this cell
+        pad = grid.size * 1e-6
+        layer.SetSpatialFilterRect(minx - pad, miny - pad, maxx + pad, maxy + pad)
+        layer.ResetReading()
+
+    def __getattr__(self, name):
+        return getattr(self.layer, name)
+
+    def GetNextFeature(self):
+        while True:
+            ogrfeature = self.layer.GetNextFeature()
+            if ogrfeature is None:
+                return None
+            ogrgeometry = ogrfeature.GetGeometryRef()
+            if ogrgeometry is None:
+                continue
+            vertex = firstVertex(ogrgeometry)
+            if vertex is not None and self.grid.cellof(*vertex) == self.cell:
+                return ogrfeature
+
+
+class BoundaryIndex(object):
+    def __init__(self, grid):
+        self.grid = grid
+        # Vertices that may be shared between tiles, in output coordinates
+        self.candidates = set()
+        # Ids of the shared nodes written so far
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def scan(self, layer, reproject):
+        # Only the geometries are read, the fields are skipped
+        featureDefinition = layer.GetLayerDefn()
+        layer.SetIgnoredFields([featureDefinition.GetFieldDefn(j).GetNameRef()
+                                for j in range(featureDefinition.GetFieldCount())])
+        layer.SetSpatialFilter(None)
+        layer.ResetReading()
+        grid = self.grid
+        ogrfeature = layer.GetNextFeature()
+        while ogrfeature is not None:
+            ogrgeometry = ogrfeature.GetGeometryRef()
+            vertex = None
+            if ogrgeometry is not None:
+                vertex = firstVertex(ogrgeometry)
+            if vertex is not None:
+                (cminx, cminy, cmaxx, cmaxy) = grid.bounds(grid.cellof(*vertex))
+                (minx, maxx, miny, maxy) = ogrgeometry.GetEnvelope()
+                if (minx <= cminx or maxx >= cmaxx or
+                    miny <= cminy or maxy >= cmaxy):
+                    reproject(ogrgeometry)
+                    self.candidates.update(vertices(ogrgeometry))
+            ogrfeature = layer.GetNextFeature()
+        layer.SetIgnoredFields([])
+        layer.ResetReading()
+
+    def stitch(self, node, key):
+        # Returns whether the node has to be written. key tells apart nodes
+        # at the same location, if the caller does.
+        if (node.x, node.y) not in self.candidates:
+            return True
+        id = self.ids.get(key)
+        if id is None:
+            self.ids[key] = node.id
+            return True
+        node.id = id
+        return False
+
+
+class Spool(object):
+    # Stands in for the writer for ways and relations, keeping them in a
+    # temporary file until replay() passes them on to the real writer
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+
+    def way(self, id, refs, tags):
+        marshal.dump(('way', id, refs, plainTags(tags)), self.file)
+
+    def relation(self, id, members, tags):
+        marshal.dump(('relation', id, members, plainTags(tags)), self.file)
+
+    def replay(self, writer):
+        self.file.seek(0)
+        while True:
+            try:
+                (kind, id, refs, tags) = marshal.load(self.file)
+            except EOFError:
+                break
+            if kind == 'way':
+                writer.way(id, refs, tags)
+            else:
+                writer.relation(id, refs, tags)
+        self.file.close()
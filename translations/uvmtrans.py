@@ -74,12 +74,13 @@ def preOutputTransform(geometries, features):
     # Remove the building code nodes
     for feature in [f for f in features if f.tags["Layer"] == "VA-BLDG-ATTRIBUTES"]:
         print "Removing a text node: " + feature.tags["Text"]
-        features.remove(feature)
+        features.mark(feature)
         feature.geometry.removeparent(feature)
+    features.sweep()
     
     # Remove buildings that were not given a buildingid
     for feature in [f for f in features if "uvm:buildingid" not in f.tags]:
-        features.remove(feature)
+        features.mark(feature)
         try:
             geometries.remove(feature.geometry)
             try:
@@ -92,6 +93,7 @@ def preOutputTransform(geometries, features):
                 print "Failed -- geometry.points does not exist -- not a way"
         except:
             print "Failed -- two building features with same geometry??"
+    features.sweep()
 
     uvmjson(geometries, features)
 